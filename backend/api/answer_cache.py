@@ -0,0 +1,173 @@
+"""
+Cache of chat answers.
+
+An answer is reused when the document version, the normalized question and
+the conversation history all match. The document version
+(`document_answer_version`) is a digest of extracted_data, the ingestion
+state and the chat/embedding models, so an edit, a re-extraction or a
+re-ingestion makes old entries unreachable. `invalidate_answer_cache` also
+deletes those rows.
+
+With RAG_ANSWER_CACHE_SEMANTIC_THRESHOLD > 0, a question without history may
+also reuse the answer to a paraphrase: the closest cached question (cosine
+similarity of the query embeddings) for the same document version is
+accepted when its similarity is at least the threshold.
+
+Hit/miss counters per document are ChatCounter rows (api/chat_counters.py),
+reported as rag_metrics['answer_cache'] by the rag_status endpoint.
+"""
+import hashlib
+import json
+import logging
+from datetime import timedelta
+
+from django.db.models import F
+from django.utils import timezone
+from pgvector.django import CosineDistance
+
+from .embeddings import normalize_query_text
+from .models import ChatAnswerCache
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_OUTCOMES = ('hits', 'semantic_hits', 'misses', 'stores')
+
+
+def document_answer_version(document, *model_ids: str) -> str:
+    """Digest of everything an answer depends on besides the question itself."""
+    payload = json.dumps(
+        {
+            'extracted_data': document.extracted_data or {},
+            'edit_count': document.edit_count,
+            'rag_completed_at': document.rag_completed_at.isoformat() if document.rag_completed_at else None,
+            'rag_pages_indexed': document.rag_pages_indexed,
+            'models': list(model_ids),
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def history_digest(history: list | None) -> str:
+    """'' for a fresh conversation, otherwise a digest of the (sender, text) turns."""
+    if not history:
+        return ''
+    turns = [[h.get('sender', ''), normalize_query_text(h.get('text', ''))] for h in history]
+    return hashlib.sha256(json.dumps(turns, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def answer_cache_key(document_id: int, version: str, normalized_query: str, digest: str) -> str:
+    raw = f"{document_id}\x1f{version}\x1f{digest}\x1f{normalized_query}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class AnswerCache:
+    """
+    Lookup/store of cached answers for one document version.
+
+    `semantic_threshold` is a cosine similarity (0 disables paraphrase matching);
+    entries older than `ttl_days` are ignored.
+    """
+
+    def __init__(self, document, version: str, history: list | None = None,
+                 semantic_threshold: float = 0.0, ttl_days: float = 7):
+        self.document_id = document.id
+        self.version = version
+        self.digest = history_digest(history)
+        self.semantic_threshold = semantic_threshold
+        self.ttl_days = ttl_days
+
+    @property
+    def semantic(self) -> bool:
+        # Follow-up questions depend on the conversation; only fresh questions match by meaning.
+        return self.semantic_threshold > 0 and not self.digest
+
+    def _base_queryset(self):
+        cutoff = timezone.now() - timedelta(days=self.ttl_days)
+        return ChatAnswerCache.objects.filter(
+            document_id=self.document_id,
+            document_version=self.version,
+            created_at__gte=cutoff,
+        )
+
+    def lookup(self, query: str, query_vector=None):
+        """
+        Returns (row, kind) with kind 'exact' or 'semantic', or (None, None).
+        Never raises: a cache failure only costs an LLM call.
+        """
+        normalized = normalize_query_text(query)
+        key = answer_cache_key(self.document_id, self.version, normalized, self.digest)
+        try:
+            row = self._base_queryset().filter(cache_key=key).first()
+            kind = 'exact' if row else None
+
+            if row is None and self.semantic and query_vector is not None:
+                candidate = (
+                    self._base_queryset()
+                    .filter(history_digest='', query_embedding__isnull=False)
+                    .annotate(distance=CosineDistance('query_embedding', query_vector))
+                    .order_by('distance')
+                    .first()
+                )
+                if candidate is not None and candidate.distance <= 1 - self.semantic_threshold:
+                    row, kind = candidate, 'semantic'
+
+            if row is not None:
+                ChatAnswerCache.objects.filter(id=row.id).update(
+                    hit_count=F('hit_count') + 1,
+                    last_used_at=timezone.now(),
+                )
+            return row, kind
+        except Exception as e:
+            logger.warning(f"Answer cache lookup failed for document {self.document_id}: {e}")
+            return None, None
+
+    def store(self, query: str, answer: str, contexts: list[str], query_vector=None) -> None:
+        normalized = normalize_query_text(query)
+        key = answer_cache_key(self.document_id, self.version, normalized, self.digest)
+        try:
+            ChatAnswerCache.objects.update_or_create(
+                document_id=self.document_id,
+                cache_key=key,
+                defaults={
+                    'document_version': self.version,
+                    'history_digest': self.digest,
+                    'query_text': normalized,
+                    'query_embedding': query_vector if not self.digest else None,
+                    'answer': answer,
+                    'contexts': contexts,
+                    'hit_count': 0,
+                    'created_at': timezone.now(),
+                    'last_used_at': timezone.now(),
+                },
+            )
+        except Exception as e:
+            logger.warning(f"Answer cache write failed for document {self.document_id}: {e}")
+
+
+def invalidate_answer_cache(document_id: int) -> int:
+    """Delete every cached answer of a document (after edits or re-ingestion)."""
+    try:
+        deleted = ChatAnswerCache.objects.filter(document_id=document_id).delete()[0]
+    except Exception as e:
+        logger.warning(f"Failed to invalidate answer cache for document {document_id}: {e}")
+        return 0
+    if deleted:
+        logger.info(f"Answer cache: dropped {deleted} answers of document {document_id}")
+    return deleted
+
+
+def record_answer_cache_outcome(counters: dict, outcome: str) -> None:
+    """Count one outcome in a chat turn's counters (written by chat_counters.flush_counters)."""
+    name = f'answer_cache.{outcome}'
+    counters[name] = counters.get(name, 0) + 1
+
+
+def answer_cache_stats(counters: dict) -> dict:
+    """Reported rag_metrics['answer_cache']: outcome counts and hit rate."""
+    stats = {name: int(counters.get(name, 0)) for name in ANSWER_CACHE_OUTCOMES}
+    lookups = stats['hits'] + stats['semantic_hits'] + stats['misses']
+    stats['hit_rate'] = round((stats['hits'] + stats['semantic_hits']) / lookups, 4) if lookups else 0.0
+    return stats
@@ -3,3 +3,11 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+
+        # runserver: load the Ollama chat model before the first chat turn (WSGI/ASGI preload in config/).
+        from .ollama import preload_on_startup
+
+        preload_on_startup()
@@ -0,0 +1,82 @@
+"""
+Per-document chat counters (answer cache, field router).
+
+Chat turns do not read-modify-write Document.rag_metrics: that would take a
+row lock on every turn and contend with ingestion's `update_rag_metrics` on
+the same row. A turn collects its counts in a plain dict
+(`{"answer_cache.misses": 1, "answer_cache.stores": 1}`) and `flush_counters`
+adds them to ChatCounter rows with a single `UPDATE ... SET value = value + n`;
+rows are created on first use. `chat_metrics` rebuilds the rag_metrics
+sections (rates) on read.
+"""
+import logging
+
+from django.db import transaction
+from django.db.models import Case, F, FloatField, Value, When
+
+from .answer_cache import answer_cache_stats
+from .field_router import router_stats
+from .models import ChatCounter
+
+logger = logging.getLogger(__name__)
+
+# rag_metrics section -> function turning its raw counters into the reported stats
+SECTION_STATS = {
+    'answer_cache': answer_cache_stats,
+    'field_router': router_stats,
+}
+
+
+class _MissingCounters(Exception):
+    pass
+
+
+def flush_counters(document_id: int, counters: dict) -> None:
+    """Add a turn's `counters` to the document's ChatCounter rows (best-effort, never raises)."""
+    if not counters:
+        return
+    amounts = {name: float(value) for name, value in counters.items()}
+    queryset = ChatCounter.objects.filter(document_id=document_id, name__in=list(amounts))
+    increment = Case(
+        *[When(name=name, then=Value(amount)) for name, amount in amounts.items()],
+        default=Value(0.0),
+        output_field=FloatField(),
+    )
+    try:
+        try:
+            with transaction.atomic():
+                if queryset.update(value=F('value') + increment) < len(amounts):
+                    raise _MissingCounters()
+        except _MissingCounters:
+            # First use of a counter: create the rows at 0, then apply the whole increment once.
+            with transaction.atomic():
+                ChatCounter.objects.bulk_create(
+                    [ChatCounter(document_id=document_id, name=name, value=0.0) for name in amounts],
+                    ignore_conflicts=True,
+                )
+                queryset.update(value=F('value') + increment)
+    except Exception as e:
+        logger.warning(f"Failed to update chat counters for document {document_id}: {e}")
+
+
+def document_counters(document_id: int) -> dict[str, dict[str, float]]:
+    """Raw counters grouped by section: {"answer_cache": {"hits": 3.0, ...}, ...}."""
+    sections: dict[str, dict[str, float]] = {}
+    for name, value in ChatCounter.objects.filter(document_id=document_id).values_list('name', 'value'):
+        section, _, key = name.partition('.')
+        sections.setdefault(section, {})[key] = value
+    return sections
+
+
+def chat_metrics(document_id: int) -> dict:
+    """rag_metrics-style sections for the chat counters of a document."""
+    try:
+        sections = document_counters(document_id)
+    except Exception as e:
+        logger.warning(f"Failed to read chat counters for document {document_id}: {e}")
+        return {}
+    return {
+        section: SECTION_STATS[section](values)
+        for section, values in sections.items()
+        if section in SECTION_STATS
+    }
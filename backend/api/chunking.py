@@ -0,0 +1,231 @@
+"""
+Chunking helpers for RAG ingestion.
+
+`iter_markdown_chunks` walks page-marked markdown ("=== PAGE N ===" from Mistral
+OCR / Gemini, "--- PAGE N ---" from older extractions) in a single pass, tracks
+the markdown header hierarchy and yields chunks lazily, so the embedding stage
+can start before the whole document has been split.
+
+`NearDuplicateFilter` flags chunks that repeat an earlier one almost verbatim
+(legal boilerplate, fee tables reprinted on several pages) so they are not
+embedded and retrieved more than once.
+"""
+import random
+import re
+import zlib
+from typing import Container, Iterator, NamedTuple
+
+from .text_normalize import WORD_RE
+
+PAGE_MARKER_RE = re.compile(r"^\s*(?:---|===) PAGE (\d+) (?:---|===)\s*$")
+HEADER_RE = re.compile(r"^(#{1,3})\s+(.+?)\s*$")
+FENCE_RE = re.compile(r"^\s*(```|~~~)")
+
+DEFAULT_CHUNK_SIZE = 800
+DEFAULT_CHUNK_OVERLAP = 100
+
+
+class MarkdownChunk(NamedTuple):
+    page_number: int
+    headers: tuple  # (Header 1, Header 2, Header 3) - missing levels are None
+    text: str
+
+
+def format_chunk_content(chunk: MarkdownChunk) -> str:
+    """Stored chunk content: Header 1/2 context lines followed by the chunk text."""
+    header_context = ""
+    if chunk.headers[0]:
+        header_context += f"# {chunk.headers[0]}\n"
+    if chunk.headers[1]:
+        header_context += f"## {chunk.headers[1]}\n"
+    return header_context + chunk.text
+
+
+def _make_splitter(chunk_size: int, chunk_overlap: int):
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=["\n\n", "\n", ".", " ", ""],
+    )
+
+
+def _iter_lines(text: str) -> Iterator[str]:
+    # Like str.split('\n') but without materializing the list of lines.
+    start = 0
+    while True:
+        end = text.find("\n", start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+
+def iter_page_sections(text: str) -> Iterator[tuple[int, tuple, str]]:
+    """
+    Yield (page_number, headers, section_text) for every run of lines that shares
+    the same page and header path. Header lines themselves are not part of the text.
+
+    The header path starts empty on every page, like the per-page header
+    splitting this replaces: a chunk's header context only comes from headings
+    on its own page.
+    """
+    page = 1
+    headers: list = [None, None, None]
+    buffer: list[str] = []
+    in_fence = False
+
+    def flush():
+        section = "\n".join(buffer)
+        buffer.clear()
+        if section.strip():
+            return page, tuple(headers), section
+        return None
+
+    for line in _iter_lines(text):
+        if FENCE_RE.match(line):
+            in_fence = not in_fence
+            buffer.append(line)
+            continue
+
+        if not in_fence:
+            marker = PAGE_MARKER_RE.match(line)
+            if marker:
+                section = flush()
+                if section:
+                    yield section
+                page = int(marker.group(1))
+                headers[:] = [None, None, None]
+                continue
+
+            header = HEADER_RE.match(line)
+            if header:
+                section = flush()
+                if section:
+                    yield section
+                level = len(header.group(1))
+                headers[level - 1] = header.group(2)
+                for deeper in range(level, 3):
+                    headers[deeper] = None
+                continue
+
+        buffer.append(line)
+
+    section = flush()
+    if section:
+        yield section
+
+
+def iter_markdown_chunks(
+    text: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+    pages: Container[int] | None = None,
+) -> Iterator[MarkdownChunk]:
+    """
+    Split page-marked markdown into chunks of at most `chunk_size` characters, lazily.
+    With `pages`, sections of other pages are skipped before splitting.
+    """
+    splitter = _make_splitter(chunk_size, chunk_overlap)
+    for page, headers, section in iter_page_sections(text):
+        if pages is not None and page not in pages:
+            continue
+        for piece in splitter.split_text(section):
+            yield MarkdownChunk(page, headers, piece)
+
+
+# --- Near-duplicate detection ------------------------------------------------
+
+MINHASH_PERMUTATIONS = 64
+SHINGLE_WORDS = 3
+DEFAULT_NEAR_DUP_THRESHOLD = 0.9
+
+# Largest prime below 2**32: (a * h + b) stays within uint64 for 32-bit hashes.
+_HASH_PRIME = 4294967291
+
+
+def _lsh_bands(threshold: float, permutations: int) -> tuple[int, int]:
+    """
+    Pick (bands, rows) so that pairs at `threshold` similarity almost surely
+    share a band while clearly different chunks rarely do: the S-curve
+    midpoint (1/b)^(1/r) is kept ~0.15 below the threshold.
+    """
+    best = (permutations, 1)
+    for rows in range(1, permutations + 1):
+        if permutations % rows:
+            continue
+        bands = permutations // rows
+        if (1 / bands) ** (1 / rows) <= threshold - 0.15:
+            best = (bands, rows)
+    return best
+
+
+class NearDuplicateFilter:
+    """
+    Streaming near-duplicate detector for chunk texts (MinHash + LSH banding).
+
+    `find_or_add(text, key)` returns the key of an earlier text whose estimated
+    Jaccard similarity of word 3-shingles is at least `threshold`, or registers
+    `text` under `key` and returns None. Hashing uses crc32 and a fixed seed, so
+    the same document always deduplicates the same way (stable chunk plans).
+    """
+
+    def __init__(self, threshold: float = DEFAULT_NEAR_DUP_THRESHOLD, permutations: int = MINHASH_PERMUTATIONS):
+        import numpy as np
+
+        self._np = np
+        self.threshold = threshold
+        self.permutations = permutations
+        self.bands, self.rows = _lsh_bands(threshold, permutations)
+        rng = random.Random(0x5EED)
+        self._a = np.array([rng.randrange(1, _HASH_PRIME) for _ in range(permutations)], dtype=np.uint64)
+        self._b = np.array([rng.randrange(0, _HASH_PRIME) for _ in range(permutations)], dtype=np.uint64)
+        self._buckets: list[dict] = [{} for _ in range(self.bands)]
+        self._signatures: dict = {}
+        self.checked = 0
+        self.duplicates = 0
+
+    def signature(self, text: str):
+        np = self._np
+        words = WORD_RE.findall(text.lower())
+        if len(words) < SHINGLE_WORDS:
+            shingles = {" ".join(words)}
+        else:
+            shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+        hashes = np.array([zlib.crc32(s.encode("utf-8")) % _HASH_PRIME for s in shingles], dtype=np.uint64)
+        # (a * h + b) mod p for every permutation/shingle pair, then the minimum per permutation.
+        permuted = (np.outer(self._a, hashes) + self._b[:, None]) % np.uint64(_HASH_PRIME)
+        return tuple(permuted.min(axis=1).tolist())
+
+    def similarity(self, sig_a: tuple, sig_b: tuple) -> float:
+        return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / self.permutations
+
+    def find_or_add(self, text: str, key):
+        self.checked += 1
+        sig = self.signature(text)
+        band_keys = [sig[i * self.rows:(i + 1) * self.rows] for i in range(self.bands)]
+
+        candidates = []
+        for bucket, band_key in zip(self._buckets, band_keys):
+            for other in bucket.get(band_key, ()):
+                if other not in candidates:
+                    candidates.append(other)
+        for other in candidates:
+            if self.similarity(sig, self._signatures[other]) >= self.threshold:
+                self.duplicates += 1
+                return other
+
+        self._signatures[key] = sig
+        for bucket, band_key in zip(self._buckets, band_keys):
+            bucket.setdefault(band_key, []).append(key)
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "threshold": self.threshold,
+            "checked": self.checked,
+            "duplicates": self.duplicates,
+            "kept": self.checked - self.duplicates,
+        }
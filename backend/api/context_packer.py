@@ -0,0 +1,289 @@
+"""
+Token-budgeted context for chat prompts.
+
+The prompt used to carry every structured field (including the full
+portfolio/asset allocation JSON) plus 25 retrieved chunks, whatever the
+question. `pack_structured` keeps the core identification fields and the
+fields whose catalog phrases occur in the question; `pack_chunks` picks
+retrieved chunks greedily with an MMR-style diversity penalty (near-identical
+chunks are dropped) until the token budget is spent.
+
+Budgets are per chat provider (RAG_CONTEXT_BUDGET_<PROVIDER>, or
+RAG_CONTEXT_BUDGET for all). Tokens are estimated from characters
+(RAG_CHARS_PER_TOKEN); Vietnamese runs at roughly 3 characters per token on
+the supported chat models.
+"""
+import math
+import os
+import unicodedata
+from dataclasses import dataclass, field
+
+from .text_normalize import WORD_RE, fold_words
+
+DEFAULT_CHARS_PER_TOKEN = 3.0
+# Context tokens (structured block + chunks); instructions and history come on top.
+DEFAULT_CONTEXT_BUDGETS = {
+    'ollama': 3000,
+    'mistral': 12000,
+    'gemini': 24000,
+}
+DEFAULT_STRUCTURED_SHARE = 0.3
+DEFAULT_MMR_LAMBDA = 0.7
+DEFAULT_DUPLICATE_SIMILARITY = 0.85
+# A field value is cut (not dropped) when at least this many tokens are left for it.
+_MIN_FIELD_TOKENS = 40
+
+
+def chars_per_token() -> float:
+    return float(os.getenv("RAG_CHARS_PER_TOKEN", str(DEFAULT_CHARS_PER_TOKEN)))
+
+
+def estimate_tokens(text: str, ratio: float | None = None) -> int:
+    if not text:
+        return 0
+    return math.ceil(len(text) / (ratio or chars_per_token()))
+
+
+def context_budget(provider: str) -> int:
+    """Token budget of the prompt context for a chat provider."""
+    specific = os.getenv(f"RAG_CONTEXT_BUDGET_{provider.upper()}", "").strip()
+    if specific:
+        return int(specific)
+    return int(os.getenv("RAG_CONTEXT_BUDGET", str(DEFAULT_CONTEXT_BUDGETS.get(provider, 8000))))
+
+
+# --- Structured fields -------------------------------------------------------------
+
+@dataclass
+class StructuredField:
+    key: str
+    label: str
+    value: str
+
+    def render(self, value: str | None = None) -> str:
+        return f"- {self.label}: {self.value if value is None else value}"
+
+
+# Always sent: short, and needed to name the fund in any answer.
+CORE_FIELDS = ('fund_name', 'fund_code', 'management_company', 'custodian_bank')
+
+_FEE_WORDS = ('fee', 'fees')
+_RISK_WORDS = ('rui ro', 'an toan', 'risk', 'risks')
+_TRADING_WORDS = ('giao dich', 'trading', 'dat lenh', 'so lenh', 'cut off', 'nav', 'thanh toan')
+
+# Accent-folded phrases (whole words) of a question that select a field. Single
+# Vietnamese syllables are ambiguous once folded (bán/bạn, vay/vậy, mã/mà), so
+# they are not keys here but WEAK_KEYWORDS, matched with their diacritics.
+FIELD_KEYWORDS = {
+    'fund_name': ('ten quy', 'fund name'),
+    'fund_code': ('ma quy', 'ma chung chi quy', 'fund code', 'ticker'),
+    'fund_type': ('loai quy', 'loai hinh', 'fund type', 'quy mo', 'quy dong'),
+    'legal_structure': ('cau truc phap ly', 'phap ly', 'legal structure'),
+    'license_number': ('giay phep', 'gcn', 'license', 'licence'),
+    'regulator': ('co quan quan ly', 'ubck', 'ubcknn', 'regulator'),
+    'management_company': ('cong ty quan ly', 'ctql', 'management company'),
+    'custodian_bank': ('ngan hang giam sat', 'ngan hang', 'luu ky', 'custodian'),
+    'fund_supervisor': ('giam sat', 'supervisor'),
+    'auditor': ('kiem toan', 'auditor'),
+    'management_fee': _FEE_WORDS + ('phi quan ly', 'management fee'),
+    'subscription_fee': _FEE_WORDS + ('phat hanh', 'phi mua', 'gia mua', 'subscription'),
+    'redemption_fee': _FEE_WORDS + ('mua lai', 'phi ban', 'gia ban', 'redemption'),
+    'switching_fee': _FEE_WORDS + ('chuyen doi', 'switching'),
+    'total_expense_ratio': ('tong chi phi', 'chi phi', 'ter', 'expense', 'expenses'),
+    'custody_fee': ('phi luu ky', 'luu ky', 'custody'),
+    'audit_fee': ('phi kiem toan', 'audit'),
+    'supervisory_fee': ('phi giam sat',),
+    'other_expenses': ('chi phi', 'expense', 'expenses'),
+    'fees': _FEE_WORDS + ('chi phi', 'bieu phi', 'expense', 'expenses'),
+    'inception_date': ('ngay thanh lap', 'thanh lap', 'bat dau hoat dong', 'inception'),
+    'effective_date': ('ngay hieu luc', 'hieu luc', 'effective date'),
+    'investment_objective': ('muc tieu', 'objective'),
+    'investment_strategy': ('chien luoc', 'strategy'),
+    'investment_style': ('phong cach', 'investment style'),
+    'sector_focus': ('linh vuc', 'nganh nghe', 'sector'),
+    'benchmark': ('benchmark', 'tham chieu'),
+    'investment_restrictions': ('han che', 'gioi han', 'phai sinh', 'restriction', 'restrictions', 'derivative', 'derivatives'),
+    'borrowing_limit': ('khoan vay', 'di vay', 'vay no', 'han muc vay', 'borrow', 'borrowing'),
+    'leverage_limit': ('don bay', 'leverage'),
+    'trading_frequency': _TRADING_WORDS + ('tan suat',),
+    'cut_off_time': ('cut off', 'dong so lenh', 'thoi diem', 'thoi han'),
+    'nav_calculation_frequency': ('nav', 'gia tri tai san rong'),
+    'nav_publication': ('nav', 'cong bo'),
+    'settlement_cycle': ('thanh toan', 'settlement'),
+    'operational_details': _TRADING_WORDS,
+    'valuation_method': ('dinh gia', 'valuation'),
+    'pricing_source': ('nguon gia', 'dinh gia', 'pricing'),
+    'valuation': ('dinh gia', 'nguon gia', 'valuation', 'pricing'),
+    'investor_rights': ('quyen loi', 'quyen cua nha dau tu', 'nghia vu', 'investor rights'),
+    'distribution_agent': ('dai ly', 'phan phoi', 'distribution', 'distributor'),
+    'sales_channels': ('kenh ban', 'kenh phan phoi', 'phan phoi', 'sales channel', 'sales channels'),
+    'concentration_risk': _RISK_WORDS + ('tap trung', 'concentration'),
+    'liquidity_risk': _RISK_WORDS + ('thanh khoan', 'liquidity'),
+    'interest_rate_risk': _RISK_WORDS + ('lai suat', 'interest rate'),
+    'risk_factors': _RISK_WORDS,
+    'minimum_investment': ('toi thieu', 'so tien', 'minimum'),
+    'asset_allocation': ('phan bo', 'co cau', 'ty trong', 'dau tu vao', 'allocation'),
+    'portfolio': ('danh muc', 'co phieu', 'trai phieu', 'nam giu', 'dau tu vao', 'portfolio', 'holding', 'holdings'),
+}
+
+_FEE_SYLLABLES = ('phí',)
+# Single words, compared with their diacritics (casefolded). A question that only
+# matches these keeps every field, with the matched ones packed first.
+WEAK_KEYWORDS = {
+    'fund_code': ('mã',),
+    'management_fee': _FEE_SYLLABLES,
+    'subscription_fee': _FEE_SYLLABLES + ('mua',),
+    'redemption_fee': _FEE_SYLLABLES + ('bán',),
+    'switching_fee': _FEE_SYLLABLES,
+    'fees': _FEE_SYLLABLES,
+    'inception_date': ('ngày',),
+    'effective_date': ('ngày',),
+    'borrowing_limit': ('vay',),
+    'cut_off_time': ('giờ', 'lệnh'),
+    'trading_frequency': ('lệnh',),
+    'investor_rights': ('quyền',),
+    'sales_channels': ('kênh',),
+    'sector_focus': ('ngành',),
+}
+
+
+def _accented_words(text: str) -> set[str]:
+    return set(WORD_RE.findall(unicodedata.normalize("NFC", (text or "").casefold())))
+
+
+def match_field_keywords(query: str) -> tuple[set[str], set[str]]:
+    """(fields selected by a phrase of FIELD_KEYWORDS, fields selected only by a WEAK_KEYWORDS word)."""
+    padded = f" {fold_words(query)} "
+    strong = {
+        key for key, words in FIELD_KEYWORDS.items()
+        if any(f" {word} " in padded for word in words)
+    }
+    words = _accented_words(query)
+    weak = {
+        key for key, syllables in WEAK_KEYWORDS.items()
+        if key not in strong and any(s in words for s in syllables)
+    }
+    return strong, weak
+
+
+def matching_fields(query: str) -> set[str]:
+    """Catalog keys whose keywords occur (as whole words) in the question."""
+    strong, weak = match_field_keywords(query)
+    return strong | weak
+
+
+@dataclass
+class PackedStructured:
+    text: str = ""
+    tokens: int = 0
+    fields: list[str] = field(default_factory=list)
+    truncated: list[str] = field(default_factory=list)
+
+
+def pack_structured(header: str, fields: list[StructuredField], query: str, budget_tokens: int) -> PackedStructured:
+    """
+    Core fields, then the fields matching the question (catalog order). When the
+    question matches no field phrase, every field is a candidate, in catalog
+    order after the fields selected by weak keywords. Fields are added while
+    they fit `budget_tokens`; the first one that does not fit is cut to the
+    remaining space.
+    """
+    ratio = chars_per_token()
+    strong, weak = match_field_keywords(query)
+    if strong:
+        chosen = [f for f in fields if f.key in CORE_FIELDS or f.key in strong or f.key in weak]
+    else:
+        chosen = list(fields)
+    chosen.sort(key=lambda f: (f.key not in CORE_FIELDS, f.key not in strong, f.key not in weak))
+
+    packed = PackedStructured()
+    lines = [header]
+    used = estimate_tokens(header, ratio)
+    for item in chosen:
+        line = item.render()
+        cost = estimate_tokens(line, ratio) + 1
+        if used + cost > budget_tokens:
+            room = budget_tokens - used - estimate_tokens(item.render(""), ratio) - 1
+            if room >= _MIN_FIELD_TOKENS:
+                line = item.render(item.value[:int(room * ratio)] + " …")
+                cost = estimate_tokens(line, ratio) + 1
+                packed.truncated.append(item.key)
+            else:
+                continue
+        lines.append(line)
+        used += cost
+        packed.fields.append(item.key)
+
+    packed.text = "\n".join(lines)
+    packed.tokens = used
+    return packed
+
+
+# --- Retrieved chunks --------------------------------------------------------------
+
+def _word_set(text: str) -> frozenset:
+    return frozenset(fold_words(text).split())
+
+
+def _similarity(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+@dataclass
+class PackedChunks:
+    chunks: list = field(default_factory=list)
+    tokens: int = 0
+    dropped_duplicates: int = 0
+    dropped_budget: int = 0
+
+
+def pack_chunks(
+    chunks: list,
+    budget_tokens: int,
+    format_chunk,
+    mmr_lambda: float = DEFAULT_MMR_LAMBDA,
+    duplicate_similarity: float = DEFAULT_DUPLICATE_SIMILARITY,
+) -> PackedChunks:
+    """
+    Select from `chunks` (most relevant first) until `budget_tokens` is spent.
+
+    Each step takes the chunk maximizing
+    `mmr_lambda * relevance - (1 - mmr_lambda) * max word-set Jaccard similarity`
+    to the chunks already taken, where relevance falls linearly with the
+    retrieval rank. Chunks at least `duplicate_similarity` similar to a taken
+    chunk are dropped; chunks that no longer fit are skipped.
+    """
+    ratio = chars_per_token()
+    packed = PackedChunks()
+    if not chunks:
+        return packed
+
+    n = len(chunks)
+    remaining = list(range(n))
+    blocks = [format_chunk(c) for c in chunks]
+    costs = [estimate_tokens(b, ratio) + 2 for b in blocks]  # + separator
+    words = [_word_set(c.content) for c in chunks]
+    redundancy = [0.0] * n
+    taken: list[int] = []
+
+    while remaining:
+        best = max(
+            remaining,
+            key=lambda i: mmr_lambda * (1.0 - i / n) - (1.0 - mmr_lambda) * redundancy[i],
+        )
+        remaining.remove(best)
+        if redundancy[best] >= duplicate_similarity:
+            packed.dropped_duplicates += 1
+            continue
+        if packed.tokens + costs[best] > budget_tokens:
+            packed.dropped_budget += 1
+            continue
+        taken.append(best)
+        packed.tokens += costs[best]
+        for i in remaining:
+            redundancy[i] = max(redundancy[i], _similarity(words[i], words[best]))
+
+    packed.chunks = [chunks[i] for i in taken]
+    return packed
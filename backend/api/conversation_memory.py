@@ -0,0 +1,282 @@
+"""
+Bounded conversation memory for chat prompts.
+
+The client sends the whole conversation (up to 200 persisted messages) with
+every question, and it used to be replayed verbatim into every provider call.
+`build_memory` keeps only the last RAG_MEMORY_RECENT_TURNS question/answer
+pairs verbatim, cut to the provider's history budget
+(RAG_HISTORY_BUDGET_<PROVIDER>, or RAG_HISTORY_BUDGET for all). Older messages
+are represented by a rolling summary stored on `Document.chat_memory`:
+
+    {"format": 1, "summary": str, "covered": int, "digest": str, "updated_at": iso}
+
+`covered` is the number of leading messages the summary accounts for and
+`digest` their `history_digest`, so a cleared or different conversation never
+reuses another conversation's summary. Messages that aged out after the last
+summary are represented by their questions only until `refresh_summary_async`
+has folded them into the summary in a background thread; a turn never waits
+for the summarizer.
+
+`rewrite_query` is the only use of history in retrieval: a follow-up
+("còn phí mua lại?") is searched together with the previous question.
+"""
+import logging
+import os
+import threading
+import unicodedata
+from dataclasses import dataclass, field
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .answer_cache import history_digest
+from .context_packer import chars_per_token, estimate_tokens
+from .text_normalize import WORD_RE, fold_words
+
+logger = logging.getLogger(__name__)
+
+MEMORY_FORMAT = 1
+DEFAULT_RECENT_TURNS = 3
+# Tokens of summary + verbatim history per chat provider.
+DEFAULT_HISTORY_BUDGETS = {
+    'ollama': 800,
+    'mistral': 2500,
+    'gemini': 4000,
+}
+# Share of the history budget the rolling summary may use.
+SUMMARY_SHARE = 0.4
+# Characters of aged-out conversation sent to the summarizer per refresh.
+SUMMARY_INPUT_CHARS = 12000
+SUMMARY_MAX_CHARS = 2000
+# A verbatim message is cut (not dropped) when at least this many tokens are left for it.
+_MIN_MESSAGE_TOKENS = 40
+
+_refreshing: set[int] = set()
+_refreshing_lock = threading.Lock()
+
+
+def history_budget(provider: str) -> int:
+    """Token budget of summary + verbatim history for a chat provider."""
+    specific = os.getenv(f"RAG_HISTORY_BUDGET_{provider.upper()}", "").strip()
+    if specific:
+        return int(specific)
+    return int(os.getenv("RAG_HISTORY_BUDGET", str(DEFAULT_HISTORY_BUDGETS.get(provider, 2000))))
+
+
+def recent_turns() -> int:
+    return max(int(os.getenv("RAG_MEMORY_RECENT_TURNS", str(DEFAULT_RECENT_TURNS))), 0)
+
+
+def split_history(history: list, turns: int) -> tuple[list, list]:
+    """(older, recent): `recent` is the last `turns` question/answer pairs."""
+    history = [h for h in (history or []) if isinstance(h, dict) and h.get('text')]
+    keep = turns * 2
+    if keep == 0:
+        return history, []
+    return history[:-keep], history[-keep:]
+
+
+def _cut(text: str, tokens: int, ratio: float) -> str:
+    limit = int(tokens * ratio)
+    # The marker counts against the limit so the cut text still fits `tokens`.
+    return text if len(text) <= limit else text[:max(limit - 2, 0)].rstrip() + " …"
+
+
+@dataclass
+class ConversationMemory:
+    # Verbatim messages ({'sender', 'text'}) put in the prompt, oldest first
+    recent: list = field(default_factory=list)
+    # Rolling summary of the older messages (possibly stale)
+    summary: str = ""
+    # Questions of older messages the summary does not cover yet
+    pending_questions: list = field(default_factory=list)
+    # Older messages not yet folded into the stored summary
+    unsummarized: int = 0
+    dropped: int = 0
+    tokens: int = 0
+
+    @property
+    def needs_refresh(self) -> bool:
+        return self.unsummarized > 0
+
+    def render(self) -> str:
+        """Prompt block for everything older than the verbatim messages ('' when nothing)."""
+        parts = []
+        if self.summary:
+            parts.append(self.summary)
+        if self.pending_questions:
+            parts.append("Các câu hỏi trước đó: " + " | ".join(self.pending_questions))
+        return "\n".join(parts)
+
+    def usage(self) -> dict:
+        return {
+            'history_tokens': self.tokens,
+            'history_messages': len(self.recent),
+            'history_summarized': bool(self.summary),
+            'history_unsummarized': self.unsummarized,
+            'history_dropped': self.dropped,
+        }
+
+
+def stored_summary(document, older: list) -> tuple[str, int]:
+    """(summary, messages covered) of `document.chat_memory` if it belongs to this conversation."""
+    stored = getattr(document, 'chat_memory', None) or {}
+    covered = stored.get('covered', 0)
+    if stored.get('format') != MEMORY_FORMAT or not stored.get('summary') or not 0 < covered <= len(older):
+        return "", 0
+    if stored.get('digest') != history_digest(older[:covered]):
+        return "", 0
+    return stored['summary'], covered
+
+
+def build_memory(document, history: list, provider: str, turns: int | None = None) -> ConversationMemory:
+    """
+    Bounded view of `history`: summary (up to SUMMARY_SHARE of the budget), then
+    verbatim recent messages newest first while they fit, then the questions of
+    unsummarized older messages in whatever budget is left.
+    """
+    ratio = chars_per_token()
+    budget = history_budget(provider)
+    older, recent = split_history(history, recent_turns() if turns is None else turns)
+    summary, covered = stored_summary(document, older)
+
+    memory = ConversationMemory(unsummarized=len(older) - covered)
+    used = 0
+    if summary:
+        memory.summary = _cut(summary, int(budget * SUMMARY_SHARE), ratio)
+        used += estimate_tokens(memory.summary, ratio)
+
+    kept = []
+    for message in reversed(recent):
+        text = message.get('text', '')
+        cost = estimate_tokens(text, ratio) + 4  # + role overhead
+        if used + cost > budget:
+            room = budget - used - 4
+            if room < _MIN_MESSAGE_TOKENS:
+                break
+            text = _cut(text, room, ratio)
+            cost = estimate_tokens(text, ratio) + 4
+        kept.append({'sender': message.get('sender'), 'text': text})
+        used += cost
+    kept.reverse()
+    memory.recent = kept
+    memory.dropped = len(recent) - len(kept)
+
+    # Not summarized yet: the questions alone carry most of the thread.
+    for message in reversed(older[covered:]):
+        if message.get('sender') != 'user':
+            continue
+        question = _cut(message.get('text', ''), 60, ratio)
+        cost = estimate_tokens(question, ratio) + 1
+        if used + cost > budget:
+            break
+        memory.pending_questions.insert(0, question)
+        used += cost
+
+    memory.tokens = used
+    return memory
+
+
+def _transcript(messages: list) -> str:
+    lines = []
+    for message in messages:
+        speaker = "Người dùng" if message.get('sender') == 'user' else "Trợ lý"
+        lines.append(f"{speaker}: {message.get('text', '')}")
+    text = "\n".join(lines)
+    # Keep the newest part when a long backlog ages out at once.
+    return text[-SUMMARY_INPUT_CHARS:]
+
+
+def refresh_summary(document_id: int, history: list, summarize, turns: int | None = None) -> bool:
+    """
+    Fold the older messages of `history` not covered by the stored summary into
+    it. `summarize(previous_summary, transcript) -> str` calls the chat model.
+    Returns True when a new summary was stored.
+    """
+    from .models import Document
+
+    older, _ = split_history(history, recent_turns() if turns is None else turns)
+    document = Document.objects.only('id', 'chat_memory').get(id=document_id)
+    previous, covered = stored_summary(document, older)
+    if covered >= len(older):
+        return False
+
+    summary = (summarize(previous, _transcript(older[covered:])) or "").strip()
+    if not summary:
+        return False
+    Document.objects.filter(id=document_id).update(chat_memory={
+        'format': MEMORY_FORMAT,
+        'summary': summary[:SUMMARY_MAX_CHARS],
+        'covered': len(older),
+        'digest': history_digest(older),
+        'updated_at': timezone.now().isoformat(),
+    })
+    logger.info(f"Chat memory for Doc {document_id}: summarized {len(older)} messages")
+    return True
+
+
+def refresh_summary_async(document_id: int, history: list, summarize, turns: int | None = None) -> bool:
+    """Run `refresh_summary` in a daemon thread; at most one refresh per document at a time."""
+    with _refreshing_lock:
+        if document_id in _refreshing:
+            return False
+        _refreshing.add(document_id)
+
+    def _task():
+        try:
+            close_old_connections()
+            refresh_summary(document_id, history, summarize, turns)
+        except Exception as e:
+            logger.warning(f"Chat memory refresh failed for Doc {document_id}: {e}")
+        finally:
+            close_old_connections()
+            with _refreshing_lock:
+                _refreshing.discard(document_id)
+
+    threading.Thread(target=_task, daemon=True).start()
+    return True
+
+
+# --- Retrieval query -----------------------------------------------------------------
+
+# Accent-folded phrases that ask for more about the previous question.
+FOLLOW_UP_PHRASES = (
+    'the con', 'vay con', 'con ve', 'thi sao', 'nhu vay', 'chi tiet hon', 'giai thich them', 'noi ro hon',
+    'what about', 'how about', 'more detail', 'tell me more',
+)
+# First words of a follow-up ("Còn phí mua lại?"), compared with their diacritics.
+FOLLOW_UP_OPENERS = ('còn', 'vậy', 'and')
+# Pronouns and demonstratives pointing back to the previous turn, compared with their diacritics.
+ANAPHORA = ('nó', 'đó', 'này', 'ấy', 'kia', 'it', 'its', 'they', 'them', 'those')
+# "quỹ này" is the document's own fund, not a reference to the previous question.
+_SELF_REFERENCES = ('quỹ', 'fund')
+
+
+def is_follow_up(query: str) -> bool:
+    """True when the question opens, or refers back, like a follow-up. Length alone does not count."""
+    words = WORD_RE.findall(unicodedata.normalize("NFC", (query or "").casefold()))
+    if not words:
+        return False
+    if words[0] in FOLLOW_UP_OPENERS:
+        return True
+    padded = f" {fold_words(query)} "
+    if any(f" {phrase} " in padded for phrase in FOLLOW_UP_PHRASES):
+        return True
+    return any(
+        word in ANAPHORA and not (i and words[i - 1] in _SELF_REFERENCES)
+        for i, word in enumerate(words)
+    )
+
+
+def rewrite_query(query: str, history: list) -> str:
+    """
+    Retrieval query for `query`: a follow-up (see `is_follow_up`) is prefixed
+    with the previous user question so the search keeps its subject.
+    """
+    previous = next(
+        (h.get('text', '') for h in reversed(history or []) if isinstance(h, dict) and h.get('sender') == 'user'),
+        '',
+    )
+    if previous and is_follow_up(query):
+        return f"{previous.strip()} {query.strip()}"
+    return query
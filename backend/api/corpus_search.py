@@ -0,0 +1,129 @@
+"""
+Semantic search across every indexed document ("which funds allow derivatives?").
+
+Chat retrieval (RAGService.retrieve) searches one document. Corpus search runs
+the same vector (and, with hybrid search, keyword) ranking over all chunks
+embedded with the current model, optionally restricted by ExtractedFundData
+metadata, then groups the ranked chunks per document: documents are ordered
+by their best chunk and each keeps its `chunks_per_document` best chunks as
+page citations.
+
+Pagination is over documents. One search fetches a bounded candidate pool
+(RAG_CORPUS_SEARCH_CANDIDATES, grown with the requested page); documents
+beyond that pool are not reported, so `has_next` is only true while the pool
+still holds unseen documents.
+"""
+import os
+from dataclasses import dataclass, field
+
+from .models import Document, DocumentChunk
+
+# ExtractedFundData columns accepted as filters (case-insensitive substring match).
+CORPUS_FILTER_FIELDS = ('fund_type', 'management_company', 'custodian_bank')
+DEFAULT_CANDIDATES = 200
+MAX_CANDIDATES = 1000
+SNIPPET_CHARS = 400
+
+
+def corpus_queryset(embedding_model: str, filters: dict | None = None):
+    """Chunks searchable with `embedding_model` vectors, restricted by fund metadata `filters`."""
+    queryset = DocumentChunk.objects.filter(document__rag_embedding_model__in=[embedding_model, ''])
+    for name, value in (filters or {}).items():
+        if name not in CORPUS_FILTER_FIELDS:
+            raise ValueError(f"Unsupported corpus search filter: {name}")
+        if value:
+            queryset = queryset.filter(**{f'document__fund_data__{name}__icontains': value})
+    return queryset
+
+
+def candidate_count(page: int, page_size: int, chunks_per_document: int) -> int:
+    """
+    Chunks to fetch so that `page` can usually be filled: large prospectuses
+    contribute many near-identical chunks, hence the factor of two.
+    """
+    limit = int(os.getenv("RAG_CORPUS_SEARCH_CANDIDATES", str(DEFAULT_CANDIDATES)))
+    wanted = page * page_size * chunks_per_document * 2
+    return min(max(limit, wanted), MAX_CANDIDATES)
+
+
+def _snippet(text: str) -> str:
+    text = " ".join((text or "").split())
+    return text if len(text) <= SNIPPET_CHARS else text[:SNIPPET_CHARS].rstrip() + " …"
+
+
+@dataclass
+class DocumentHits:
+    document_id: int
+    best_rank: int
+    chunks: list = field(default_factory=list)
+
+    @property
+    def best_distance(self) -> float | None:
+        distances = [c.distance for c in self.chunks if c.distance is not None]
+        return min(distances) if distances else None
+
+
+def group_by_document(chunks: list, chunk_documents: dict[int, int], chunks_per_document: int) -> list[DocumentHits]:
+    """Ranked chunks -> documents ordered by their best-ranked chunk, each with its top chunks."""
+    groups: dict[int, DocumentHits] = {}
+    for rank, chunk in enumerate(chunks, start=1):
+        document_id = chunk_documents.get(chunk.id)
+        if document_id is None:
+            continue
+        group = groups.get(document_id)
+        if group is None:
+            group = groups[document_id] = DocumentHits(document_id, rank)
+        if len(group.chunks) < chunks_per_document:
+            group.chunks.append(chunk)
+    return sorted(groups.values(), key=lambda g: g.best_rank)
+
+
+def chunk_document_ids(chunk_ids: list[int]) -> dict[int, int]:
+    """chunk id -> document id, by primary key (keeps document_id out of the ranked queries)."""
+    if not chunk_ids:
+        return {}
+    return dict(DocumentChunk.objects.filter(id__in=chunk_ids).values_list('id', 'document_id'))
+
+
+def _fund_value(document, name: str):
+    fund_data = getattr(document, 'fund_data', None)
+    return getattr(fund_data, name, None) if fund_data is not None else None
+
+
+def describe_groups(groups: list[DocumentHits]) -> list[dict]:
+    """Response rows for one page of document groups, with fund metadata and page citations."""
+    documents = {
+        d.id: d for d in
+        Document.objects.filter(id__in=[g.document_id for g in groups]).select_related('fund_data')
+        .only('id', 'file_name', 'fund_data__fund_name', 'fund_data__fund_code', 'fund_data__fund_type',
+              'fund_data__management_company', 'fund_data__custodian_bank')
+    }
+    results = []
+    for group in groups:
+        document = documents.get(group.document_id)
+        if document is None:
+            continue
+        best = group.best_distance
+        results.append({
+            'document_id': document.id,
+            'file_name': document.file_name,
+            'fund_name': _fund_value(document, 'fund_name'),
+            'fund_code': _fund_value(document, 'fund_code'),
+            'fund_type': _fund_value(document, 'fund_type'),
+            'management_company': _fund_value(document, 'management_company'),
+            'custodian_bank': _fund_value(document, 'custodian_bank'),
+            'rank': group.best_rank,
+            'best_distance': round(best, 4) if best is not None else None,
+            'pages': sorted({c.page_number for c in group.chunks}),
+            'matches': [
+                {
+                    'chunk_id': c.id,
+                    'page': c.page_number,
+                    'alias_pages': sorted(c.alias_pages or []),
+                    'distance': round(c.distance, 4) if c.distance is not None else None,
+                    'snippet': _snippet(c.content),
+                }
+                for c in group.chunks
+            ],
+        })
+    return results
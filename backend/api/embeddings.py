@@ -0,0 +1,517 @@
+"""
+Embedding helpers for RAG ingestion.
+
+Embeddings are cached in the database keyed by (sha256 of the normalized text,
+embedding model) so that re-ingesting a document, or ingesting prospectuses that
+share the same legal boilerplate, only sends *new* text to the provider.
+
+Embedding backends are pluggable (RAG_EMBEDDING_BACKEND): the Mistral API
+(default) or a local ONNX sentence-embedding model run on CPU. Every backend
+returns vectors of EMBEDDING_DIMENSIONS so they fit DocumentChunk.embedding.
+"""
+import abc
+import hashlib
+import logging
+import os
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.db.models import F
+from django.utils import timezone
+
+from .models import EmbeddingCache, QueryEmbeddingCache
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# Must match VectorField(dimensions=...) on DocumentChunk / EmbeddingCache.
+EMBEDDING_DIMENSIONS = 1024
+
+
+def normalize_embedding_text(text: str) -> str:
+    """Canonical form of a chunk used for cache keys (NFC + collapsed whitespace)."""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFC", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def embedding_text_hash(text: str) -> str:
+    """sha256 hex digest of the normalized chunk text."""
+    return hashlib.sha256(normalize_embedding_text(text).encode("utf-8")).hexdigest()
+
+
+def _as_list(vector) -> list[float]:
+    # pgvector returns numpy arrays from the DB; providers return plain lists.
+    return vector.tolist() if hasattr(vector, "tolist") else list(vector)
+
+
+class CachedEmbedder:
+    """
+    Wraps an `embed_fn(texts) -> list[vector]` with a persistent cache.
+
+    Every call does a single bulk lookup for the batch, sends only the misses
+    (deduplicated) to `embed_fn`, and writes the new vectors back.
+    Hit/miss counters accumulate until `reset_stats()` is called.
+    """
+
+    def __init__(self, embed_fn, embedding_model: str, enabled: bool = True):
+        self.embed_fn = embed_fn
+        self.embedding_model = embedding_model
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        if not self.enabled:
+            self.misses += len(texts)
+            self.api_calls += 1
+            return [_as_list(v) for v in self.embed_fn(list(texts))]
+
+        hashes = [embedding_text_hash(t) for t in texts]
+        cached = self.lookup(hashes)
+
+        # Deduplicate misses inside the batch (same boilerplate on several pages).
+        missing: dict[str, str] = {}
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in cached and text_hash not in missing:
+                missing[text_hash] = text
+
+        if missing:
+            self.api_calls += 1
+            new_vectors = self.embed_fn(list(missing.values()))
+            fresh = {h: _as_list(v) for h, v in zip(missing.keys(), new_vectors)}
+            self.store(fresh)
+            cached.update(fresh)
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        return [cached[h] for h in hashes]
+
+    def lookup(self, hashes: list[str]) -> dict[str, list[float]]:
+        """Bulk-fetch cached vectors for `hashes`; bumps hit counters for found rows."""
+        unique_hashes = list(dict.fromkeys(hashes))
+        try:
+            rows = list(
+                EmbeddingCache.objects.filter(
+                    embedding_model=self.embedding_model,
+                    text_hash__in=unique_hashes,
+                ).values_list("id", "text_hash", "embedding")
+            )
+        except Exception as e:
+            logger.warning(f"Embedding cache lookup failed, embedding without cache: {e}")
+            return {}
+
+        if rows:
+            try:
+                EmbeddingCache.objects.filter(id__in=[r[0] for r in rows]).update(
+                    hit_count=F("hit_count") + 1,
+                    last_used_at=timezone.now(),
+                )
+            except Exception as e:
+                logger.debug(f"Embedding cache touch failed: {e}")
+
+        return {text_hash: _as_list(vector) for _, text_hash, vector in rows}
+
+    def store(self, vectors: dict[str, list[float]]) -> None:
+        """Persist new vectors (best-effort; concurrent ingestions may race on the same key)."""
+        if not vectors:
+            return
+        try:
+            EmbeddingCache.objects.bulk_create(
+                [
+                    EmbeddingCache(
+                        text_hash=text_hash,
+                        embedding_model=self.embedding_model,
+                        embedding=vector,
+                    )
+                    for text_hash, vector in vectors.items()
+                ],
+                batch_size=500,
+                ignore_conflicts=True,
+            )
+        except Exception as e:
+            logger.warning(f"Embedding cache write failed: {e}")
+
+    def reset_stats(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "model": self.embedding_model,
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "api_calls": self.api_calls,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+# --- Embedding backends -----------------------------------------------------
+
+class EmbeddingModelMismatch(ValueError):
+    """A document's chunks were embedded by a different backend than the current one."""
+
+
+class EmbeddingBackend(abc.ABC):
+    """
+    Interface for embedding providers.
+
+    `name` identifies the vector space (it is the embedding-cache key and is
+    stored on Document.rag_embedding_model); vectors from different names must
+    never be compared.
+    """
+
+    name: str = ""
+    dimensions: int = EMBEDDING_DIMENSIONS
+
+    @abc.abstractmethod
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        """Embed document chunks."""
+
+    def embed_query(self, text: str) -> list[float]:
+        """Embed a search query (some models use a different prefix for queries)."""
+        return self.embed([text])[0]
+
+
+class MistralEmbeddingBackend(EmbeddingBackend):
+    """mistral-embed through the Mistral API, with retry + jitter."""
+
+    def __init__(self, client, model: str = "mistral-embed-2312", max_retries: int = 3):
+        self.client = client
+        self.name = model
+        self.max_retries = max_retries
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        retry_count = 0
+        while True:
+            try:
+                resp = self.client.embeddings.create(model=self.name, inputs=texts)
+                return [item.embedding for item in resp.data]
+            except Exception as e:
+                retry_count += 1
+                if retry_count < self.max_retries:
+                    wait_time = (2 ** retry_count) + random.uniform(0, 1.0)  # jitter
+                    logger.warning(
+                        f"Embedding API error (attempt {retry_count}/{self.max_retries}): {e}. Retrying in {wait_time}s..."
+                    )
+                    time.sleep(wait_time)
+                else:
+                    logger.error(f"Failed to embed batch after {self.max_retries} attempts: {str(e)}")
+                    raise
+
+
+class OnnxEmbeddingBackend(EmbeddingBackend):
+    """
+    Local sentence-embedding model exported to ONNX, run on CPU with onnxruntime.
+
+    `model_dir` must contain `model.onnx` and a HuggingFace `tokenizer.json`
+    (e.g. an ONNX export of BAAI/bge-m3, which is multilingual and natively
+    1024-dim). Texts are tokenized and run in batches of `batch_size`; the
+    token states are pooled ("cls" or "mean"), L2-normalized and zero-padded
+    to EMBEDDING_DIMENSIONS. Zero padding leaves cosine distances unchanged,
+    so smaller models (384/768-dim) work without a schema migration.
+    """
+
+    def __init__(
+        self,
+        model_dir: str,
+        name: str | None = None,
+        threads: int = 4,
+        batch_size: int = 16,
+        max_length: int = 512,
+        pooling: str = "cls",
+        query_prefix: str = "",
+        passage_prefix: str = "",
+    ):
+        try:
+            import onnxruntime as ort
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImportError(
+                "RAG_EMBEDDING_BACKEND=onnx requires the 'onnxruntime' and 'tokenizers' packages "
+                "(pip install onnxruntime tokenizers)"
+            ) from e
+
+        model_path = os.path.join(model_dir, "model.onnx")
+        tokenizer_path = os.path.join(model_dir, "tokenizer.json")
+        if not os.path.exists(model_path) or not os.path.exists(tokenizer_path):
+            raise ValueError(f"ONNX embedding model not found: expected model.onnx and tokenizer.json in {model_dir}")
+        if pooling not in {"cls", "mean"}:
+            raise ValueError(f"Invalid pooling: {pooling}. Use 'cls' or 'mean'")
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+
+        self.name = name or f"onnx:{os.path.basename(os.path.normpath(model_dir))}"
+        self.batch_size = max(batch_size, 1)
+        self.pooling = pooling
+        self.query_prefix = query_prefix
+        self.passage_prefix = passage_prefix
+        # InferenceSession.run is thread-safe, but concurrent runs just fight over the same threads.
+        self._lock = threading.Lock()
+
+    def _run(self, texts: list[str]) -> list[list[float]]:
+        import numpy as np
+
+        vectors: list[list[float]] = []
+        for start in range(0, len(texts), self.batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start:start + self.batch_size])
+            input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+            feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self._input_names:
+                feeds["token_type_ids"] = np.zeros_like(input_ids)
+
+            with self._lock:
+                hidden = self.session.run(None, feeds)[0]  # (batch, tokens, dim)
+
+            if self.pooling == "cls":
+                pooled = hidden[:, 0, :]
+            else:
+                mask = attention_mask[:, :, None].astype(hidden.dtype)
+                pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+            pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            dim = pooled.shape[1]
+            if dim > EMBEDDING_DIMENSIONS:
+                raise ValueError(
+                    f"Embedding model {self.name} returns {dim}-dim vectors; "
+                    f"DocumentChunk.embedding holds {EMBEDDING_DIMENSIONS} (needs a migration)"
+                )
+            if dim < EMBEDDING_DIMENSIONS:
+                pooled = np.pad(pooled, ((0, 0), (0, EMBEDDING_DIMENSIONS - dim)))
+            vectors.extend(pooled.astype(np.float32).tolist())
+        return vectors
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        return self._run([self.passage_prefix + t for t in texts])
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._run([self.query_prefix + text])[0]
+
+
+_backend_lock = threading.Lock()
+_local_backends: dict[tuple, EmbeddingBackend] = {}
+
+
+def get_embedding_backend(mistral_client=None) -> EmbeddingBackend:
+    """
+    Embedding backend selected by RAG_EMBEDDING_BACKEND ('mistral' default, or 'onnx').
+
+    ONNX settings: RAG_EMBEDDING_MODEL_DIR (required), RAG_EMBEDDING_MODEL_NAME,
+    RAG_EMBEDDING_THREADS, RAG_EMBEDDING_BATCH_SIZE, RAG_EMBEDDING_MAX_LENGTH,
+    RAG_EMBEDDING_POOLING, RAG_EMBEDDING_QUERY_PREFIX, RAG_EMBEDDING_PASSAGE_PREFIX.
+    Local models are loaded once per process and shared.
+    """
+    backend = os.getenv("RAG_EMBEDDING_BACKEND", "mistral").strip().lower()
+    if backend == "mistral":
+        if mistral_client is None:
+            raise ValueError("MISTRAL_API_KEY environment variable is not set (required when RAG_EMBEDDING_BACKEND=mistral)")
+        return MistralEmbeddingBackend(
+            mistral_client,
+            model=os.getenv("RAG_EMBEDDING_MODEL_NAME", "mistral-embed-2312").strip(),
+        )
+
+    if backend == "onnx":
+        model_dir = os.getenv("RAG_EMBEDDING_MODEL_DIR", "").strip()
+        if not model_dir:
+            raise ValueError("RAG_EMBEDDING_MODEL_DIR not set (required when RAG_EMBEDDING_BACKEND=onnx)")
+        config = (
+            model_dir,
+            os.getenv("RAG_EMBEDDING_MODEL_NAME", "").strip() or None,
+            int(os.getenv("RAG_EMBEDDING_THREADS", str(min(os.cpu_count() or 1, 4)))),
+            int(os.getenv("RAG_EMBEDDING_BATCH_SIZE", "16")),
+            int(os.getenv("RAG_EMBEDDING_MAX_LENGTH", "512")),
+            os.getenv("RAG_EMBEDDING_POOLING", "cls").strip().lower(),
+            os.getenv("RAG_EMBEDDING_QUERY_PREFIX", ""),
+            os.getenv("RAG_EMBEDDING_PASSAGE_PREFIX", ""),
+        )
+        with _backend_lock:
+            if config not in _local_backends:
+                logger.info(f"Loading ONNX embedding model from {model_dir} ({config[2]} threads)")
+                _local_backends[config] = OnnxEmbeddingBackend(*config)
+            return _local_backends[config]
+
+    raise ValueError(f"Invalid RAG_EMBEDDING_BACKEND: {backend}. Use 'mistral' or 'onnx'")
+
+
+# --- Query embedding cache ----------------------------------------------------
+
+_QUERY_EDGE_PUNCTUATION = " ?!.,;:…\"'“”‘’()[]-"
+
+
+def normalize_query_text(text: str) -> str:
+    """
+    Cache key form of a chat query: NFC (Vietnamese input methods emit both
+    precomposed and combining diacritics), case-folded, whitespace collapsed,
+    surrounding punctuation dropped. Diacritics are kept: "phí" and "phi"
+    are different words.
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFC", unicodedata.normalize("NFC", text).casefold())
+    text = _WHITESPACE_RE.sub(" ", text)
+    return text.strip(_QUERY_EDGE_PUNCTUATION)
+
+
+class _QueryLRU:
+    """Process-wide LRU of query vectors with a TTL (RAGService is created per request)."""
+
+    def __init__(self):
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, ttl_seconds: float):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            vector, stored_at = entry
+            if time.monotonic() - stored_at > ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return vector
+
+    def put(self, key, vector, max_entries: int) -> None:
+        with self._lock:
+            self._entries[key] = (vector, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+_query_memory = _QueryLRU()
+_query_stats_lock = threading.Lock()
+_query_stats = {"memory_hits": 0, "db_hits": 0, "misses": 0}
+
+
+def query_cache_stats() -> dict:
+    """Hit/miss counters of this process's query embedding cache."""
+    with _query_stats_lock:
+        stats = dict(_query_stats)
+    total = sum(stats.values())
+    stats["hit_rate"] = round((stats["memory_hits"] + stats["db_hits"]) / total, 4) if total else 0.0
+    return stats
+
+
+def _count_query(outcome: str) -> None:
+    with _query_stats_lock:
+        _query_stats[outcome] += 1
+
+
+class CachedQueryEmbedder:
+    """
+    Query embeddings through an in-process LRU, then the QueryEmbeddingCache
+    table, then the backend. Hits never touch the embedding provider.
+
+    `last_source` is 'memory', 'db' or 'backend' for the latest call.
+    """
+
+    def __init__(
+        self,
+        backend: EmbeddingBackend,
+        enabled: bool = True,
+        max_entries: int = 512,
+        memory_ttl_seconds: float = 3600,
+        ttl_days: float = 30,
+    ):
+        self.backend = backend
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.memory_ttl_seconds = memory_ttl_seconds
+        self.ttl_days = ttl_days
+        self.last_source = None
+
+    def embed_query(self, text: str) -> list[float]:
+        if not self.enabled:
+            self.last_source = "backend"
+            return _as_list(self.backend.embed_query(text))
+
+        normalized = normalize_query_text(text)
+        query_hash = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        key = (self.backend.name, query_hash)
+
+        vector = _query_memory.get(key, self.memory_ttl_seconds)
+        if vector is not None:
+            self.last_source = "memory"
+            _count_query("memory_hits")
+            return vector
+
+        vector = self._lookup(query_hash)
+        if vector is not None:
+            self.last_source = "db"
+            _count_query("db_hits")
+        else:
+            vector = _as_list(self.backend.embed_query(text))
+            self.last_source = "backend"
+            _count_query("misses")
+            self._store(query_hash, normalized, vector)
+
+        _query_memory.put(key, vector, self.max_entries)
+        return vector
+
+    def _lookup(self, query_hash: str):
+        cutoff = timezone.now() - timedelta(days=self.ttl_days)
+        try:
+            row = (
+                QueryEmbeddingCache.objects.filter(
+                    query_hash=query_hash,
+                    embedding_model=self.backend.name,
+                    created_at__gte=cutoff,
+                )
+                .values_list("id", "embedding")
+                .first()
+            )
+            if row is None:
+                return None
+            QueryEmbeddingCache.objects.filter(id=row[0]).update(
+                hit_count=F("hit_count") + 1,
+                last_used_at=timezone.now(),
+            )
+            return _as_list(row[1])
+        except Exception as e:
+            logger.warning(f"Query embedding cache lookup failed: {e}")
+            return None
+
+    def _store(self, query_hash: str, normalized: str, vector: list[float]) -> None:
+        # update_or_create also refreshes an expired row for the same key.
+        try:
+            QueryEmbeddingCache.objects.update_or_create(
+                query_hash=query_hash,
+                embedding_model=self.backend.name,
+                defaults={
+                    "query_text": normalized,
+                    "embedding": vector,
+                    "hit_count": 0,
+                    "created_at": timezone.now(),
+                    "last_used_at": timezone.now(),
+                },
+            )
+        except Exception as e:
+            logger.warning(f"Query embedding cache write failed: {e}")
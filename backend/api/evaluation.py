@@ -1,4 +1,5 @@
 import os
+import sys
 import pandas as pd
 import ast
 from datasets import Dataset
@@ -11,7 +12,11 @@ from ragas.metrics import (
 )
 from langchain_ollama import ChatOllama, OllamaEmbeddings
 
-def run_evaluation():
+def run_evaluation(csv_path: str = "ragas_dataset.csv", output_file: str = "ragas_results_local.csv"):
+    """
+    Judge one RAGAS dataset CSV (generate_ragas_data, or run_rag_eval --export-csv).
+    RAGAS_MAX_WORKERS sets how many judge calls run at once (default 1).
+    """
     print("--- Setting up RAGAS with Local Qwen 2.5 Judge ---")
 
     # 1. Cấu hình Judge (Dùng Qwen 2.5 thay cho Llama 3)
@@ -39,7 +44,6 @@ def run_evaluation():
     ]
 
     # 4. Load dữ liệu
-    csv_path = "ragas_dataset.csv"
     try:
         df = pd.read_csv(csv_path)
         df['contexts'] = df['contexts'].apply(ast.literal_eval)
@@ -52,14 +56,18 @@ def run_evaluation():
   
 
     print("\nRunning RAGAS Evaluation LOCALLY...")
-    print("Lưu ý: Đang chạy tuần tự 1-1 để tránh lỗi JSON. Sẽ mất khoảng 5-10 phút.")
-    
+    max_workers = int(os.getenv("RAGAS_MAX_WORKERS", "1"))
+    if max_workers == 1:
+        print("Lưu ý: Đang chạy tuần tự 1-1 để tránh lỗi JSON. Sẽ mất khoảng 5-10 phút.")
+    run_config = RunConfig(timeout=int(os.getenv("RAGAS_TIMEOUT", "300")), max_workers=max_workers)
+
     try:
         results = evaluate(
             dataset=dataset,
             metrics=metrics,
             llm=local_judge,
             embeddings=local_embeddings,
+            run_config=run_config,
         )
     except Exception as e:
         print(f"\n Evaluation failed: {e}")
@@ -68,9 +76,9 @@ def run_evaluation():
     print("\n---  Evaluation Results (Local) ---")
     print(results)
 
-    output_file = "ragas_results_local.csv"
     results.to_pandas().to_csv(output_file, index=False)
     print(f"\n Detailed report saved to {output_file}")
 
 if __name__ == "__main__":
-    run_evaluation()
\ No newline at end of file
+    # python evaluation.py [dataset.csv [results.csv]]
+    run_evaluation(*sys.argv[1:3])
\ No newline at end of file
@@ -0,0 +1,317 @@
+"""
+Structured-field router: answers lookup questions without retrieval or LLM.
+
+Questions such as "Mã quỹ là gì?", "Phí quản lý bao nhiêu?" or "Who is the
+custodian bank?" ask for one extracted field. `route_question` recognizes
+them from accent-folded trigger phrases (longest match wins, so "phí mua lại"
+is the redemption fee, not the subscription fee); optionally, questions no
+phrase matches are compared with prototype questions by embedding
+(RAG_ROUTER_EMBEDDINGS). A route is confident only for short questions, with
+at most MAX_ROUTED_FIELDS fields, no explanatory wording ("tại sao", "so
+sánh", ...) and a non-empty value for every field; everything else takes the
+full RAG path.
+
+Values and page citations come from Document.extracted_data ({value, page,
+bbox} objects), falling back to the ExtractedFundData column without a page.
+Counters and latencies are ChatCounter rows (api/chat_counters.py), reported
+as rag_metrics['field_router'] by the rag_status endpoint.
+"""
+import logging
+import math
+import os
+import time
+from dataclasses import dataclass, field
+
+from .models import ExtractedFundData
+from .text_normalize import fold_words
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORDS = 12
+DEFAULT_EMBEDDING_THRESHOLD = 0.88
+MAX_ROUTED_FIELDS = 3
+ROUTER_OUTCOMES = ('routed', 'fallthrough', 'generated')
+
+
+@dataclass(frozen=True)
+class FieldRoute:
+    key: str
+    # Location in Document.extracted_data
+    path: tuple
+    label: str
+    # Accent-folded trigger phrases (whole words), Vietnamese and English
+    phrases: tuple
+
+
+ROUTES = (
+    FieldRoute('fund_name', ('fund_name',), "Tên quỹ",
+               ('ten quy', 'ten day du cua quy', 'fund name', 'name of the fund')),
+    FieldRoute('fund_code', ('fund_code',), "Mã quỹ",
+               ('ma quy', 'ma chung chi quy', 'fund code', 'ticker')),
+    FieldRoute('fund_type', ('fund_type',), "Loại quỹ",
+               ('loai quy', 'loai hinh quy', 'fund type', 'type of fund')),
+    FieldRoute('license_number', ('license_number',), "Số giấy phép",
+               ('giay phep', 'so giay phep', 'giay chung nhan dang ky', 'license number', 'licence number')),
+    FieldRoute('regulator', ('regulator',), "Cơ quan quản lý",
+               ('co quan quan ly', 'regulator')),
+    FieldRoute('management_company', ('management_company',), "Công ty quản lý quỹ",
+               ('cong ty quan ly', 'ctql', 'management company', 'fund manager')),
+    FieldRoute('custodian_bank', ('custodian_bank',), "Ngân hàng giám sát",
+               ('ngan hang giam sat', 'ngan hang luu ky', 'custodian', 'custodian bank')),
+    FieldRoute('auditor', ('auditor',), "Tổ chức kiểm toán",
+               ('kiem toan', 'cong ty kiem toan', 'to chuc kiem toan', 'auditor')),
+    FieldRoute('management_fee', ('fees', 'management_fee'), "Phí quản lý",
+               ('phi quan ly', 'management fee')),
+    FieldRoute('subscription_fee', ('fees', 'subscription_fee'), "Phí phát hành",
+               ('phi phat hanh', 'phi mua', 'subscription fee')),
+    FieldRoute('redemption_fee', ('fees', 'redemption_fee'), "Phí mua lại",
+               ('phi mua lai', 'phi ban', 'redemption fee')),
+    FieldRoute('switching_fee', ('fees', 'switching_fee'), "Phí chuyển đổi",
+               ('phi chuyen doi', 'switching fee')),
+    FieldRoute('total_expense_ratio', ('fees', 'total_expense_ratio'), "Tổng chi phí (TER)",
+               ('ter', 'tong chi phi', 'ty le tong chi phi', 'total expense ratio', 'expense ratio')),
+    FieldRoute('custody_fee', ('fees', 'custody_fee'), "Phí lưu ký",
+               ('phi luu ky', 'custody fee')),
+    FieldRoute('audit_fee', ('fees', 'audit_fee'), "Phí kiểm toán",
+               ('phi kiem toan', 'audit fee')),
+    FieldRoute('supervisory_fee', ('fees', 'supervisory_fee'), "Phí giám sát",
+               ('phi giam sat', 'supervisory fee')),
+    FieldRoute('benchmark', ('benchmark',), "Chỉ số tham chiếu",
+               ('benchmark', 'chi so tham chieu')),
+    FieldRoute('cut_off_time', ('operational_details', 'cut_off_time'), "Thời điểm đóng sổ lệnh",
+               ('cut off', 'cut off time', 'thoi diem dong so lenh', 'dong so lenh')),
+    FieldRoute('trading_frequency', ('operational_details', 'trading_frequency'), "Tần suất giao dịch",
+               ('tan suat giao dich', 'trading frequency', 'dealing frequency')),
+    FieldRoute('nav_calculation_frequency', ('operational_details', 'nav_calculation_frequency'), "Tần suất tính NAV",
+               ('tan suat tinh nav', 'tan suat dinh gia', 'nav calculation frequency')),
+    FieldRoute('settlement_cycle', ('operational_details', 'settlement_cycle'), "Chu kỳ thanh toán",
+               ('chu ky thanh toan', 'settlement cycle')),
+    FieldRoute('inception_date', ('inception_date',), "Ngày thành lập",
+               ('ngay thanh lap', 'thanh lap khi nao', 'thanh lap nam nao', 'inception date')),
+)
+ROUTES_BY_KEY = {route.key: route for route in ROUTES}
+
+# Wording that asks for reasoning or conditions rather than a stored value.
+EXPLANATORY_MARKERS = (
+    'tai sao', 'vi sao', 'giai thich', 'nhu the nao', 'the nao', 'so sanh', 'khac nhau', 'khac gi',
+    'dieu kien', 'truong hop', 'ap dung', 'tinh nhu', 'cach tinh', 'anh huong', 'rui ro',
+    'why', 'how is', 'how are', 'how does', 'how do', 'calculated', 'explain', 'compare', 'difference',
+    'condition', 'conditions', 'impact',
+)
+
+# Stored values that mean "not extracted", as folded by fold_words ("N/A" -> "n a").
+_EMPTY_VALUES = {'', 'none', 'null', 'n a', 'na', 'khong co', 'khong ro', 'not found'}
+
+
+def router_enabled() -> bool:
+    raw = os.getenv("RAG_FIELD_ROUTER", "true").strip().lower()
+    return raw not in {"0", "false", "no", "off"}
+
+
+def match_fields(question: str) -> list[str]:
+    """
+    Route keys whose trigger phrases occur in `question`, in order of
+    appearance. Matches inside a longer matched phrase are dropped.
+    """
+    padded = f" {fold_words(question)} "
+    spans = []
+    for route in ROUTES:
+        for phrase in route.phrases:
+            needle = f" {phrase} "
+            start = padded.find(needle)
+            while start != -1:
+                spans.append((start, start + len(needle), route.key))
+                start = padded.find(needle, start + 1)
+    kept = [
+        span for span in spans
+        if not any(o[0] <= span[0] and span[1] <= o[1] and (o[1] - o[0]) > (span[1] - span[0]) for o in spans)
+    ]
+    keys = []
+    for _, _, key in sorted(kept):
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+def is_lookup_question(question: str) -> bool:
+    """Short and not asking for an explanation."""
+    folded = fold_words(question)
+    max_words = int(os.getenv("RAG_ROUTER_MAX_WORDS", str(DEFAULT_MAX_WORDS)))
+    if not folded or len(folded.split()) > max_words:
+        return False
+    padded = f" {folded} "
+    return not any(f" {marker} " in padded for marker in EXPLANATORY_MARKERS)
+
+
+# --- Embedding classifier ------------------------------------------------------------
+
+_prototype_vectors: dict[str, list] = {}
+
+
+def prototype_questions(route: FieldRoute) -> list[str]:
+    return [f"{route.label} của quỹ là gì?", f"{route.label} là bao nhiêu?"]
+
+
+def _cosine(a, b) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def embedding_match(query_vector, embed_query, model: str, threshold: float | None = None) -> list[str]:
+    """
+    The single route whose prototype questions are closest to `query_vector`,
+    if the cosine similarity reaches `threshold`. Prototype vectors are embedded
+    once per process and model through `embed_query` (query embedding cache).
+    """
+    if threshold is None:
+        threshold = float(os.getenv("RAG_ROUTER_EMBEDDING_THRESHOLD", str(DEFAULT_EMBEDDING_THRESHOLD)))
+    best_key, best = None, 0.0
+    for route in ROUTES:
+        for i, text in enumerate(prototype_questions(route)):
+            cache_key = f"{model}\x1f{route.key}\x1f{i}"
+            vector = _prototype_vectors.get(cache_key)
+            if vector is None:
+                vector = _prototype_vectors[cache_key] = embed_query(text)
+            similarity = _cosine(query_vector, vector)
+            if similarity > best:
+                best_key, best = route.key, similarity
+    return [best_key] if best_key and best >= threshold else []
+
+
+# --- Answers -------------------------------------------------------------------------
+
+@dataclass
+class FieldAnswer:
+    key: str
+    label: str
+    value: str
+    page: int | None = None
+    bbox: list | None = None
+
+
+@dataclass
+class RoutedAnswer:
+    fields: list[FieldAnswer] = field(default_factory=list)
+    # 'keyword' or 'embedding'
+    method: str = ""
+    elapsed_ms: float = 0.0
+
+    @property
+    def text(self) -> str:
+        lines = [f"{f.label}: {f.value}" for f in self.fields]
+        pages = sorted({f.page for f in self.fields if f.page})
+        if pages:
+            lines.append(f"(Nguồn: Trang {', '.join(str(p) for p in pages)})")
+        else:
+            lines.append("(Nguồn: dữ liệu đã trích xuất)")
+        return "\n".join(lines)
+
+    def sources(self) -> list[dict]:
+        return [
+            {'field': f.key, 'page': f.page, 'bbox': f.bbox, 'alias_pages': []}
+            for f in self.fields if f.page
+        ]
+
+    def summary(self) -> dict:
+        return {
+            'fields': [f.key for f in self.fields],
+            'method': self.method,
+            'elapsed_ms': round(self.elapsed_ms, 1),
+        }
+
+
+def _located(extracted_data: dict, path: tuple):
+    """The stored object at `path`, or at the last path element at the top level (flat extractions)."""
+    current = extracted_data
+    for key in path:
+        current = current.get(key) if isinstance(current, dict) else None
+    if current is None and len(path) > 1:
+        current = extracted_data.get(path[-1])
+    return current
+
+
+def _clean_value(value) -> str | None:
+    if value is None or isinstance(value, (dict, list)):
+        return None
+    text = " ".join(str(value).split())
+    return None if fold_words(text) in _EMPTY_VALUES else text
+
+
+def field_answer(document, key: str, fund_data=None) -> FieldAnswer | None:
+    """Value and location of one routed field, or None when it was not extracted."""
+    route = ROUTES_BY_KEY[key]
+    stored = _located(document.extracted_data or {}, route.path)
+    if isinstance(stored, dict):
+        value = _clean_value(stored.get('value'))
+        page = stored.get('page') if isinstance(stored.get('page'), int) else None
+        bbox = stored.get('bbox') if isinstance(stored.get('bbox'), list) else None
+    else:
+        value, page, bbox = _clean_value(stored), None, None
+    if value is None and fund_data is not None:
+        value, page, bbox = _clean_value(getattr(fund_data, key, None)), None, None
+    if value is None:
+        return None
+    return FieldAnswer(key, route.label, value, page, bbox)
+
+
+def route_question(document, question: str, query_vector=None, embed_query=None, model: str = '') -> RoutedAnswer | None:
+    """
+    Answer `question` from the structured data of `document` when the router is
+    confident; None means "take the RAG path". `embed_query` enables the
+    embedding classifier for questions no trigger phrase matches.
+    """
+    start = time.perf_counter()
+    if not is_lookup_question(question):
+        return None
+
+    method = 'keyword'
+    keys = match_fields(question)
+    if not keys and embed_query is not None:
+        try:
+            if query_vector is None:
+                query_vector = embed_query(question)
+            keys = embedding_match(query_vector, embed_query, model)
+            method = 'embedding'
+        except Exception as e:
+            logger.warning(f"Field router: embedding classifier failed: {e}")
+            keys = []
+    if not keys or len(keys) > MAX_ROUTED_FIELDS:
+        return None
+
+    fund_data = ExtractedFundData.objects.filter(document_id=document.id).first()
+    answers = [field_answer(document, key, fund_data) for key in keys]
+    if any(a is None for a in answers):
+        return None
+    return RoutedAnswer(answers, method, (time.perf_counter() - start) * 1000)
+
+
+def record_router_outcome(counters: dict, outcome: str, elapsed_ms: float = 0.0) -> None:
+    """
+    Count one router outcome in a chat turn's counters (written by
+    chat_counters.flush_counters); routed and generated turns also add their latency.
+    """
+    name = f'field_router.{outcome}'
+    counters[name] = counters.get(name, 0) + 1
+    if outcome in ('routed', 'generated'):
+        name = f'field_router.{outcome}_ms_total'
+        counters[name] = counters.get(name, 0) + elapsed_ms
+
+
+def router_stats(counters: dict) -> dict:
+    """
+    Reported rag_metrics['field_router']: counters per outcome, mean latency of
+    routed and of fully generated turns, and the estimated time saved by routing.
+    """
+    stats = {name: int(counters.get(name, 0)) for name in ROUTER_OUTCOMES}
+    for outcome in ('routed', 'generated'):
+        stats[f'{outcome}_ms_total'] = round(counters.get(f'{outcome}_ms_total', 0.0), 1)
+
+    decisions = stats['routed'] + stats['fallthrough']
+    stats['hit_rate'] = round(stats['routed'] / decisions, 4) if decisions else 0.0
+    routed_ms = stats['routed_ms_total'] / stats['routed'] if stats['routed'] else 0.0
+    generated_ms = stats['generated_ms_total'] / stats['generated'] if stats['generated'] else 0.0
+    stats['routed_ms_avg'] = round(routed_ms, 1)
+    stats['generated_ms_avg'] = round(generated_ms, 1)
+    stats['saved_ms_estimate'] = round(max(generated_ms - routed_ms, 0.0) * stats['routed'], 1)
+    return stats
@@ -0,0 +1,119 @@
+import random
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from api.chunking import iter_markdown_chunks, format_chunk_content
+
+
+def _synthetic_markdown(pages: int, seed: int = 42) -> str:
+    """Prospectus-like markdown: page markers, headers, paragraphs and a fee table."""
+    rng = random.Random(seed)
+    words = (
+        "quỹ đầu tư chứng chỉ nhà đầu tư giá dịch vụ quản lý ngân hàng giám sát tài sản ròng "
+        "danh mục cổ phiếu trái phiếu rủi ro thanh khoản lãi suất phân phối lợi nhuận điều lệ"
+    ).split()
+    parts = []
+    for page in range(1, pages + 1):
+        parts.append(f"\n\n=== PAGE {page} ===\n")
+        if page % 5 == 1:
+            parts.append(f"# CHƯƠNG {page // 5 + 1}\n")
+        parts.append(f"## Mục {page}\n")
+        for _ in range(rng.randint(6, 12)):
+            sentence_count = rng.randint(3, 8)
+            sentences = [
+                " ".join(rng.choice(words) for _ in range(rng.randint(8, 20))).capitalize() + "."
+                for _ in range(sentence_count)
+            ]
+            parts.append(" ".join(sentences) + "\n\n")
+        if page % 7 == 0:
+            parts.append("| Thời gian nắm giữ | Giá dịch vụ mua lại |\n|---|---|\n")
+            parts.append("| Dưới 6 tháng | 1,00% |\n| Từ 6 đến 12 tháng | 0,50% |\n| Trên 12 tháng | 0,00% |\n\n")
+    return "".join(parts)
+
+
+def _legacy_chunks(full_text: str) -> list:
+    """The previous ingest_document chunking step, kept verbatim for comparison."""
+    from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
+
+    page_sections = []
+    current_page = 1
+    current_text = ""
+    for line in full_text.split('\n'):
+        is_page_marker = False
+        if ('--- PAGE ' in line and ' ---' in line) or ('=== PAGE ' in line and ' ===' in line):
+            is_page_marker = True
+            if current_text.strip():
+                page_sections.append((current_page, current_text))
+            try:
+                page_str = line.strip().replace('--- PAGE ', '').replace(' ---', '')
+                page_str = page_str.replace('=== PAGE ', '').replace(' ===', '')
+                current_page = int(page_str)
+                current_text = ""
+            except ValueError:
+                is_page_marker = False
+        if not is_page_marker:
+            current_text += line + '\n'
+    if current_text.strip():
+        page_sections.append((current_page, current_text))
+
+    markdown_splitter = MarkdownHeaderTextSplitter(
+        headers_to_split_on=[("#", "Header 1"), ("##", "Header 2"), ("###", "Header 3")]
+    )
+    all_chunks = []
+    for page_num, page_text in page_sections:
+        docs = markdown_splitter.split_text(page_text)
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=800, chunk_overlap=100, separators=["\n\n", "\n", ".", " ", ""]
+        )
+        for doc in text_splitter.split_documents(docs):
+            doc.metadata['page_number'] = page_num
+            all_chunks.append(doc)
+    return all_chunks
+
+
+def _streaming_chunks(full_text: str) -> list:
+    return [format_chunk_content(c) for c in iter_markdown_chunks(full_text)]
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the streaming markdown chunker against the previous LangChain splitter pipeline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=500, help='Pages of synthetic markdown to generate')
+        parser.add_argument('--file', type=str, default=None, help='Benchmark a real page-marked markdown file instead')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per implementation (best time is reported)')
+
+    def handle(self, *args, **options):
+        if options['file']:
+            with open(options['file'], encoding='utf-8') as f:
+                text = f.read()
+            source = options['file']
+        else:
+            text = _synthetic_markdown(options['pages'])
+            source = f"synthetic, {options['pages']} pages"
+
+        self.stdout.write(f"Input: {source} ({len(text) / 1024:.0f} KiB)")
+
+        for name, fn in (("legacy (split per page)", _legacy_chunks), ("streaming", _streaming_chunks)):
+            best = float('inf')
+            count = 0
+            for _ in range(max(options['repeat'], 1)):
+                start = time.perf_counter()
+                count = len(fn(text))
+                best = min(best, time.perf_counter() - start)
+
+            tracemalloc.start()
+            fn(text)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            self.stdout.write(
+                f"{name:<26} {best * 1000:9.1f} ms  {count:6d} chunks  peak {peak / 1024 / 1024:7.1f} MiB"
+            )
+
+        # Time-to-first-chunk is what the embedding stage waits for.
+        start = time.perf_counter()
+        next(iter_markdown_chunks(text), None)
+        self.stdout.write(f"streaming time to first chunk: {(time.perf_counter() - start) * 1000:.2f} ms")
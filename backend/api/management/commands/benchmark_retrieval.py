@@ -0,0 +1,299 @@
+import hashlib
+import itertools
+import json
+import re
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from api.embeddings import normalize_query_text
+from api.eval_cases import load_test_cases
+from api.models import Document, DocumentChunk, QueryEmbeddingCache
+from api.text_normalize import remove_vietnamese_diacritics
+from api.vector_store import (
+    VECTOR_STORAGE_MODES,
+    keyword_search,
+    plan_search,
+    reciprocal_rank_fusion,
+    search_chunks,
+    vector_storage_mode,
+)
+
+# Codes, numbers and words ("1,2%", "14h45", "T-1" stay one term)
+_TERM_RE = re.compile(r"\w+(?:[.,/:-]\w+)*%?")
+# Accent-folded words too common to count as a fact of a ground truth
+_STOPWORDS = frozenset(
+    "cua va la cac cho voi trong duoc khong nhung mot nay tai theo tu den ve hoac neu khi nhu thi "
+    "da se bi boi con nao moi tren duoi sau truoc hon nhat cung rang vao ra lai tong gia "
+    "the and for with from that this are not".split()
+)
+
+
+class _Rollback(Exception):
+    pass
+
+
+def text_terms(text: str) -> set[str]:
+    return {term.rstrip('%') for term in _TERM_RE.findall(remove_vietnamese_diacritics(text))}
+
+
+def fact_terms(ground_truth: str) -> set[str]:
+    """Numbers and content words of a ground truth: what a useful context must contain."""
+    return {
+        term for term in text_terms(ground_truth)
+        if any(c.isdigit() for c in term) or (len(term) >= 3 and term not in _STOPWORDS)
+    }
+
+
+def lexical_recall(facts: set[str], contexts: list[str]) -> tuple[float, float]:
+    """(share of fact terms, share of numeric fact terms) found in the retrieved contexts."""
+    if not facts:
+        return 1.0, 1.0
+    found = set().union(*(text_terms(c) for c in contexts)) if contexts else set()
+    numbers = {t for t in facts if any(c.isdigit() for c in t)}
+    recall = len(facts & found) / len(facts)
+    numeric = len(numbers & found) / len(numbers) if numbers else recall
+    return recall, numeric
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Command(BaseCommand):
+    help = (
+        'Retrieval-only benchmark over the evaluation questions: lexical context recall (share of the ground '
+        'truth\'s numbers and words present in the retrieved chunks) and p50/p95 search latency for each '
+        'combination of k, vector/hybrid retrieval, search strategy, ef_search and storage mode. '
+        'Needs no LLM; query vectors come from the query embedding cache.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents', type=int, nargs='+', required=True, help='Ingested documents to search')
+        parser.add_argument('--cases', default=None, help='JSON/JSONL test cases (default: the TCSME questions)')
+        parser.add_argument('--csv', default=None,
+                            help='Read question/ground_truth from a RAGAS CSV (e.g. ragas_dataset.csv) instead')
+        parser.add_argument('--k', type=int, nargs='+', default=[5, 10, 15, 25])
+        parser.add_argument('--modes', nargs='+', choices=('vector', 'hybrid'), default=['vector', 'hybrid'])
+        parser.add_argument('--strategies', nargs='+', choices=('exact', 'hnsw'), default=['exact', 'hnsw'])
+        parser.add_argument('--ef-search', type=int, nargs='+', default=[40, 100], help='HNSW ef_search values (raised to the rows a search fetches when lower)')
+        parser.add_argument('--storage', nargs='+', choices=VECTOR_STORAGE_MODES, default=None,
+                            help='Vector storage modes (default: RAG_VECTOR_STORAGE)')
+        parser.add_argument('--hybrid-candidates', type=int, default=30, help='Rows per ranking before fusion')
+        parser.add_argument('--index-params', nargs='*', default=[], metavar='M:EF_CONSTRUCTION',
+                            help='Also rebuild chunk_embedding_idx with these HNSW parameters inside a '
+                                 'rolled-back transaction (locks the table; fixture databases only)')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs per question and configuration')
+        parser.add_argument('--hit-threshold', type=float, default=0.5,
+                            help='Context recall at which a question counts as answered by the retrieved chunks')
+        parser.add_argument('--embed-missing', action='store_true',
+                            help='Embed questions missing from the query cache with the configured backend '
+                                 '(default: skip them, no network access)')
+        parser.add_argument('--output', default=None, help='Also write per-configuration results as JSON')
+
+    def handle(self, *args, **options):
+        cases = self._load_cases(options)
+        documents = {
+            d.id: d for d in Document.objects.filter(id__in=options['documents']).only('id', 'rag_embedding_model')
+        }
+        missing = sorted(set(options['documents']) - set(documents))
+        if missing:
+            raise CommandError(f"Unknown documents: {missing}")
+
+        questions = self._prepare_questions(cases, documents, options)
+        if not questions:
+            raise CommandError("No question has a cached query embedding; run with --embed-missing once")
+
+        configs = self._configs(options)
+        results = []
+        variants = [None] + [self._parse_index_params(p) for p in options['index_params']]
+        for variant in variants:
+            if variant is None:
+                results += self._run(questions, configs, options, index_label='current index')
+                continue
+            try:
+                with transaction.atomic():
+                    label = self._rebuild_index(*variant)
+                    results += self._run(questions, configs, options, index_label=label)
+                    raise _Rollback()
+            except _Rollback:
+                self.stdout.write(f"Index {variant} rolled back.")
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+    # --- inputs ---------------------------------------------------------------------
+
+    @staticmethod
+    def _load_cases(options) -> list[dict]:
+        """Test cases with a ground truth; without one there is nothing to measure recall against."""
+        if options['csv']:
+            import pandas as pd
+
+            df = pd.read_csv(options['csv'], dtype=str).fillna('')
+            if 'ground_truth' not in df.columns:
+                raise CommandError(f"{options['csv']} has no ground_truth column")
+            cases = [
+                {
+                    'id': f"csv-{i}",
+                    'question': str(row['question']).strip(),
+                    'ground_truth': str(row['ground_truth']).strip(),
+                }
+                for i, row in df.iterrows()
+            ]
+        else:
+            cases = load_test_cases(options['cases'])
+        return [case for case in cases if case['question'] and str(case.get('ground_truth') or '').strip()]
+
+    def _prepare_questions(self, cases: list[dict], documents: dict, options) -> list[dict]:
+        """Cases with their fact terms, query vector and the recall ceiling of each document."""
+        embedder = None
+        questions = []
+        skipped = 0
+        for document in documents.values():
+            model = document.rag_embedding_model
+            all_chunks = list(DocumentChunk.objects.filter(document_id=document.id).values_list('content', flat=True))
+            if not all_chunks:
+                raise CommandError(f"Document {document.id} has no chunks; ingest it first")
+            for case in cases:
+                if case.get('document_id') not in (None, document.id):
+                    continue
+                vector = self._cached_vector(case['question'], model)
+                if vector is None and options['embed_missing']:
+                    if embedder is None:
+                        from api.services import RAGService
+
+                        embedder = RAGService().query_embedder
+                    vector = embedder.embed_query(case['question'])
+                if vector is None:
+                    skipped += 1
+                    continue
+                facts = fact_terms(case.get('ground_truth') or '')
+                if not facts:
+                    # lexical_recall() scores an empty fact set as 1.0, which would inflate every setting.
+                    skipped += 1
+                    continue
+                questions.append({
+                    'document_id': document.id,
+                    'case_id': case['id'],
+                    'question': case['question'],
+                    'facts': facts,
+                    'vector': vector,
+                    # Facts the OCR text does not contain cannot be retrieved by any setting.
+                    'ceiling': lexical_recall(facts, all_chunks)[0],
+                })
+        self.stdout.write(
+            f"{len(questions)} questions over {len(documents)} documents"
+            + (f" ({skipped} skipped: no cached query embedding or no fact terms)" if skipped else "")
+        )
+        return questions
+
+    @staticmethod
+    def _cached_vector(question: str, model: str):
+        """Query vector from QueryEmbeddingCache (same key as CachedQueryEmbedder), ignoring its TTL."""
+        query_hash = hashlib.sha256(normalize_query_text(question).encode('utf-8')).hexdigest()
+        queryset = QueryEmbeddingCache.objects.filter(query_hash=query_hash)
+        if model:
+            queryset = queryset.filter(embedding_model=model)
+        vector = queryset.values_list('embedding', flat=True).first()
+        return [float(x) for x in vector] if vector is not None else None
+
+    @staticmethod
+    def _configs(options) -> list[dict]:
+        storages = options['storage'] or [vector_storage_mode()]
+        configs = []
+        for k, mode, strategy, storage in itertools.product(
+            options['k'], options['modes'], options['strategies'], storages
+        ):
+            if strategy == 'exact':
+                # Exact search always scans the full vectors.
+                if storage == storages[0]:
+                    configs.append({'k': k, 'mode': mode, 'strategy': 'exact', 'ef_search': None, 'storage': 'full'})
+                continue
+            for ef_search in options['ef_search']:
+                configs.append({'k': k, 'mode': mode, 'strategy': 'hnsw', 'ef_search': ef_search, 'storage': storage})
+        return configs
+
+    @staticmethod
+    def _parse_index_params(spec: str) -> tuple[int, int]:
+        try:
+            m, ef_construction = (int(x) for x in spec.split(':'))
+        except ValueError:
+            raise CommandError(f"Invalid --index-params {spec!r}; use M:EF_CONSTRUCTION, e.g. 16:64")
+        return m, ef_construction
+
+    def _rebuild_index(self, m: int, ef_construction: int) -> str:
+        start = time.perf_counter()
+        with connection.cursor() as cursor:
+            cursor.execute("DROP INDEX IF EXISTS chunk_embedding_idx")
+            cursor.execute(
+                "CREATE INDEX chunk_embedding_idx ON api_documentchunk "
+                "USING hnsw (embedding vector_cosine_ops) WITH (m = %s, ef_construction = %s)",
+                [m, ef_construction],
+            )
+        label = f"hnsw m={m} ef_construction={ef_construction}"
+        self.stdout.write(f"\nBuilt {label} in {time.perf_counter() - start:.1f} s")
+        return label
+
+    # --- benchmark ------------------------------------------------------------------
+
+    def _retrieve(self, queryset, question: dict, config: dict) -> list:
+        k = config['k']
+        # Hybrid fetches --hybrid-candidates vector rows; the plan (ef_search, re-rank pool) is sized for those.
+        rows = k if config['mode'] == 'vector' else max(self._hybrid_candidates, k)
+        plan = plan_search(
+            queryset, rows, strategy=config['strategy'], mode=config['storage'], ef_search=config['ef_search'],
+        )
+        chunks, _ = search_chunks(queryset, question['vector'], limit=rows, mode=config['storage'], plan=plan)
+        if config['mode'] == 'vector':
+            return chunks
+        keyword_chunks, _ = keyword_search(queryset, question['question'], rows)
+        return reciprocal_rank_fusion([chunks, keyword_chunks], limit=k)
+
+    def _run(self, questions: list[dict], configs: list[dict], options, index_label: str) -> list[dict]:
+        self._hybrid_candidates = options['hybrid_candidates']
+        ceiling = statistics.mean(q['ceiling'] for q in questions)
+        self.stdout.write(f"\n{index_label}: {len(questions)} questions, lexical recall ceiling {ceiling:.3f}")
+        self.stdout.write(
+            f"{'k':>3} {'mode':<7} {'strategy':<8} {'ef':>4} {'storage':<8} "
+            f"{'recall':>7} {'numeric':>8} {'hit':>6} {'p50 ms':>8} {'p95 ms':>8}"
+        )
+
+        results = []
+        for config in configs:
+            recalls, numerics, hits, latencies = [], [], [], []
+            for question in questions:
+                queryset = DocumentChunk.objects.filter(document_id=question['document_id'])
+                chunks = []
+                for _ in range(max(options['repeat'], 1)):
+                    start = time.perf_counter()
+                    chunks = self._retrieve(queryset, question, config)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                recall, numeric = lexical_recall(question['facts'], [c.content for c in chunks])
+                recalls.append(recall)
+                numerics.append(numeric)
+                hits.append(recall >= options['hit_threshold'])
+
+            row = {
+                **config,
+                'index': index_label,
+                'questions': len(questions),
+                'context_recall': round(statistics.mean(recalls), 4),
+                'numeric_recall': round(statistics.mean(numerics), 4),
+                'hit_rate': round(sum(hits) / len(hits), 4),
+                'recall_ceiling': round(ceiling, 4),
+                'p50_ms': round(statistics.median(latencies), 2),
+                'p95_ms': round(_percentile(latencies, 0.95), 2),
+            }
+            results.append(row)
+            self.stdout.write(
+                f"{config['k']:>3} {config['mode']:<7} {config['strategy']:<8} {config['ef_search'] or '-':>4} "
+                f"{config['storage']:<8} {row['context_recall']:7.3f} {row['numeric_recall']:8.3f} "
+                f"{row['hit_rate']:6.2f} {row['p50_ms']:8.1f} {row['p95_ms']:8.1f}"
+            )
+        return results
@@ -0,0 +1,158 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from api.embeddings import EMBEDDING_DIMENSIONS
+from api.models import Document, DocumentChunk
+from api.vector_store import SearchPlan, copy_supported, copy_document_chunks, plan_search, search_chunks
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks per-document vector search on a large synthetic corpus (default 10k documents): '
+        'plain HNSW vs tuned HNSW vs exact scan vs the auto planner. Everything is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents', type=int, default=10000, help='Synthetic documents to create')
+        parser.add_argument('--chunks-per-document', type=int, default=20)
+        parser.add_argument('--large-documents', type=int, default=5, help='Documents with --large-chunks chunks')
+        parser.add_argument('--large-chunks', type=int, default=6000)
+        parser.add_argument('--topics', type=int, default=50,
+                            help='Shared topic centres; similar sections across prospectuses make filtering hard')
+        parser.add_argument('--queries', type=int, default=40, help='Queries per document size class')
+        parser.add_argument('--k', type=int, default=25)
+        parser.add_argument('--seed', type=int, default=11)
+        parser.add_argument('--keep', action='store_true', help='Commit the synthetic corpus instead of rolling back')
+
+    def handle(self, *args, **options):
+        import numpy as np
+
+        rng = np.random.default_rng(options['seed'])
+        topics = rng.normal(size=(options['topics'], EMBEDDING_DIMENSIONS)).astype(np.float32)
+        self._rng = rng
+        self._topics = topics
+
+        try:
+            with transaction.atomic():
+                small_ids, large_ids = self._build_corpus(options)
+                with connection.cursor() as cursor:
+                    cursor.execute("ANALYZE api_documentchunk")
+                self._run(small_ids, large_ids, options)
+                if not options['keep']:
+                    raise _Rollback()
+        except _Rollback:
+            self.stdout.write("Synthetic corpus rolled back.")
+
+    # --- corpus ---------------------------------------------------------------------
+
+    def _vectors(self, count: int):
+        import numpy as np
+
+        topic_ids = self._rng.integers(0, len(self._topics), size=count)
+        offset = self._rng.normal(scale=0.3, size=(1, EMBEDDING_DIMENSIONS)).astype(np.float32)
+        vectors = self._topics[topic_ids] + offset + self._rng.normal(scale=0.5, size=(count, EMBEDDING_DIMENSIONS))
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors.astype(np.float32)
+
+    def _build_corpus(self, options):
+        start = time.perf_counter()
+        total = options['documents']
+        large = min(options['large_documents'], total)
+        now = timezone.now()
+        documents = Document.objects.bulk_create(
+            [
+                Document(
+                    file='benchmark/synthetic.pdf',
+                    file_name=f'benchmark-{i}.pdf',
+                    status='completed',
+                    rag_status='completed',
+                    rag_completed_at=now,
+                )
+                for i in range(total)
+            ],
+            batch_size=1000,
+        )
+        use_copy = copy_supported()
+        pending = []
+        inserted = 0
+        for index, document in enumerate(documents):
+            count = options['large_chunks'] if index < large else options['chunks_per_document']
+            for page, vector in enumerate(self._vectors(count), start=1):
+                pending.append(DocumentChunk(
+                    document_id=document.id,
+                    content=f'synthetic chunk {page} of document {document.id}',
+                    page_number=page,
+                    embedding=vector.tolist(),
+                ))
+            if len(pending) >= 5000 or index == len(documents) - 1:
+                if use_copy:
+                    copy_document_chunks(pending)
+                else:
+                    DocumentChunk.objects.bulk_create(pending, batch_size=1000)
+                inserted += len(pending)
+                pending = []
+                if (index + 1) % 1000 == 0 or index == len(documents) - 1:
+                    self.stdout.write(f"  {index + 1}/{total} documents, {inserted} chunks")
+
+        self.stdout.write(
+            f"Synthetic corpus: {total} documents ({large} with {options['large_chunks']} chunks), "
+            f"{inserted} chunks in {time.perf_counter() - start:.0f} s"
+        )
+        ids = [d.id for d in documents]
+        return ids[large:], ids[:large]
+
+    # --- benchmark ------------------------------------------------------------------
+
+    def _run(self, small_ids, large_ids, options):
+        k = options['k']
+        sample = random.Random(options['seed'])
+        classes = [
+            ('small', sample.sample(small_ids, min(options['queries'], len(small_ids)))),
+            ('large', [sample.choice(large_ids) for _ in range(options['queries'])] if large_ids else []),
+        ]
+        strategies = {
+            # pgvector defaults: ef_search=40, no iterative scan
+            'hnsw default': lambda qs: SearchPlan('hnsw', ef_search=40, iterative_scan='off'),
+            'hnsw tuned': lambda qs: plan_search(qs, k, strategy='hnsw'),
+            'exact': lambda qs: SearchPlan('exact'),
+            'auto': lambda qs: plan_search(qs, k, strategy='auto'),
+        }
+
+        self.stdout.write(f"{'docs':<6} {'strategy':<13} {'p50 ms':>8} {'p95 ms':>8} {'recall@k':>9} {'rows/k':>7}")
+        for label, document_ids in classes:
+            if not document_ids:
+                continue
+            cases = []
+            for document_id in document_ids:
+                queryset = DocumentChunk.objects.filter(document_id=document_id)
+                vector = sample.choice(list(queryset.values_list('embedding', flat=True)[:50]))
+                query = [float(x) + sample.gauss(0, 0.02) for x in vector]
+                truth, _ = search_chunks(queryset, query, limit=k, mode='full', plan=SearchPlan('exact'))
+                cases.append((queryset, query, {c.id for c in truth}))
+
+            for name, make_plan in strategies.items():
+                latencies, recalls, returned = [], [], []
+                for queryset, query, expected in cases:
+                    start = time.perf_counter()
+                    plan = make_plan(queryset)
+                    found, _ = search_chunks(queryset, query, limit=k, plan=plan)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    ids = {c.id for c in found}
+                    recalls.append(len(expected & ids) / max(len(expected), 1))
+                    returned.append(len(found) / k)
+
+                latencies.sort()
+                p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+                self.stdout.write(
+                    f"{label:<6} {name:<13} {statistics.median(latencies):8.1f} {p95:8.1f} "
+                    f"{statistics.mean(recalls):9.3f} {statistics.mean(returned):7.2f}"
+                )
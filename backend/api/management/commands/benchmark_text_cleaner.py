@@ -0,0 +1,53 @@
+import random
+import re
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.text_cleaning import collapse_repeated_phrases
+
+LEGACY_PATTERN = re.compile(r'(.{10,})\1+')
+
+
+def _pathological_inputs(size: int, seed: int = 7) -> dict[str, str]:
+    rng = random.Random(seed)
+    loop = "sở hữu của một Quỹ đầu tư chứng khoán "
+    return {
+        # Low-entropy lines force the regex to try every group length at every position.
+        "low-entropy line": "".join(rng.choice("ab ") for _ in range(size)),
+        "near-repeats": ("Phí quản lý tối đa 1,2% NAV/năm " + "x") * (size // 33),
+        "ocr loop": "Mở đầu. " + loop * (size // len(loop)) + " Kết thúc.",
+        "table rules": "\n".join("|---|---|---|---|" for _ in range(size // 18)),
+        "prose": " ".join(
+            rng.choice(["quỹ", "đầu", "tư", "chứng", "khoán", "rủi", "ro", "thanh", "khoản", "lãi", "suất"])
+            for _ in range(size // 5)
+        ),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the repeated-phrase cleaner against the previous backtracking regex'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[2_000, 8_000, 32_000, 1_000_000],
+                            help='Input sizes in characters')
+        parser.add_argument('--max-period', type=int, default=400, help='Longest phrase considered')
+        parser.add_argument('--regex-max-chars', type=int, default=32_000,
+                            help='Skip the legacy regex above this size (it can run for minutes)')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'input':<18} {'chars':>9} {'new (ms)':>10} {'regex (ms)':>11} {'out chars':>10}")
+        for size in options['sizes']:
+            for name, text in _pathological_inputs(size).items():
+                start = time.perf_counter()
+                cleaned = collapse_repeated_phrases(text, max_period=options['max_period'])
+                new_ms = (time.perf_counter() - start) * 1000
+
+                if len(text) <= options['regex_max_chars']:
+                    start = time.perf_counter()
+                    LEGACY_PATTERN.sub(r'\1', text)
+                    regex_ms = f"{(time.perf_counter() - start) * 1000:11.1f}"
+                else:
+                    regex_ms = f"{'skipped':>11}"
+
+                self.stdout.write(f"{name:<18} {len(text):9d} {new_ms:10.1f} {regex_ms} {len(cleaned):10d}")
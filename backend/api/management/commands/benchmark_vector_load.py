@@ -0,0 +1,74 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.models import Document, DocumentChunk
+from api.vector_store import copy_document_chunks, copy_supported
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _make_chunks(document, rows: int, dim: int, seed: int) -> list[DocumentChunk]:
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((rows, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    text_rng = random.Random(seed)
+    words = "quỹ đầu tư chứng chỉ giá dịch vụ quản lý ngân hàng giám sát tài sản ròng rủi ro".split()
+    return [
+        DocumentChunk(
+            document=document,
+            content=" ".join(text_rng.choice(words) for _ in range(120)),
+            page_number=i // 8 + 1,
+            content_hash=f"{i:064x}",
+            embedding=vectors[i],
+        )
+        for i in range(rows)
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Compares DocumentChunk insert throughput: bulk_create vs binary COPY (changes are rolled back)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5000, help='Chunks to insert per method')
+        parser.add_argument('--batch-size', type=int, default=500, help='bulk_create batch size')
+        parser.add_argument('--dim', type=int, default=1024, help='Embedding dimensions (must match the column)')
+
+    def handle(self, *args, **options):
+        if not copy_supported():
+            raise CommandError("Binary COPY needs PostgreSQL with psycopg 3")
+
+        rows = options['rows']
+        results = {}
+        try:
+            with transaction.atomic():
+                document = Document.objects.create(file_name='benchmark_vector_load.pdf', file='benchmark.pdf')
+
+                chunks = _make_chunks(document, rows, options['dim'], seed=1)
+                start = time.perf_counter()
+                DocumentChunk.objects.bulk_create(chunks, batch_size=options['batch_size'])
+                results['bulk_create'] = time.perf_counter() - start
+
+                chunks = _make_chunks(document, rows, options['dim'], seed=2)
+                start = time.perf_counter()
+                copy_document_chunks(chunks)
+                results['COPY (binary)'] = time.perf_counter() - start
+
+                stored = DocumentChunk.objects.filter(document=document).count()
+                if stored != 2 * rows:
+                    raise CommandError(f"Expected {2 * rows} rows, found {stored}")
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+        self.stdout.write(f"{rows} rows x {options['dim']} dims (HNSW index maintained, rolled back)")
+        for name, seconds in results.items():
+            self.stdout.write(f"{name:<15} {seconds:8.2f} s  {rows / seconds:10.0f} rows/s")
+        if len(results) == 2:
+            self.stdout.write(f"speed-up: {results['bulk_create'] / results['COPY (binary)']:.1f}x")
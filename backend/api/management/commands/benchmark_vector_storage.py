@@ -0,0 +1,98 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from pgvector.django import CosineDistance
+
+from api.models import DocumentChunk
+from api.vector_store import VECTOR_STORAGE_MODES, nearest_chunks
+
+INDEXES = {
+    'full': 'chunk_embedding_idx',
+    'halfvec': 'chunk_embedding_halfvec_idx',
+    'binary': 'chunk_embedding_bit_idx',
+}
+
+
+def _exact_top_k(queryset, query_vector, k: int) -> list[int]:
+    """Ground truth: sequential scan with exact cosine distance (indexes disabled)."""
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SET LOCAL enable_indexscan = off")
+        cursor.execute("SET LOCAL enable_bitmapscan = off")
+        return list(
+            queryset.annotate(distance=CosineDistance('embedding', query_vector))
+            .order_by('distance')
+            .values_list('id', flat=True)[:k]
+        )
+
+
+def _index_size(name: str) -> int | None:
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_relation_size(to_regclass(%s))", [name])
+        row = cursor.fetchone()
+    return row[0] if row and row[0] is not None else None
+
+
+class Command(BaseCommand):
+    help = 'Compares index size, query latency and recall@k of the full, halfvec and binary-quantized vector indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=50, help='Number of sample queries')
+        parser.add_argument('--k', type=int, default=25, help='Neighbours per query (chat uses 25)')
+        parser.add_argument('--document', type=int, default=None, help='Search within one document (default: all chunks)')
+        parser.add_argument('--rerank-factor', type=int, default=None, help='Candidates per result for quantized modes')
+        parser.add_argument('--noise', type=float, default=0.02, help='Gaussian noise added to sampled chunk vectors')
+        parser.add_argument('--seed', type=int, default=7)
+
+    def handle(self, *args, **options):
+        import numpy as np
+
+        queryset = DocumentChunk.objects.all()
+        if options['document']:
+            queryset = queryset.filter(document_id=options['document'])
+        total = queryset.count()
+        if total == 0:
+            raise CommandError("No chunks to benchmark; ingest some documents first")
+
+        # Queries: stored chunk vectors plus a little noise (close to real question embeddings,
+        # without calling the embedding API).
+        rng = random.Random(options['seed'])
+        ids = list(queryset.values_list('id', flat=True))
+        sample_ids = rng.sample(ids, min(options['queries'], len(ids)))
+        noise = np.random.default_rng(options['seed'])
+        queries = []
+        for vector in DocumentChunk.objects.filter(id__in=sample_ids).values_list('embedding', flat=True):
+            v = np.asarray(vector, dtype=np.float32)
+            v = v + noise.normal(0, options['noise'], v.shape).astype(np.float32)
+            queries.append((v / np.linalg.norm(v)).tolist())
+
+        k = options['k']
+        truth = [set(_exact_top_k(queryset, q, k)) for q in queries]
+        self.stdout.write(f"{total} chunks, {len(queries)} queries, k={k}")
+        self.stdout.write(f"{'mode':<8} {'index MiB':>10} {'p50 ms':>8} {'p95 ms':>8} {'recall@k':>9}")
+
+        for mode in VECTOR_STORAGE_MODES:
+            size = _index_size(INDEXES[mode])
+            if size is None:
+                self.stdout.write(f"{mode:<8} index {INDEXES[mode]} missing (run migrate)")
+                continue
+
+            latencies = []
+            recalls = []
+            for query, expected in zip(queries, truth):
+                start = time.perf_counter()
+                found = list(
+                    nearest_chunks(queryset, query, limit=k, mode=mode, rerank_factor=options['rerank_factor'])
+                    .values_list('id', flat=True)
+                )
+                latencies.append((time.perf_counter() - start) * 1000)
+                recalls.append(len(expected.intersection(found)) / max(len(expected), 1))
+
+            latencies.sort()
+            p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+            self.stdout.write(
+                f"{mode:<8} {size / 1024 / 1024:10.1f} {statistics.median(latencies):8.1f} {p95:8.1f} "
+                f"{statistics.mean(recalls):9.3f}"
+            )
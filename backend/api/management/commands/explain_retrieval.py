@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.models import DocumentChunk
+from api.vector_store import SEARCH_STRATEGIES, apply_search_plan, nearest_chunks, plan_search, vector_storage_mode
+
+# Index names as they appear in EXPLAIN output
+VECTOR_INDEXES = ('chunk_embedding_idx', 'chunk_embedding_halfvec_idx', 'chunk_embedding_bit_idx')
+
+
+class Command(BaseCommand):
+    help = 'Shows the search plan and PostgreSQL EXPLAIN output of the chat vector search for one document'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--document', type=int, required=True, help='Document to search in')
+        parser.add_argument('--strategy', choices=SEARCH_STRATEGIES, default=None,
+                            help='Override RAG_SEARCH_STRATEGY')
+        parser.add_argument('--k', type=int, default=25, help='Rows requested')
+        parser.add_argument('--chunk', type=int, default=None,
+                            help='Use this chunk\'s stored vector as the query (default: first chunk of the document)')
+        parser.add_argument('--analyze', action='store_true', help='EXPLAIN ANALYZE (runs the query)')
+
+    def handle(self, *args, **options):
+        queryset = DocumentChunk.objects.filter(document_id=options['document'])
+        source = DocumentChunk.objects.filter(id=options['chunk']) if options['chunk'] else queryset.order_by('id')
+        query_vector = source.values_list('embedding', flat=True).first()
+        if query_vector is None:
+            raise CommandError("No chunk to take the query vector from")
+        query_vector = [float(x) for x in query_vector]
+
+        k = options['k']
+        storage = vector_storage_mode()
+        plan = plan_search(queryset, k, strategy=options['strategy'], mode=storage)
+        mode = 'full' if plan.strategy == 'exact' else storage
+        self.stdout.write(f"Plan: {plan.describe()} (storage mode {mode}, k={k})")
+
+        with transaction.atomic():
+            apply_search_plan(plan)
+            search = nearest_chunks(
+                queryset, query_vector, limit=k, mode=mode, rerank_factor=plan.rerank_factor,
+            ).values_list('id', 'distance')
+            explain_options = {'analyze': True, 'buffers': True} if options['analyze'] else {}
+            output = search.explain(**explain_options)
+            rows = list(search)
+
+        self.stdout.write(output)
+        self.stdout.write("")
+        used = [name for name in VECTOR_INDEXES if name in output]
+        self.stdout.write(f"Vector index used: {', '.join(used) if used else 'none (exact scan)'}")
+        self.stdout.write(f"Rows returned: {len(rows)}/{k}")
+        if len(rows) < min(k, queryset.count()):
+            self.stdout.write(self.style.WARNING(
+                "Filtered HNSW search returned fewer rows than requested: raise RAG_HNSW_EF_SEARCH, "
+                "enable hnsw.iterative_scan (pgvector >= 0.8) or use the exact strategy for this document."
+            ))
@@ -0,0 +1,85 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from api.models import EmbeddingCache, QueryEmbeddingCache
+
+CACHES = {
+    'chunks': ('Embedding cache', EmbeddingCache),
+    'queries': ('Query embedding cache', QueryEmbeddingCache),
+}
+
+
+class Command(BaseCommand):
+    help = 'Shows chunk/query embedding cache statistics and evicts stale or excess entries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=None,
+                            help='Delete entries not used for this many days')
+        parser.add_argument('--max-entries', type=int, default=None,
+                            help='Keep only the N most recently used entries (per model)')
+        parser.add_argument('--model', type=str, default=None,
+                            help='Only consider entries for this embedding model')
+        parser.add_argument('--cache', choices=['chunks', 'queries', 'all'], default='all',
+                            help='Which cache to report on / prune')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would be deleted without deleting')
+
+    def handle(self, *args, **options):
+        names = list(CACHES) if options['cache'] == 'all' else [options['cache']]
+        for name in names:
+            label, model = CACHES[name]
+            self._prune(label, model, options)
+
+    def _prune(self, label, model, options):
+        qs = model.objects.all()
+        if options['model']:
+            qs = qs.filter(embedding_model=options['model'])
+
+        self._print_stats(label, qs)
+
+        to_delete_ids: set[int] = set()
+
+        days = options['older_than_days']
+        if days is not None:
+            cutoff = timezone.now() - timedelta(days=days)
+            to_delete_ids.update(qs.filter(last_used_at__lt=cutoff).values_list('id', flat=True))
+
+        max_entries = options['max_entries']
+        if max_entries is not None:
+            for model_name in qs.values_list('embedding_model', flat=True).distinct():
+                stale = (
+                    qs.filter(embedding_model=model_name)
+                    .order_by('-last_used_at', '-id')
+                    .values_list('id', flat=True)[max_entries:]
+                )
+                to_delete_ids.update(stale)
+
+        if days is None and max_entries is None:
+            return
+
+        if options['dry_run']:
+            self.stdout.write(f"Would delete {len(to_delete_ids)} {label.lower()} entries (dry run).")
+            return
+
+        deleted = 0
+        ids = list(to_delete_ids)
+        for i in range(0, len(ids), 5000):
+            deleted += model.objects.filter(id__in=ids[i:i + 5000]).delete()[0]
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} {label.lower()} entries."))
+
+    def _print_stats(self, label, qs):
+        self.stdout.write(f"--- {label} ---")
+        rows = qs.values('embedding_model').annotate(entries=Count('id'), hits=Sum('hit_count')).order_by('embedding_model')
+        if not rows:
+            self.stdout.write("(empty)")
+        for row in rows:
+            entries = row['entries']
+            hits = row['hits'] or 0
+            # Each entry was a miss once; every later reuse counted as a hit.
+            hit_rate = hits / (hits + entries) if entries else 0.0
+            self.stdout.write(
+                f"{row['embedding_model']}: {entries} entries, {hits} hits (lifetime hit rate {hit_rate:.1%})"
+            )
@@ -0,0 +1,329 @@
+import hashlib
+import itertools
+import json
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.utils import timezone
+
+from api.eval_cases import load_test_cases
+from api.models import Document
+from api.services import RAGService
+
+# Short names accepted by --set
+CONFIG_ALIASES = {
+    'k': 'RAG_RETRIEVAL_K',
+    'provider': 'RAG_CHAT_PROVIDER',
+    'chunk_size': 'RAG_CHUNK_SIZE',
+    'chunk_overlap': 'RAG_CHUNK_OVERLAP',
+    'hybrid': 'RAG_HYBRID_SEARCH',
+    'strategy': 'RAG_SEARCH_STRATEGY',
+    'budget': 'RAG_CONTEXT_BUDGET',
+}
+# Settings that change the stored chunks: documents are re-ingested (full) for each value.
+INGESTION_SETTINGS = ('RAG_CHUNK_SIZE', 'RAG_CHUNK_OVERLAP', 'RAG_EMBEDDING_BACKEND')
+
+
+def parse_grid(specs: list[str]) -> list[dict]:
+    """['k=15,25', 'provider=ollama'] -> every combination, as {ENV_NAME: value} dicts."""
+    axes = []
+    for spec in specs or []:
+        name, sep, values = spec.partition('=')
+        if not sep or not values.strip():
+            raise CommandError(f"Invalid --set {spec!r}; use NAME=value1,value2")
+        name = CONFIG_ALIASES.get(name.strip().lower(), name.strip().upper())
+        axes.append([(name, v.strip()) for v in values.split(',') if v.strip()])
+    return [dict(combo) for combo in itertools.product(*axes)] if axes else [{}]
+
+
+def config_id(config: dict) -> str:
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:10]
+
+
+def config_label(config: dict) -> str:
+    return ", ".join(f"{k}={v}" for k, v in sorted(config.items())) or "defaults"
+
+
+@contextmanager
+def environment(overrides: dict):
+    """Environment variables set for the duration of one configuration (RAGService reads them in __init__)."""
+    previous = {name: os.environ.get(name) for name in overrides}
+    os.environ.update(overrides)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs the evaluation questions against one or more documents and settings combinations with bounded '
+        'concurrency. Answers, contexts and retrieval/generation timings are appended to a JSONL results store; '
+        'a re-run skips questions already answered.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents', type=int, nargs='+', required=True, help='Document ids to evaluate')
+        parser.add_argument('--cases', default=None,
+                            help='JSON/JSONL test cases (default: the built-in TCSME questions)')
+        parser.add_argument('--set', dest='grid', action='append', default=[],
+                            help='Setting to vary, NAME=v1,v2 (aliases: ' + ', '.join(CONFIG_ALIASES) + '); '
+                                 'repeat for a grid of every combination')
+        parser.add_argument('--concurrency', type=int, default=4, help='Questions answered at the same time')
+        parser.add_argument('--limit', type=int, default=None, help='Only the first N test cases')
+        parser.add_argument('--output', default='eval_runs/rag_eval.jsonl', help='JSONL results store')
+        parser.add_argument('--retry-errors', action='store_true', help='Re-run questions that failed before')
+        parser.add_argument('--reingest', action='store_true',
+                            help='Allow re-ingesting the documents for chunking settings (rewrites their chunks; '
+                                 'they are re-ingested with the current settings again at the end)')
+        parser.add_argument('--use-answer-cache', action='store_true',
+                            help='Keep the chat answer cache on (off by default so every answer is generated)')
+        parser.add_argument('--export-csv', default=None,
+                            help='Directory for one RAGAS CSV (question, answer, contexts, ground_truth) '
+                                 'per configuration and document')
+
+    def handle(self, *args, **options):
+        documents = list(Document.objects.filter(id__in=options['documents']).values_list('id', flat=True))
+        missing = sorted(set(options['documents']) - set(documents))
+        if missing:
+            raise CommandError(f"Unknown documents: {missing}")
+
+        cases = load_test_cases(options['cases'])
+        if options['limit']:
+            cases = cases[:options['limit']]
+        configs = parse_grid(options['grid'])
+        if not options['reingest'] and any(name in c for c in configs for name in INGESTION_SETTINGS):
+            raise CommandError(f"{', '.join(INGESTION_SETTINGS)} only apply after re-ingestion; pass --reingest")
+
+        output = Path(options['output'])
+        output.parent.mkdir(parents=True, exist_ok=True)
+        done = self._completed(output, options['retry_errors'])
+        self.stdout.write(
+            f"{len(cases)} questions x {len(documents)} documents x {len(configs)} configurations "
+            f"-> {output} ({len(done)} already done)"
+        )
+
+        self._write_lock = threading.Lock()
+        self._reingested: set[int] = set()
+        try:
+            with output.open('a', encoding='utf-8') as store:
+                for config in configs:
+                    self._run_config(config, documents, cases, done, store, options)
+        finally:
+            self._restore_chunks()
+
+        if options['export_csv']:
+            self._export_csv(output, Path(options['export_csv']))
+
+    # --- results store --------------------------------------------------------------
+
+    @staticmethod
+    def _read_store(path: Path) -> list[dict]:
+        if not path.exists():
+            return []
+        records = []
+        with path.open(encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue  # a line cut short by an interrupted run
+        return records
+
+    def _completed(self, path: Path, retry_errors: bool) -> set:
+        keys = set()
+        for record in self._read_store(path):
+            if retry_errors and record.get('error'):
+                continue
+            keys.add((record['config_id'], record['document_id'], record['case_id']))
+        return keys
+
+    def _append(self, store, record: dict) -> None:
+        with self._write_lock:
+            store.write(json.dumps(record, ensure_ascii=False) + "\n")
+            store.flush()
+
+    # --- evaluation -----------------------------------------------------------------
+
+    def _run_config(self, config: dict, documents: list[int], cases: list[dict], done: set, store, options) -> None:
+        cid = config_id(config)
+        overrides = dict(config)
+        if not options['use_answer_cache']:
+            overrides['RAG_ANSWER_CACHE'] = 'false'
+
+        tasks = [
+            (document_id, case)
+            for document_id in documents
+            for case in cases
+            if case.get('document_id') in (None, document_id) and (cid, document_id, case['id']) not in done
+        ]
+        self.stdout.write(f"\n[{cid}] {config_label(config)}: {len(tasks)} questions to run")
+        if not tasks:
+            return
+
+        records = []
+        with environment(overrides):
+            if any(name in config for name in INGESTION_SETTINGS):
+                failed = set()
+                for document_id in sorted({d for d, _ in tasks}):
+                    start = time.perf_counter()
+                    self._reingested.add(document_id)
+                    if RAGService().ingest_document(document_id, incremental=False, resume=False):
+                        self.stdout.write(f"  re-ingested document {document_id} in {time.perf_counter() - start:.0f} s")
+                    else:
+                        failed.add(document_id)
+                        self.stderr.write(f"  re-ingesting document {document_id} failed; its questions are skipped")
+                if failed:
+                    # Answers from stale or partial chunks would be scored under this configuration.
+                    for document_id, case in tasks:
+                        if document_id in failed:
+                            record = self._new_record(cid, config, document_id, case)
+                            record['error'] = 'Re-ingestion failed'
+                            self._append(store, record)
+                            records.append(record)
+                    tasks = [(d, case) for d, case in tasks if d not in failed]
+                    if not tasks:
+                        self._summarize(records)
+                        return
+
+            local = threading.local()
+
+            def answer(document_id: int, case: dict) -> dict:
+                close_old_connections()
+                try:
+                    if not hasattr(local, 'service'):
+                        local.service = RAGService()
+                    return self._answer(local.service, cid, config, document_id, case)
+                except Exception as e:
+                    record = self._new_record(cid, config, document_id, case)
+                    record['error'] = str(e)
+                    return record
+                finally:
+                    close_old_connections()
+
+            with ThreadPoolExecutor(max_workers=max(options['concurrency'], 1)) as pool:
+                futures = [pool.submit(answer, document_id, case) for document_id, case in tasks]
+                for index, future in enumerate(as_completed(futures), start=1):
+                    record = future.result()
+                    self._append(store, record)
+                    records.append(record)
+                    status = f"ERROR {record['error']}" if record['error'] else f"{record['timings'].get('wall_ms', 0):.0f} ms"
+                    self.stdout.write(f"  {index}/{len(tasks)} doc {record['document_id']} {record['case_id']}: {status}")
+
+        self._summarize(records)
+
+    def _restore_chunks(self) -> None:
+        """Re-ingest the documents rewritten for a chunking configuration with the current settings."""
+        for document_id in sorted(self._reingested):
+            self.stdout.write(f"Restoring the chunks of document {document_id} with the current settings...")
+            if not RAGService().ingest_document(document_id, incremental=False, resume=False):
+                self.stderr.write(f"  restoring document {document_id} failed; re-run its RAG ingestion")
+
+    @staticmethod
+    def _new_record(cid: str, config: dict, document_id: int, case: dict) -> dict:
+        return {
+            'run_at': timezone.now().isoformat(),
+            'config_id': cid,
+            'config': config,
+            'document_id': document_id,
+            'case_id': case['id'],
+            'question': case['question'],
+            'ground_truth': case.get('ground_truth', ''),
+            'answer': '',
+            'contexts': [],
+            'sources': [],
+            'routed': None,
+            'cached': None,
+            'timings': {},
+            'error': None,
+        }
+
+    def _answer(self, service: RAGService, cid: str, config: dict, document_id: int, case: dict) -> dict:
+        record = self._new_record(cid, config, document_id, case)
+        start = time.perf_counter()
+        # The streaming path reports retrieval (prepare) and generation time separately.
+        for event, data in service.chat_stream(document_id, case['question'], []):
+            if event == 'done':
+                timings = data.get('timings', {})
+                record.update({
+                    'answer': data.get('text', ''),
+                    'contexts': data.get('contexts', []),
+                    'sources': data.get('sources', []),
+                    'routed': data.get('routed'),
+                    'cached': data.get('cached'),
+                    'timings': {
+                        **timings,
+                        'retrieval_ms': timings.get('prepare_ms', timings.get('total_ms')),
+                    },
+                })
+            elif event == 'error':
+                record['answer'] = data.get('text', '')
+                record['error'] = data.get('error', 'unknown error')
+        record['timings']['wall_ms'] = round((time.perf_counter() - start) * 1000, 1)
+        return record
+
+    def _summarize(self, records: list[dict]) -> None:
+        ok = [r for r in records if not r['error']]
+        self.stdout.write(f"  {len(ok)}/{len(records)} answered, {len(records) - len(ok)} errors")
+        if not ok:
+            return
+        self.stdout.write(f"  {'stage':<16} {'p50 ms':>9} {'p95 ms':>9} {'mean ms':>9}")
+        for name in ('retrieval_ms', 'first_token_ms', 'generation_ms', 'wall_ms'):
+            values = [r['timings'][name] for r in ok if r['timings'].get(name) is not None]
+            if values:
+                self.stdout.write(
+                    f"  {name:<16} {statistics.median(values):9.0f} {_percentile(values, 0.95):9.0f} "
+                    f"{statistics.mean(values):9.0f}"
+                )
+        routed = sum(1 for r in ok if r.get('routed'))
+        if routed:
+            self.stdout.write(f"  answered by the field router: {routed}/{len(ok)}")
+
+    # --- export ---------------------------------------------------------------------
+
+    def _export_csv(self, store: Path, directory: Path) -> None:
+        """Latest answer per question, one RAGAS dataset CSV per configuration and document."""
+        import pandas as pd
+
+        latest = {}
+        for record in self._read_store(store):
+            if record.get('error'):
+                continue
+            latest[(record['config_id'], record['document_id'], record['case_id'])] = record
+
+        groups: dict[tuple, list[dict]] = {}
+        for (cid, document_id, _), record in latest.items():
+            groups.setdefault((cid, document_id), []).append(record)
+
+        directory.mkdir(parents=True, exist_ok=True)
+        for (cid, document_id), records in sorted(groups.items()):
+            df = pd.DataFrame({
+                "question": [r['question'] for r in records],
+                "answer": [r['answer'] for r in records],
+                "contexts": [r['contexts'] for r in records],
+                "ground_truth": [r['ground_truth'] for r in records],
+            })
+            path = directory / f"ragas_{cid}_doc{document_id}.csv"
+            df.to_csv(path, index=False)
+            self.stdout.write(f"Exported {len(records)} rows ({config_label(records[0]['config'])}) to {path}")
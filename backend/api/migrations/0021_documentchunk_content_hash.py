@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_embeddingcache_document_rag_metrics'),
+    ]
+
+    operations = [
+        # Existing rows keep an empty hash; it is filled lazily on their next re-ingestion.
+        migrations.AddField(
+            model_name='documentchunk',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='documentchunk',
+            index=models.Index(fields=['document', 'content_hash'], name='chunk_doc_hash_idx'),
+        ),
+    ]
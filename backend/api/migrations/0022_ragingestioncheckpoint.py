@@ -0,0 +1,29 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_documentchunk_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RagIngestionCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(choices=[('extracted', 'Extracted'), ('planned', 'Planned'), ('embedding', 'Embedding'), ('completed', 'Completed')], default='extracted', max_length=20)),
+                ('mode', models.CharField(choices=[('full', 'Full'), ('incremental', 'Incremental')], default='full', max_length=20)),
+                ('text_digest', models.CharField(blank=True, default='', max_length=64)),
+                ('chunk_plan', models.JSONField(blank=True, default=list)),
+                ('total_batches', models.PositiveIntegerField(default=0)),
+                ('completed_batches', models.PositiveIntegerField(default=0)),
+                ('embedded_chunks', models.PositiveIntegerField(default=0)),
+                ('saved_chunks', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('document', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='rag_checkpoint', to='api.document')),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0023_documentchunk_alias_pages'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='rag_pages_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='rag_pages_indexed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+def set_existing_model(apps, schema_editor):
+    # Every document ingested so far used the Mistral API embeddings.
+    Document = apps.get_model('api', 'Document')
+    DocumentChunk = apps.get_model('api', 'DocumentChunk')
+    Document.objects.filter(
+        id__in=DocumentChunk.objects.values('document_id')
+    ).update(rag_embedding_model='mistral-embed-2312')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0024_document_rag_pages'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='rag_embedding_model',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.RunPython(set_existing_model, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction; existing rows are
+    # indexed in place while ingestion/chat keep working.
+    atomic = False
+
+    dependencies = [
+        ('api', '0025_document_rag_embedding_model'),
+    ]
+
+    operations = [
+        # Half-precision HNSW index (RAG_VECTOR_STORAGE=halfvec): ~half the memory of chunk_embedding_idx.
+        migrations.RunSQL(
+            sql=(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS chunk_embedding_halfvec_idx ON api_documentchunk "
+                "USING hnsw ((embedding::halfvec(1024)) halfvec_cosine_ops) "
+                "WITH (m=16, ef_construction=64);"
+            ),
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS chunk_embedding_halfvec_idx;",
+        ),
+        # Binary-quantized HNSW index (RAG_VECTOR_STORAGE=binary): 1 bit per dimension,
+        # candidates are re-ranked by exact cosine distance on the full vectors.
+        migrations.RunSQL(
+            sql=(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS chunk_embedding_bit_idx ON api_documentchunk "
+                "USING hnsw ((binary_quantize(embedding)::bit(1024)) bit_hamming_ops) "
+                "WITH (m=16, ef_construction=64);"
+            ),
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS chunk_embedding_bit_idx;",
+        ),
+    ]
@@ -0,0 +1,30 @@
+import django.utils.timezone
+import pgvector.django.vector
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0026_chunk_quantized_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryEmbeddingCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('query_hash', models.CharField(max_length=64)),
+                ('embedding_model', models.CharField(max_length=100)),
+                ('query_text', models.TextField()),
+                ('embedding', pgvector.django.vector.VectorField(dimensions=1024)),
+                ('hit_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['last_used_at'], name='query_cache_used_idx')],
+                'constraints': [models.UniqueConstraint(fields=('query_hash', 'embedding_model'), name='query_cache_key_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+import django.db.models.deletion
+import django.utils.timezone
+import pgvector.django.vector
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0027_queryembeddingcache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatAnswerCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cache_key', models.CharField(max_length=64)),
+                ('document_version', models.CharField(max_length=64)),
+                ('history_digest', models.CharField(blank=True, default='', max_length=64)),
+                ('query_text', models.TextField()),
+                ('query_embedding', pgvector.django.vector.VectorField(blank=True, dimensions=1024, null=True)),
+                ('answer', models.TextField()),
+                ('contexts', models.JSONField(blank=True, default=list)),
+                ('hit_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answer_cache', to='api.document')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['document', 'document_version'], name='answer_cache_doc_ver_idx')],
+                'constraints': [models.UniqueConstraint(fields=('document', 'cache_key'), name='answer_cache_key_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ChatCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64)),
+                ('value', models.FloatField(default=0.0)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_counters', to='api.document')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('document', 'name'), name='chat_counter_uniq')],
+            },
+        ),
+    ]
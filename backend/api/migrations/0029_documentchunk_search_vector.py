@@ -0,0 +1,47 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import AddIndexConcurrently, UnaccentExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The GIN index is built CONCURRENTLY (no transaction); adding the stored
+    # generated column rewrites api_documentchunk once.
+    atomic = False
+
+    dependencies = [
+        ('api', '0028_chatanswercache'),
+    ]
+
+    operations = [
+        UnaccentExtension(),
+        # PostgreSQL ships no Vietnamese stemmer: `simple` (lower-case, no stop words)
+        # behind `unaccent`, so diacritics and case do not matter for keyword matches.
+        migrations.RunSQL(
+            sql="""
+                DO $$
+                BEGIN
+                    IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = 'vietnamese_unaccent') THEN
+                        CREATE TEXT SEARCH CONFIGURATION vietnamese_unaccent (COPY = simple);
+                        ALTER TEXT SEARCH CONFIGURATION vietnamese_unaccent
+                            ALTER MAPPING FOR hword, hword_part, word WITH unaccent, simple;
+                    END IF;
+                END
+                $$;
+            """,
+            reverse_sql="DROP TEXT SEARCH CONFIGURATION IF EXISTS vietnamese_unaccent;",
+        ),
+        migrations.AddField(
+            model_name='documentchunk',
+            name='search_vector',
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.contrib.postgres.search.SearchVector('content', config='vietnamese_unaccent'),
+                output_field=django.contrib.postgres.search.SearchVectorField(),
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name='documentchunk',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='chunk_search_vector_idx'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0030_document_structured_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='chat_memory',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
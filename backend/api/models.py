@@ -1,16 +1,35 @@
 from django.db import models
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.utils import timezone
 import json
 from pgvector.django import VectorField, HnswIndex
 
+# Text search configuration for chunk keyword search (created in migration 0029):
+# the `simple` parser/dictionary with accents folded by `unaccent`, so "phí", "phi" and "PHÍ" match.
+SEARCH_CONFIG = 'vietnamese_unaccent'
+
 class DocumentChunk(models.Model):
     document = models.ForeignKey('Document', on_delete=models.CASCADE, related_name='chunks')
     content = models.TextField()
     page_number = models.IntegerField()
+    # sha256 of the normalized content; used to diff chunks on re-ingestion
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    # Other pages carrying a near-duplicate of this chunk (not embedded separately)
+    alias_pages = ArrayField(models.IntegerField(), default=list, blank=True)
     embedding = VectorField(dimensions=1024)
+    # Keyword search (hybrid retrieval); computed by Postgres from `content`
+    search_vector = models.GeneratedField(
+        expression=SearchVector('content', config=SEARCH_CONFIG),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     class Meta:
         indexes = [
+            models.Index(fields=['document', 'content_hash'], name='chunk_doc_hash_idx'),
+            GinIndex(fields=['search_vector'], name='chunk_search_vector_idx'),
             # HNSW Index for fast approximate nearest neighbor search
             HnswIndex(
                 name='chunk_embedding_idx',
@@ -69,13 +88,28 @@ class Document(models.Model):
     rag_error_message = models.TextField(blank=True, null=True)
     rag_started_at = models.DateTimeField(null=True, blank=True)
     rag_completed_at = models.DateTimeField(null=True, blank=True)
+
+    # Per-document RAG pipeline metrics (embedding cache hit rate, ...) for the last run
+    rag_metrics = models.JSONField(default=dict, blank=True)
+
+    # Pages with chunks in the current chunk plan / pages whose chunks are committed.
+    # Chat can run before ingestion finishes, over the pages indexed so far.
+    rag_pages_total = models.PositiveIntegerField(default=0)
+    rag_pages_indexed = models.PositiveIntegerField(default=0)
+    # Embedding model/backend the document's chunks were embedded with (see api/embeddings.py)
+    rag_embedding_model = models.CharField(max_length=200, blank=True, default='')
     
     # Extracted data (stored as JSON)
     extracted_data = models.JSONField(null=True, blank=True)
+    # Rendered structured block of the chat prompt (see api/structured_summary.py) and its digest
+    structured_summary = models.JSONField(default=dict, blank=True)
+    structured_summary_version = models.CharField(max_length=64, blank=True, default='')
 
     # Persisted chat history for the document (list of messages)
     # Stored as JSON so the frontend can restore conversations when reopening.
     chat_history = models.JSONField(default=list, blank=True)
+    # Rolling summary of older chat turns (see api/conversation_memory.py)
+    chat_memory = models.JSONField(default=dict, blank=True)
     
     # Optimized PDF file (containing only relevant pages)
     optimized_file = models.FileField(upload_to='optimized_documents/%Y/%m/%d/', null=True, blank=True)
@@ -109,6 +143,13 @@ class Document(models.Model):
         """Helper method to set extracted data"""
         self.extracted_data = data
 
+    @property
+    def rag_coverage(self) -> float:
+        """Share of the document's pages that are searchable for chat (0.0-1.0)."""
+        if self.rag_pages_total <= 0:
+            return 1.0 if self.rag_status == 'completed' else 0.0
+        return min(self.rag_pages_indexed / self.rag_pages_total, 1.0)
+
 
 class ExtractedFundData(models.Model):
     """
@@ -221,3 +262,145 @@ class DocumentChangeLog(models.Model):
     
     def __str__(self):
         return f"Change for {self.document.file_name} at {self.changed_at}"
+
+
+class EmbeddingCache(models.Model):
+    """
+    Embeddings keyed by (sha256 of normalized chunk text, embedding model).
+    Consulted before calling the embeddings API so unchanged text is never re-embedded.
+    """
+    text_hash = models.CharField(max_length=64)
+    embedding_model = models.CharField(max_length=100)
+    embedding = VectorField(dimensions=1024)
+    hit_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['text_hash', 'embedding_model'], name='embedding_cache_key_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['last_used_at'], name='embedding_cache_used_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.embedding_model}:{self.text_hash[:12]}"
+
+
+class QueryEmbeddingCache(models.Model):
+    """
+    Chat query embeddings keyed by (sha256 of the normalized query, embedding model).
+    Repeated questions skip the embeddings call; entries expire after RAG_QUERY_CACHE_TTL_DAYS.
+    """
+    query_hash = models.CharField(max_length=64)
+    embedding_model = models.CharField(max_length=100)
+    # Normalized query, kept for inspection / pruning reports
+    query_text = models.TextField()
+    embedding = VectorField(dimensions=1024)
+    hit_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['query_hash', 'embedding_model'], name='query_cache_key_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['last_used_at'], name='query_cache_used_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.embedding_model}:{self.query_text[:40]}"
+
+
+class ChatAnswerCache(models.Model):
+    """
+    Chat answers keyed by (document, document version, normalized query, history digest).
+
+    `document_version` changes whenever extracted_data, the ingested chunks or the
+    chat model change, so stale answers are never served; rows for old versions
+    are also deleted on edits and re-ingestion.
+    """
+    document = models.ForeignKey('Document', on_delete=models.CASCADE, related_name='answer_cache')
+    cache_key = models.CharField(max_length=64)
+    document_version = models.CharField(max_length=64)
+    history_digest = models.CharField(max_length=64, blank=True, default='')
+    query_text = models.TextField()
+    # Query vector for optional paraphrase matching (RAG_ANSWER_CACHE_SEMANTIC_THRESHOLD)
+    query_embedding = VectorField(dimensions=1024, null=True, blank=True)
+    answer = models.TextField()
+    contexts = models.JSONField(default=list, blank=True)
+    hit_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['document', 'cache_key'], name='answer_cache_key_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['document', 'document_version'], name='answer_cache_doc_ver_idx'),
+        ]
+
+    def __str__(self):
+        return f"Doc {self.document_id}: {self.query_text[:40]}"
+
+
+class ChatCounter(models.Model):
+    """
+    One chat counter of a document, e.g. `answer_cache.hits`.
+
+    Incremented with `value = value + n` (api/chat_counters.py), so chat turns never
+    lock the Document row that ingestion updates.
+    """
+    document = models.ForeignKey('Document', on_delete=models.CASCADE, related_name='chat_counters')
+    name = models.CharField(max_length=64)
+    value = models.FloatField(default=0.0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['document', 'name'], name='chat_counter_uniq'),
+        ]
+
+    def __str__(self):
+        return f"Doc {self.document_id}: {self.name}={self.value}"
+
+
+class RagIngestionCheckpoint(models.Model):
+    """
+    Resumable state of the last RAG ingestion of a document.
+
+    The chunk plan is rebuilt from the stored markdown (checked against
+    `text_digest`) and records the stable IDs of the chunks saved so far;
+    `embedded_chunks` and `saved_chunks` are prefixes of the list being
+    embedded / the plan, so a failed run can continue from the last completed
+    batch.
+    """
+    STAGE_CHOICES = [
+        ('extracted', 'Extracted'),   # markdown stored in Document.markdown_file
+        ('planned', 'Planned'),       # chunking started
+        ('embedding', 'Embedding'),   # some batches embedded / saved
+        ('completed', 'Completed'),
+    ]
+    MODE_CHOICES = [
+        ('full', 'Full'),
+        ('incremental', 'Incremental'),
+    ]
+
+    document = models.OneToOneField(Document, on_delete=models.CASCADE, related_name='rag_checkpoint')
+    stage = models.CharField(max_length=20, choices=STAGE_CHOICES, default='extracted')
+    mode = models.CharField(max_length=20, choices=MODE_CHOICES, default='full')
+    # sha256 of the cleaned markdown the plan was built from
+    text_digest = models.CharField(max_length=64, blank=True, default='')
+    # Stable IDs of the saved chunks, in plan order
+    chunk_plan = models.JSONField(default=list, blank=True)
+    total_batches = models.PositiveIntegerField(default=0)
+    completed_batches = models.PositiveIntegerField(default=0)
+    embedded_chunks = models.PositiveIntegerField(default=0)
+    saved_chunks = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"RAG checkpoint for {self.document.file_name} ({self.stage})"
@@ -0,0 +1,107 @@
+"""
+Ollama request settings shared by chat, summaries and the startup preload.
+
+Every request carries the same `keep_alive` and `num_ctx`: Ollama reloads a
+model when `num_ctx` changes, and unloads it after `keep_alive` without
+requests (default 5 minutes), which made the first turn after a pause pay
+the model load. Chat prompts are laid out so that the per-document part
+(instructions + structured data) is an identical prefix on every turn and
+Ollama can reuse its KV cache; see RAGService._prepare_chat.
+"""
+import logging
+import os
+import sys
+import threading
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_KEEP_ALIVE = '30m'
+DEFAULT_NUM_CTX = 8192
+DEFAULT_TIMEOUT = 300.0
+CONNECT_TIMEOUT = 10.0
+
+_NS_PER_MS = 1_000_000
+
+
+def ollama_base_url() -> str:
+    return os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434').strip()
+
+
+def ollama_model() -> str:
+    return os.getenv('OLLAMA_MODEL', 'qwen2.5:7b').strip()
+
+
+def keep_alive() -> str:
+    return os.getenv('OLLAMA_KEEP_ALIVE', DEFAULT_KEEP_ALIVE).strip()
+
+
+def request_timeout() -> tuple[float, float]:
+    """(connect, read) timeout; the read timeout covers a cold model load plus a long answer."""
+    return CONNECT_TIMEOUT, float(os.getenv('OLLAMA_TIMEOUT', str(DEFAULT_TIMEOUT)))
+
+
+def model_options(**extra) -> dict:
+    options = {"temperature": 0, "num_ctx": int(os.getenv('OLLAMA_NUM_CTX', str(DEFAULT_NUM_CTX)))}
+    options.update(extra)
+    return options
+
+
+def generation_stats(payload: dict) -> dict:
+    """
+    Milliseconds and token counts from the final response object of
+    /api/chat. `prompt_tokens` counts only prompt tokens evaluated on this
+    turn: a reused (cached) prefix is not evaluated again.
+    """
+    if not payload or 'eval_count' not in payload:
+        return {}
+    eval_ms = payload.get('eval_duration', 0) / _NS_PER_MS
+    eval_count = payload.get('eval_count', 0)
+    return {
+        'load_ms': round(payload.get('load_duration', 0) / _NS_PER_MS, 1),
+        'prompt_eval_ms': round(payload.get('prompt_eval_duration', 0) / _NS_PER_MS, 1),
+        'prompt_tokens': payload.get('prompt_eval_count', 0),
+        'eval_ms': round(eval_ms, 1),
+        'eval_tokens': eval_count,
+        'tokens_per_s': round(eval_count / (eval_ms / 1000), 1) if eval_ms else 0.0,
+        'ollama_total_ms': round(payload.get('total_duration', 0) / _NS_PER_MS, 1),
+    }
+
+
+def preload_model() -> bool:
+    """Load the chat model into memory (an empty /api/generate request) and keep it loaded."""
+    try:
+        response = requests.post(
+            f"{ollama_base_url()}/api/generate",
+            json={"model": ollama_model(), "keep_alive": keep_alive(), "options": model_options()},
+            timeout=request_timeout(),
+        )
+        response.raise_for_status()
+        logger.info(f"Ollama model {ollama_model()} preloaded (keep_alive={keep_alive()})")
+        return True
+    except Exception as e:
+        logger.warning(f"Ollama preload of {ollama_model()} failed: {e}")
+        return False
+
+
+def _runserver_process() -> bool:
+    """True in the `manage.py runserver` process that serves requests (not its autoreloader parent)."""
+    argv = sys.argv or ['']
+    if len(argv) < 2 or argv[1] != 'runserver':
+        return False
+    return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in argv
+
+
+def preload_on_startup(server: bool = False) -> None:
+    """
+    Preload in a background thread when Ollama is the chat provider (OLLAMA_PRELOAD=0 disables).
+    Only serving processes preload: runserver (from AppConfig.ready) and the WSGI/ASGI
+    entrypoints, which pass `server=True`. Other commands, scripts and tests never do.
+    """
+    if os.getenv('RAG_CHAT_PROVIDER', 'ollama').strip().lower() != 'ollama':
+        return
+    raw = os.getenv('OLLAMA_PRELOAD', 'true').strip().lower()
+    if raw in {"0", "false", "no", "off"} or not (server or _runserver_process()):
+        return
+    threading.Thread(target=preload_model, daemon=True).start()
@@ -50,6 +50,17 @@ class ChatResponseSerializer(serializers.Serializer):
     chunks_count = serializers.IntegerField(required=False)
 
 
+class CorpusSearchRequestSerializer(serializers.Serializer):
+    """Serializer for corpus-wide search requests (query string or JSON body)"""
+    q = serializers.CharField(required=True, max_length=1000)
+    fund_type = serializers.CharField(required=False, allow_blank=True, max_length=200)
+    management_company = serializers.CharField(required=False, allow_blank=True, max_length=500)
+    custodian_bank = serializers.CharField(required=False, allow_blank=True, max_length=300)
+    page = serializers.IntegerField(required=False, default=1, min_value=1)
+    page_size = serializers.IntegerField(required=False, default=10, min_value=1, max_value=50)
+    chunks_per_document = serializers.IntegerField(required=False, default=3, min_value=1, max_value=10)
+
+
 class ChatHistorySerializer(serializers.Serializer):
     """Serializer for persisting chat history per document"""
     history = serializers.ListField(required=True, allow_empty=True)
@@ -61,6 +72,7 @@ class DocumentSerializer(serializers.ModelSerializer):
     file_url = serializers.SerializerMethodField()
     optimized_file_url = serializers.SerializerMethodField()
     markdown_file_url = serializers.SerializerMethodField()
+    rag_coverage = serializers.FloatField(read_only=True)
     
     class Meta:
         model = Document
@@ -78,6 +90,11 @@ class DocumentSerializer(serializers.ModelSerializer):
             'rag_error_message',
             'rag_started_at',
             'rag_completed_at',
+            'rag_metrics',
+            'rag_pages_total',
+            'rag_pages_indexed',
+            'rag_coverage',
+            'rag_embedding_model',
             'extracted_data',
             'confidence_score',
             'fund_data',
@@ -101,6 +118,10 @@ class DocumentSerializer(serializers.ModelSerializer):
             'rag_error_message',
             'rag_started_at',
             'rag_completed_at',
+            'rag_metrics',
+            'rag_pages_total',
+            'rag_pages_indexed',
+            'rag_embedding_model',
         ]
     
     def get_file_url(self, obj):
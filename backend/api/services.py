@@ -2,11 +2,17 @@
 Service layer for OCR using Gemini 2.0 Flash
 """
 import os
+import itertools
 import json
+import hashlib
 import logging
 import re
 from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator
 import threading
+from concurrent.futures import ThreadPoolExecutor
+import time
 import unicodedata
 import io
 import requests
@@ -16,11 +22,52 @@ from django.utils import timezone
 import tempfile
 import fitz  # PyMuPDF
 from rapidocr_onnxruntime import RapidOCR
-from .models import Document, ExtractedFundData, DocumentChunk
+from .models import Document, ExtractedFundData, DocumentChunk, RagIngestionCheckpoint
+from .embeddings import (
+    CachedEmbedder,
+    CachedQueryEmbedder,
+    EmbeddingModelMismatch,
+    embedding_text_hash,
+    get_embedding_backend,
+)
+from .chunking import (
+    DEFAULT_CHUNK_OVERLAP,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_NEAR_DUP_THRESHOLD,
+    NearDuplicateFilter,
+    format_chunk_content,
+    iter_markdown_chunks,
+    iter_page_sections,
+)
+from .vector_store import (
+    RetrievalResult,
+    keyword_search,
+    plan_search,
+    reciprocal_rank_fusion,
+    save_document_chunks,
+    search_chunks,
+)
+from .text_cleaning import collapse_repeated_phrases, strip_running_headers_footers
+from .text_normalize import remove_vietnamese_diacritics
+from .context_packer import (
+    DEFAULT_MMR_LAMBDA,
+    DEFAULT_STRUCTURED_SHARE,
+    PackedChunks,
+    StructuredField,
+    context_budget,
+    matching_fields,
+    pack_chunks,
+    pack_structured,
+)
+from . import ollama
+from .structured_summary import load_structured_summary, refresh_structured_summary
+from .answer_cache import AnswerCache, document_answer_version, invalidate_answer_cache, record_answer_cache_outcome
+from .chat_counters import flush_counters
+from .conversation_memory import ConversationMemory, build_memory, refresh_summary_async, rewrite_query
+from .field_router import RoutedAnswer, record_router_outcome, route_question, router_enabled
+from .corpus_search import candidate_count, chunk_document_ids, corpus_queryset, describe_groups, group_by_document
 from django.db.models import F
-from django.db import close_old_connections
-from pgvector.django import CosineDistance
-from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
+from django.db import close_old_connections, transaction
 import PIL.Image
 import PIL.ImageDraw
 logger = logging.getLogger(__name__)
@@ -38,28 +85,6 @@ try:
 except Exception:  # pragma: no cover
     unidecode = None
 
-def remove_vietnamese_diacritics(text: str) -> str:
-    """
-    Remove Vietnamese diacritics and convert to plain ASCII.
-    Used for flexible matching when OCR strips diacritics.
-    
-    Examples:
-        'tên quỹ' → 'ten quy'
-        'công ty quản lý' → 'cong ty quan ly'
-    """
-    # Normalize to NFD (decompose accented chars)
-    text = unicodedata.normalize('NFD', text)
-    # Remove combining marks (diacritics)
-    text = ''.join(c for c in text if not unicodedata.combining(c))
-    # Handle special Vietnamese characters that don't decompose
-    replacements = {
-        'đ': 'd', 'Đ': 'D',
-        'ð': 'd',  # Alternative encoding
-    }
-    for viet_char, ascii_char in replacements.items():
-        text = text.replace(viet_char, ascii_char)
-    return text.lower()
-
 def normalize_text_for_matching(text: str) -> str:
     """
     Normalize text for keyword matching:
@@ -92,6 +117,53 @@ except Exception as e:
     logger.warning(f"Could not initialize RapidOCR with GPU, falling back to CPU: {e}")
     ocr_engine = RapidOCR(lang_list=['en', 'vi'], gpu_id=-1)
 
+# --- TỪ KHÓA QUAN TRỌNG ---
+# Dùng chung cho create_optimized_pdf() (chọn trang) và RAGService (thứ tự lập chỉ mục trang).
+# Lưu dạng có dấu (dễ đọc), nhưng so khớp sẽ dùng normalize_text_for_matching()
+# để chịu được OCR mất dấu / sai khoảng trắng.
+# NOTE: Avoid overly-generic keywords that appear in headers/footers on *every* page
+# (e.g. “công ty quản lý”, “ngân hàng giám sát”), otherwise we keep almost the whole PDF.
+PAGE_KEYWORDS = {
+    "identity": [
+        "tên quỹ",
+        "mã giao dịch",
+        "mã chứng khoán",
+        "mã quỹ",
+        "giấy phép",
+        "giấy phép thành lập",
+    ],
+    "fees": [
+        "biểu phí",
+        "các loại phí",
+        "phí phát hành",
+        "phí quản lý",
+        "phí mua lại",
+        "phí chuyển đổi",
+        "chi phí của quỹ",
+        "phí mua",
+        "phí bán",
+        "phí đăng ký",
+        "giá dịch vụ",
+        "thù lao",
+        "chi phí",
+        "hoa hồng",
+        "tối đa",
+        "% giá trị",
+    ],
+    "tables": [
+        "danh mục đầu tư",
+        "cơ cấu tài sản",
+        "tài sản ròng",
+        "giá trị tài sản ròng",
+        "nav",
+        "biến động nav",
+        "lịch sử chia cổ tức",
+        "phân phối lợi nhuận",
+        "hoạt động đầu tư",
+    ],
+}
+
+
 def create_optimized_pdf(original_pdf_path: str) -> str:
     """
     Hỗ trợ cả PDF dạng Text và PDF dạng Scanned Image.
@@ -112,55 +184,10 @@ def create_optimized_pdf(original_pdf_path: str) -> str:
             logger.info(f"PDF has only {total_pages} pages, returning original")
             return original_pdf_path
 
-        # --- TỪ KHÓA QUAN TRỌNG ---
-        # Lưu dạng có dấu (dễ đọc), nhưng so khớp sẽ dùng normalize_text_for_matching()
-        # để chịu được OCR mất dấu / sai khoảng trắng.
-        # NOTE: Avoid overly-generic keywords that appear in headers/footers on *every* page
-        # (e.g. “công ty quản lý”, “ngân hàng giám sát”), otherwise we keep almost the whole PDF.
-        keywords = {
-            "identity": [
-                "tên quỹ",
-                "mã giao dịch",
-                "mã chứng khoán",
-                "mã quỹ",
-                "giấy phép",
-                "giấy phép thành lập",
-            ],
-            "fees": [
-                "biểu phí",
-                "các loại phí",
-                "phí phát hành",
-                "phí quản lý",
-                "phí mua lại",
-                "phí chuyển đổi",
-                "chi phí của quỹ",
-                "phí mua",
-                "phí bán",
-                "phí đăng ký",
-                "giá dịch vụ",      
-                "thù lao",           
-                "chi phí",           
-                "hoa hồng",          
-                "tối đa",            
-                "% giá trị",        
-            ],
-            "tables": [
-                "danh mục đầu tư",
-                "cơ cấu tài sản",
-                "tài sản ròng",
-                "giá trị tài sản ròng",
-                "nav",
-                "biến động nav",
-                "lịch sử chia cổ tức",
-                "phân phối lợi nhuận",
-                "hoạt động đầu tư",
-            ],
-        }
-        
         # Normalize keywords for matching (remove diacritics + spaces)
         normalized_keywords = {
             category: [normalize_text_for_matching(k) for k in kws]
-            for category, kws in keywords.items()
+            for category, kws in PAGE_KEYWORDS.items()
         }
         
         # Luôn lấy 4 trang đầu (trang bìa, mục lục, thông tin chung)
@@ -2015,6 +2042,12 @@ class DocumentProcessingService:
                         logger.warning(f"Failed to remove temp file: {e}")
 
             document.save(update_fields=['status', 'processed_at', 'extracted_data', 'optimized_file'])
+
+            # Chat reads the rendered structured block from the document row
+            try:
+                refresh_structured_summary(document)
+            except Exception as e:
+                logger.warning(f"Failed to build structured summary for document {document_id}: {e}")
             
             logger.info(f"Successfully processed document {document_id}")
 
@@ -2051,7 +2084,8 @@ class DocumentProcessingService:
 
                         close_old_connections()
                         doc = Document.objects.get(id=doc_id)
-                        if doc.chunks.exists():
+                        unfinished = RagIngestionCheckpoint.objects.filter(document_id=doc_id).exclude(stage='completed')
+                        if doc.chunks.exists() and not unfinished.exists():
                             logger.info(f"Auto RAG: document {doc_id} already ingested; skipping")
                             try:
                                 Document.objects.filter(id=doc_id).update(
@@ -2098,6 +2132,58 @@ class DocumentProcessingService:
                     except OSError as e:
                         logger.warning(f"Error removing temp file: {e}")
 
+def update_rag_metrics(document_id: int, **sections) -> None:
+    """Merge `sections` into Document.rag_metrics (best-effort, never raises)."""
+    try:
+        with transaction.atomic():
+            current = (
+                Document.objects.select_for_update()
+                .values_list('rag_metrics', flat=True)
+                .get(id=document_id)
+            )
+            metrics = dict(current or {})
+            metrics.update(sections)
+            Document.objects.filter(id=document_id).update(rag_metrics=metrics)
+    except Exception as e:
+        logger.warning(f"Failed to update RAG metrics for document {document_id}: {e}")
+
+
+@dataclass
+class ChatTurn:
+    """State of one chat turn between retrieval/prompt building and generation."""
+    document: Document
+    user_query: str
+    history: list = field(default_factory=list)
+    structured_info: str = ""
+    system_prompt: str = ""
+    chunks: list = field(default_factory=list)
+    contexts: list = field(default_factory=list)
+    context_usage: dict = field(default_factory=dict)
+    timings: dict = field(default_factory=dict)
+    is_partial: bool = False
+    retrieval_failed: bool = False
+    answer_cache: AnswerCache | None = None
+    query_vector: list | None = None
+    # 'exact' / 'semantic' when the answer came from the answer cache
+    cached: str | None = None
+    # Set when the field router answered from the structured data
+    routed: RoutedAnswer | None = None
+    # Answer available before generation (answer cache or field router)
+    ready_answer: str = ""
+    # Answer cache / field router counts, written once at the end of the turn (api/chat_counters.py)
+    counters: dict = field(default_factory=dict)
+    # Question used for retrieval (follow-ups carry the previous question)
+    retrieval_query: str = ""
+    # Bounded history actually sent to the provider
+    memory: ConversationMemory | None = None
+    # Per-turn part of the prompt sent with the question, after the history (stable-prefix layout)
+    turn_context: str = ""
+
+    @property
+    def answered(self) -> bool:
+        return bool(self.cached or self.routed)
+
+
 class RAGService:
     """
     Service for Retrieval-Augmented Generation (Chat with PDF).
@@ -2109,17 +2195,73 @@ class RAGService:
     """
 
     def __init__(self):
+        # Chat provider configuration: ollama (qwen2.5), gemini, or mistral
+        self.chat_provider = os.getenv('RAG_CHAT_PROVIDER', 'ollama').strip().lower()
+
+        # The Mistral client is only required for Mistral embeddings / Mistral chat;
+        # a local embedding backend + Ollama runs without it.
         mistral_key = os.getenv('MISTRAL_API_KEY')
-        if not mistral_key:
+        self.mistral_client = Mistral(api_key=mistral_key) if mistral_key else None
+        if self.mistral_client is None and self.chat_provider == 'mistral':
             raise ValueError("MISTRAL_API_KEY environment variable is not set")
 
-        self.mistral_client = Mistral(api_key=mistral_key)
-        self.embedding_model = "mistral-embed-2312"
+        # Embedding backend: RAG_EMBEDDING_BACKEND=mistral (default) or onnx (local CPU model).
+        self.embedding_backend = get_embedding_backend(self.mistral_client)
+        self.embedding_model = self.embedding_backend.name
+
+        # Persistent embedding cache: only text not seen before is sent to the provider.
+        # Can be disabled by setting RAG_EMBEDDING_CACHE=0/false/no.
+        cache_raw = os.getenv("RAG_EMBEDDING_CACHE", "true").strip().lower()
+        self.embedder = CachedEmbedder(
+            self.embedding_backend.embed,
+            self.embedding_model,
+            enabled=cache_raw not in {"0", "false", "no", "off"},
+        )
+
+        # Query embeddings: in-process LRU + QueryEmbeddingCache table (RAG_QUERY_CACHE=0 disables).
+        query_cache_raw = os.getenv("RAG_QUERY_CACHE", "true").strip().lower()
+        self.query_embedder = CachedQueryEmbedder(
+            self.embedding_backend,
+            enabled=query_cache_raw not in {"0", "false", "no", "off"},
+            max_entries=int(os.getenv("RAG_QUERY_CACHE_SIZE", "512")),
+            memory_ttl_seconds=float(os.getenv("RAG_QUERY_CACHE_MEMORY_TTL", "3600")),
+            ttl_days=float(os.getenv("RAG_QUERY_CACHE_TTL_DAYS", "30")),
+        )
+
+        # Chat answer cache keyed by document version + normalized question (RAG_ANSWER_CACHE=0 disables).
+        answer_cache_raw = os.getenv("RAG_ANSWER_CACHE", "true").strip().lower()
+        self.answer_cache_enabled = answer_cache_raw not in {"0", "false", "no", "off"}
+        self.answer_cache_threshold = float(os.getenv("RAG_ANSWER_CACHE_SEMANTIC_THRESHOLD", "0"))
+        self.answer_cache_ttl_days = float(os.getenv("RAG_ANSWER_CACHE_TTL_DAYS", "7"))
+
+        # Chunking of ingested markdown; documents must be re-ingested (full) for a change to apply.
+        self.chunk_size = int(os.getenv("RAG_CHUNK_SIZE", str(DEFAULT_CHUNK_SIZE)))
+        self.chunk_overlap = int(os.getenv("RAG_CHUNK_OVERLAP", str(DEFAULT_CHUNK_OVERLAP)))
+
+        # Structured-field router: lookup questions answered without retrieval/LLM (RAG_FIELD_ROUTER=0 disables).
+        self.field_router = router_enabled()
+        router_embeddings_raw = os.getenv("RAG_ROUTER_EMBEDDINGS", "false").strip().lower()
+        self.router_embeddings = router_embeddings_raw not in {"0", "false", "no", "off"}
+
+        # Hybrid retrieval: full-text keyword ranking fused with vector ranking (RAG_HYBRID_SEARCH=0 disables).
+        hybrid_raw = os.getenv("RAG_HYBRID_SEARCH", "true").strip().lower()
+        self.hybrid_search = hybrid_raw not in {"0", "false", "no", "off"}
+        self.hybrid_candidates = int(os.getenv("RAG_HYBRID_CANDIDATES", "30"))
+        self.rrf_k = int(os.getenv("RAG_RRF_K", "60"))
+        # Chunks put in the chat prompt; fused rankings need fewer than vector-only search.
+        self.retrieval_k = int(os.getenv("RAG_RETRIEVAL_K", "15" if self.hybrid_search else "25"))
+
+        # Prompt context packing (api/context_packer.py): token budget per provider via RAG_CONTEXT_BUDGET*.
+        self.structured_budget_share = float(os.getenv("RAG_STRUCTURED_BUDGET_SHARE", str(DEFAULT_STRUCTURED_SHARE)))
+        self.mmr_lambda = float(os.getenv("RAG_MMR_LAMBDA", str(DEFAULT_MMR_LAMBDA)))
         
-        # Chat provider configuration: ollama (qwen2.5), gemini, or mistral
-        self.chat_provider = os.getenv('RAG_CHAT_PROVIDER', 'ollama').strip().lower()
-        self.ollama_base_url = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434').strip()
-        self.ollama_model = os.getenv('OLLAMA_MODEL', 'qwen2.5:7b').strip()
+        self.ollama_base_url = ollama.ollama_base_url()
+        self.ollama_model = ollama.ollama_model()
+        # Ollama reuses the KV cache of an identical prompt prefix: instructions + a question-independent
+        # structured block go first, retrieved chunks with the question (RAG_STABLE_PROMPT_PREFIX=0 disables).
+        stable_raw = os.getenv("RAG_STABLE_PROMPT_PREFIX", "true").strip().lower()
+        self.stable_prompt_prefix = self.chat_provider == 'ollama' and stable_raw not in {"0", "false", "no", "off"}
+        self.prefix_budget = int(os.getenv("OLLAMA_PREFIX_BUDGET", "2000"))
         self.mistral_chat_model = os.getenv('MISTRAL_CHAT_MODEL', 'mistral-small-latest').strip()
         
         logger.info(f"RAGService initialized with chat_provider={self.chat_provider}")
@@ -2144,8 +2286,37 @@ class RAGService:
         else:
             raise ValueError(f"Invalid RAG_CHAT_PROVIDER: {self.chat_provider}. Use 'ollama', 'gemini', or 'mistral'")
 
-    def _clean_text_for_rag(self, text: str) -> str:
-        """Removes repetitive headers/footers and fixes extraction glitches."""
+    @property
+    def chat_model_id(self) -> str:
+        """'provider:model' of the chat LLM (part of the answer cache version)."""
+        if self.chat_provider == 'ollama':
+            return f"ollama:{self.ollama_model}"
+        if self.chat_provider == 'mistral':
+            return f"mistral:{self.mistral_chat_model}"
+        return f"gemini:{getattr(self.chat_model, 'model_name', 'gemini-2.5-flash-lite')}"
+
+    def _clean_text_for_rag(self, text: str, document_id: int | None = None) -> str:
+        """
+        Removes repetitive headers/footers and fixes extraction glitches.
+        With `document_id`, the removal stats are stored in rag_metrics['cleaning'].
+        """
+        chars_before = len(text)
+
+        # 0. Running headers/footers/page numbers detected across pages.
+        # Can be disabled by setting RAG_STRIP_RUNNING_HEADERS=0/false/no.
+        header_stats = None
+        strip_raw = os.getenv("RAG_STRIP_RUNNING_HEADERS", "true").strip().lower()
+        if strip_raw not in {"0", "false", "no", "off"}:
+            text, header_stats = strip_running_headers_footers(
+                text,
+                min_page_ratio=float(os.getenv("RAG_RUNNING_HEADER_MIN_RATIO", "0.3")),
+            )
+            if header_stats["removed_lines"]:
+                logger.info(
+                    f"RAG cleaning: removed {header_stats['removed_lines']} running header/footer lines "
+                    f"({len(header_stats['patterns'])} patterns) across {header_stats['pages']} pages"
+                )
+
         # 1. Remove common headers
         lines = text.split('\n')
         cleaned_lines: list[str] = []
@@ -2164,21 +2335,55 @@ class RAGService:
         text = "\n".join(cleaned_lines)
 
         # 2. Fix the "looping phrase" glitch (heuristic)
-        # If a line repeats itself within a short window, cut it.
+        # If a phrase of 10+ chars repeats immediately, keep one copy.
         # (This handles the "sở hữu của một Quỹ..." loop)
-        import re
-        # This regex looks for phrases of 10+ chars that repeat immediately
-        text = re.sub(r'(.{10,})\1+', r'\1', text)
+        # Linear-time scan; the old regex r'(.{10,})\1+' backtracked for minutes on big OCR output.
+        text = collapse_repeated_phrases(
+            text,
+            min_period=10,
+            max_period=int(os.getenv("RAG_REPEAT_MAX_PERIOD", "400")),
+        )
+
+        if document_id is not None:
+            update_rag_metrics(document_id, cleaning={
+                'chars_before': chars_before,
+                'chars_after': len(text),
+                'running_headers': header_stats,
+            })
         return text
 
-    def ingest_document(self, document_id: int) -> bool:
+    def ingest_document(self, document_id: int, incremental: bool | None = None, resume: bool = True) -> bool:
         """
         Process a document into vector chunks for RAG.
+
+        If the document already has chunks and `incremental` is not False
+        (default: RAG_INCREMENTAL_INGEST, on), the new chunk set is diffed against
+        the stored rows and only the difference is written; otherwise all chunks
+        are rebuilt from scratch.
+
+        Progress is checkpointed (stored markdown, embedded/saved batches and
+        the IDs of the saved chunks). With `resume` (default) an unfinished
+        checkpoint is picked up where it stopped instead of redoing OCR and
+        embeddings.
         Returns True if successful.
         """
         try:
             document = Document.objects.get(id=document_id)
             logger.info(f"Starting RAG ingestion for Doc {document_id}")
+            self.embedder.reset_stats()
+
+            if incremental is None:
+                incremental_raw = os.getenv("RAG_INCREMENTAL_INGEST", "true").strip().lower()
+                incremental = incremental_raw not in {"0", "false", "no", "off"}
+
+            if document.rag_embedding_model and document.rag_embedding_model != self.embedding_model:
+                # Stored vectors belong to another embedding model: nothing can be reused.
+                logger.info(
+                    f"Embedding model changed for Doc {document_id} "
+                    f"({document.rag_embedding_model} -> {self.embedding_model}); rebuilding all chunks"
+                )
+                incremental = False
+                resume = False
 
             # Mark as running (best-effort)
             try:
@@ -2192,207 +2397,148 @@ class RAGService:
             except Exception:
                 pass
 
-            # 1. Check if already ingested to avoid duplicates
-            if document.chunks.exists():
-                logger.info(f"Document {document_id} already ingested. Deleting old chunks...")
-                document.chunks.all().delete()
+            checkpoint = self._get_resumable_checkpoint(document) if resume else None
+            if not resume:
+                RagIngestionCheckpoint.objects.filter(document_id=document_id).delete()
+
+            # A checkpoint belongs to the markdown it was planned from. If the document was
+            # reprocessed since, its chunk plan no longer matches: start over with a full rebuild.
+            stored_text = ""
+            if checkpoint is not None:
+                stored_text = self._clean_text_for_rag(self._read_stored_markdown(document), document_id=document_id)
+                if not stored_text or hashlib.sha256(stored_text.encode('utf-8')).hexdigest() != checkpoint.text_digest:
+                    logger.info(f"Markdown of Doc {document_id} changed since its checkpoint; starting a full ingestion")
+                    checkpoint.delete()
+                    checkpoint = None
+                    stored_text = ""
+                    incremental = False
+
+            if checkpoint is not None and checkpoint.stage != 'extracted':
+                # Resume: the stored markdown is the text the checkpoint was chunked from,
+                # skip OCR; chunking restarts and skips the chunks already saved.
+                full_text = stored_text
+                logger.info(
+                    f"Resuming RAG ingestion for Doc {document_id} ({checkpoint.mode}): "
+                    f"{checkpoint.saved_chunks} chunks saved, {checkpoint.embedded_chunks} embedded"
+                )
+            else:
+                # 1. Existing chunks: diff against them (incremental) or rebuild from scratch.
+                has_existing_chunks = document.chunks.exists()
+                if has_existing_chunks and not incremental:
+                    logger.info(f"Document {document_id} already ingested. Deleting old chunks...")
+                    document.chunks.all().delete()
+                    update_rag_metrics(document_id, chunks={'stored': 0})
+                    has_existing_chunks = False
+                if not has_existing_chunks:
+                    Document.objects.filter(id=document_id).update(rag_embedding_model=self.embedding_model)
 
-            try:
-                Document.objects.filter(id=document_id).update(rag_progress=5)
-            except Exception:
-                pass
+                try:
+                    Document.objects.filter(id=document_id).update(rag_progress=5)
+                except Exception:
+                    pass
 
-            # 2. Extract Raw Content (optimized for Scanned PDFs)
-            # Since Mistral/Gemini services return JSON, we might not have the full text saved.
-            # We call a helper to get the raw markdown representation.
-            full_text = self._extract_content_for_rag(document)
-            full_text = self._clean_text_for_rag(full_text)
+                # 2. Extract Raw Content (optimized for Scanned PDFs)
+                # Since Mistral/Gemini services return JSON, we might not have the full text saved.
+                # We call a helper to get the raw markdown representation.
+                # When resuming after extraction, reuse the stored markdown instead of re-running OCR.
+                full_text = stored_text
+                if full_text:
+                    logger.info(f"Resuming RAG ingestion for Doc {document_id} from stored markdown")
+                else:
+                    full_text = self._extract_content_for_rag(document)
+                    full_text = self._clean_text_for_rag(full_text, document_id=document_id)
+
+                if not full_text:
+                    raise ValueError("Could not extract text content from document")
+
+                checkpoint, _ = RagIngestionCheckpoint.objects.update_or_create(
+                    document=document,
+                    defaults={
+                        'stage': 'extracted',
+                        'mode': 'incremental' if has_existing_chunks else 'full',
+                        'text_digest': hashlib.sha256(full_text.encode('utf-8')).hexdigest(),
+                        'chunk_plan': [],
+                        'completed_batches': 0,
+                        'total_batches': 0,
+                        'embedded_chunks': 0,
+                        'saved_chunks': 0,
+                    },
+                )
 
-            if not full_text:
-                raise ValueError("Could not extract text content from document")
+                # DEBUG: Save extracted markdown for inspection
+                try:
+                    debug_dir = os.path.join(settings.MEDIA_ROOT, 'debug_markdown')
+                    os.makedirs(debug_dir, exist_ok=True)
+                    debug_file = os.path.join(debug_dir, f'document_{document_id}_extracted.md')
+                    with open(debug_file, 'w', encoding='utf-8') as f:
+                        f.write(full_text)
+                    logger.info(f">> Saved extracted markdown to: {debug_file}")
+                except Exception as e:
+                    logger.warning(f"Failed to save debug markdown: {e}")
 
-            # DEBUG: Save extracted markdown for inspection
-            try:
-                debug_dir = os.path.join(settings.MEDIA_ROOT, 'debug_markdown')
-                os.makedirs(debug_dir, exist_ok=True)
-                debug_file = os.path.join(debug_dir, f'document_{document_id}_extracted.md')
-                with open(debug_file, 'w', encoding='utf-8') as f:
-                    f.write(full_text)
-                logger.info(f">> Saved extracted markdown to: {debug_file}")
-            except Exception as e:
-                logger.warning(f"Failed to save debug markdown: {e}")
+                try:
+                    Document.objects.filter(id=document_id).update(rag_progress=15)
+                except Exception:
+                    pass
+
+                checkpoint.stage = 'planned'
+                checkpoint.save(update_fields=['stage', 'updated_at'])
 
             try:
-                Document.objects.filter(id=document_id).update(rag_progress=15)
+                Document.objects.filter(id=document_id).update(rag_progress=30)
             except Exception:
                 pass
 
-            # 3. Chunking Strategy
-            # Parse page markers (supports both formats: "--- PAGE X ---" and "=== PAGE X ===")
-            page_sections = []
-            current_page = 1
-            current_text = ""
-            
-            for line in full_text.split('\n'):
-                # Check for page markers in either format
-                is_page_marker = False
-                if ('--- PAGE ' in line and ' ---' in line) or ('=== PAGE ' in line and ' ===' in line):
-                    is_page_marker = True
-                    # Save previous page section if exists
-                    if current_text.strip():
-                        page_sections.append((current_page, current_text))
-                    # Extract new page number
-                    try:
-                        # Remove both marker formats
-                        page_str = line.strip().replace('--- PAGE ', '').replace(' ---', '')
-                        page_str = page_str.replace('=== PAGE ', '').replace(' ===', '')
-                        current_page = int(page_str)
-                        current_text = ""
-                    except ValueError:
-                        is_page_marker = False
-                
-                if not is_page_marker:
-                    current_text += line + '\n'
-            
-            # Add last section
-            if current_text.strip():
-                page_sections.append((current_page, current_text))
-            
-            logger.info(f"Parsed {len(page_sections)} page sections")
-            
-            # Split by Markdown headers to keep logical sections together
-            headers_to_split_on = [
-                ("#", "Header 1"),
-                ("##", "Header 2"),
-                ("###", "Header 3"),
-            ]
-            markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on)
-            
-            # Process each page section separately to maintain page tracking
-            all_chunks_with_pages = []
-            for page_num, page_text in page_sections:
-                # Split by headers
-                docs = markdown_splitter.split_text(page_text)
-                
-                # Then split into smaller chunks
-                text_splitter = RecursiveCharacterTextSplitter(
-                    chunk_size=800, 
-                    chunk_overlap=100,
-                    separators=["\n\n", "\n", ".", " ", ""]
-                )
-                split_docs = text_splitter.split_documents(docs)
-                
-                # Tag each chunk with its page number
-                for doc in split_docs:
-                    doc.metadata['page_number'] = page_num
-                    all_chunks_with_pages.append(doc)
-            
-            logger.info(f"Created {len(all_chunks_with_pages)} chunks from document.")
+            # 3. Chunking Strategy: chunks are produced lazily and fed to the embedding batches.
+            # Full rebuilds index the pages chat needs most first.
+            page_priority = self._page_priorities(full_text)
+            pages_total = len(page_priority)
 
+            # Incremental runs keep serving the previous chunks until the swap, so
+            # coverage only drops for full rebuilds.
             try:
-                Document.objects.filter(id=document_id).update(rag_progress=30)
+                Document.objects.filter(id=document_id).update(
+                    rag_pages_total=pages_total,
+                    rag_pages_indexed=pages_total if checkpoint.mode == 'incremental' else 0,
+                )
             except Exception:
                 pass
 
-            # 4. Generate Embeddings & Save (Batch Processing)
-            batch_size = 50  # Increased for fewer API calls
-            db_write_interval = 200  # Write to DB every 200 chunks instead of every batch
-            chunks_to_create = []
-
-            total_chunks = len(all_chunks_with_pages) or 1
-            
-            for i in range(0, len(all_chunks_with_pages), batch_size):
-                batch = all_chunks_with_pages[i:i + batch_size]
-                batch_texts = [d.page_content for d in batch]
-
-                # Progress: 30% -> 95% across embedding work
-                try:
-                    done = min(i + batch_size, total_chunks)
-                    pct = 30 + int((done / total_chunks) * 65)
-                    Document.objects.filter(id=document_id).update(rag_progress=min(max(pct, 30), 95))
-                except Exception:
-                    pass
-                
-                # Call Gemini Embedding API with retry logic
-                max_retries = 3
-                retry_count = 0
-                embeddings = None
-                
-                while retry_count < max_retries:
-                    try:
-                        logger.info(f"Embedding batch {i//batch_size + 1}/{(len(all_chunks_with_pages) + batch_size - 1)//batch_size} ({len(batch)} chunks)")
+            # 4. Generate Embeddings & Save
+            # Kept chunks whose near-duplicates show up after they were saved get their
+            # alias pages written once the plan is exhausted.
+            late_aliases: dict[tuple[str, int], list[int]] = {}
+            if checkpoint.mode == 'incremental':
+                # The diff needs the whole plan; only the new chunks are embedded.
+                chunk_plan = self._iter_chunk_plan(full_text, document_id=document_id)
+                self._ingest_incremental(document, list(chunk_plan), checkpoint)
+            else:
+                chunk_plan = self._iter_chunk_plan(
+                    full_text, document_id=document_id, late_aliases=late_aliases, page_priority=page_priority,
+                )
+                self._ingest_full(document, chunk_plan, checkpoint, pages_total)
+                self._save_late_aliases(document, late_aliases)
 
-                        resp = self.mistral_client.embeddings.create(
-                            model=self.embedding_model,
-                            inputs=batch_texts,
-                        )
-                        embeddings = [item.embedding for item in resp.data]
-                        break  # Success, exit retry loop
-                        
-                    except Exception as e:
-                        retry_count += 1
-                        import random
-                        import time
-                        message = str(e)
-
-                        if retry_count < max_retries:
-                            wait_time = (2 ** retry_count) + random.uniform(0, 1.0)  # jitter
-                            logger.warning(
-                                f"Embedding API error (attempt {retry_count}/{max_retries}): {message}. Retrying in {wait_time}s..."
-                            )
-                            time.sleep(wait_time)
-                        else:
-                            logger.error(f"Failed to embed batch after {max_retries} attempts: {str(e)}")
-                            raise
-                
-                # Prepare DB objects
-                for j, doc_chunk in enumerate(batch):
-                    # Combine header metadata into content for better context
-                    header_context = ""
-                    if 'Header 1' in doc_chunk.metadata:
-                        header_context += f"# {doc_chunk.metadata['Header 1']}\n"
-                    if 'Header 2' in doc_chunk.metadata:
-                        header_context += f"## {doc_chunk.metadata['Header 2']}\n"
-                        
-                    final_content = header_context + doc_chunk.page_content
+            RagIngestionCheckpoint.objects.filter(pk=checkpoint.pk).update(
+                stage='completed',
+                updated_at=timezone.now(),
+            )
+            Document.objects.filter(id=document_id).update(
+                rag_pages_indexed=pages_total,
+                rag_embedding_model=self.embedding_model,
+            )
 
-                    # Extract page number from metadata (now properly set)
-                    page_num = doc_chunk.metadata.get('page_number', 1)
-                    
-                    chunks_to_create.append(DocumentChunk(
-                        document=document,
-                        content=final_content,
-                        page_number=page_num,
-                        embedding=embeddings[j]
-                    ))
-                
-                # Save chunks to DB every db_write_interval to reduce transactions
-                if len(chunks_to_create) >= db_write_interval:
-                    try:
-                        # Refresh DB connection in case it timed out during API calls
-                        close_old_connections()
-                        
-                        DocumentChunk.objects.bulk_create(chunks_to_create, batch_size=500)
-                        logger.info(f"Saved {len(chunks_to_create)} chunks to database")
-                        chunks_to_create = []  # Clear for next batch
-                    except Exception as e:
-                        logger.error(f"Failed to save chunk batch: {str(e)}")
-                        raise
-            
-            # Save any remaining chunks
-            if chunks_to_create:
-                try:
-                    close_old_connections()
-                    DocumentChunk.objects.bulk_create(chunks_to_create, batch_size=500)
-                    logger.info(f"Saved final {len(chunks_to_create)} chunks to database")
-                except Exception as e:
-                    logger.error(f"Failed to save final chunk batch: {str(e)}")
-                    raise
-            
             # Final count
             total_chunks = document.chunks.count()
             logger.info(f"Successfully saved {total_chunks} vector chunks total.")
 
+            cache_stats = self.embedder.stats()
+            logger.info(
+                f"Embedding cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses "
+                f"(hit rate {cache_stats['hit_rate']:.0%}, {cache_stats['api_calls']} API calls)"
+            )
+            update_rag_metrics(document_id, embedding_cache=cache_stats)
+
             try:
                 Document.objects.filter(id=document_id).update(
                     rag_status='completed',
@@ -2402,6 +2548,8 @@ class RAGService:
                 )
             except Exception:
                 pass
+            # Answers were generated from the previous chunks
+            invalidate_answer_cache(document_id)
             
             return True
 
@@ -2416,164 +2564,761 @@ class RAGService:
                 pass
             raise
 
-    def chat(self, document_id: int, user_query: str, history: list = None, return_source=False, **kwargs) -> dict|str:
+    def _iter_chunk_plan(
+        self,
+        full_text: str,
+        document_id: int | None = None,
+        late_aliases: dict | None = None,
+        page_priority: dict[int, int] | None = None,
+    ) -> Iterator[dict]:
         """
-        Answer a user question using RAG.
+        Split page-marked markdown into chunk plan items, lazily.
+
+        Yields {id, page_number, alias_pages, priority, content, embed_text,
+        content_hash} dicts where `content` (header context + text) is what gets
+        stored and `embed_text` is what gets embedded. The stable chunk ID is the
+        position in the plan plus the content hash. With `page_priority` (see
+        _page_priorities), pages are planned tier by tier, in page order within a
+        tier; otherwise in document order with priority 0.
+
+        Near-duplicate chunks (repeated boilerplate, the same fee table on several
+        pages) are dropped and their pages appended to the kept item's
+        `alias_pages`; RAG_NEAR_DUP_THRESHOLD (default 0.9, 0 disables) sets the
+        similarity cut-off. A copy can show up after the kept item was consumed,
+        so every item that gains aliases is also recorded in `late_aliases`, keyed
+        by (content_hash, page_number). With `document_id`, the dedup stats are
+        stored in rag_metrics['near_duplicates'] once the plan is exhausted.
         """
+        threshold = float(os.getenv("RAG_NEAR_DUP_THRESHOLD", str(DEFAULT_NEAR_DUP_THRESHOLD)))
+        dedup = NearDuplicateFilter(threshold) if threshold > 0 else None
+        # (content_hash, page_number, alias_pages) of each kept item, by plan position.
+        kept: list[tuple[str, int, list[int]]] = []
+
+        if page_priority:
+            tiers = [
+                (tier, {page for page, priority in page_priority.items() if priority == tier})
+                for tier in sorted(set(page_priority.values()))
+            ]
+        else:
+            tiers = [(0, None)]
+
+        # One streaming pass over page markers + header hierarchy per tier (see api/chunking.py).
+        chunks = (
+            (tier, chunk)
+            for tier, pages in tiers
+            for chunk in iter_markdown_chunks(
+                full_text, chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap, pages=pages,
+            )
+        )
+        for tier, chunk in chunks:
+            if dedup is not None:
+                representative = dedup.find_or_add(chunk.text, len(kept))
+                if representative is not None:
+                    content_hash, page, aliases = kept[representative]
+                    if chunk.page_number != page and chunk.page_number not in aliases:
+                        aliases.append(chunk.page_number)
+                        if late_aliases is not None:
+                            late_aliases[(content_hash, page)] = aliases
+                    continue
+
+            final_content = format_chunk_content(chunk)
+            content_hash = embedding_text_hash(final_content)
+            item = {
+                'id': f"{len(kept):05d}-{content_hash[:12]}",
+                'page_number': chunk.page_number,
+                'alias_pages': [],
+                'priority': tier,
+                'content': final_content,
+                'embed_text': chunk.text,
+                'content_hash': content_hash,
+            }
+            kept.append((content_hash, chunk.page_number, item['alias_pages']))
+            yield item
+
+        if dedup is not None:
+            dedup_stats = dedup.stats()
+            if dedup_stats['duplicates']:
+                logger.info(
+                    f"Dropped {dedup_stats['duplicates']}/{dedup_stats['checked']} near-duplicate chunks "
+                    f"(threshold {threshold})"
+                )
+            if document_id is not None:
+                update_rag_metrics(document_id, near_duplicates=dedup_stats)
+
+    def _page_priorities(self, full_text: str) -> dict[int, int]:
+        """
+        Indexing tier of every page with text, using the same keyword categories as
+        create_optimized_pdf(): 0 = first pages / identity / fees, 1 = tables
+        (portfolio, NAV, ...), 2 = everything else. Pages are classified one at a
+        time as the sections stream by.
+        """
+        max_identity_page = getattr(settings, "MAX_IDENTITY_SCAN_PAGES", 40)
+        normalized_keywords = {
+            category: [normalize_text_for_matching(k) for k in kws]
+            for category, kws in PAGE_KEYWORDS.items()
+        }
+
+        def classify(page: int, texts: list[str]) -> int:
+            normalized = normalize_text_for_matching(" ".join(texts))
+            if page <= 4:
+                return 0  # cover, table of contents, general information
+            if any(k in normalized for k in normalized_keywords["fees"]) or (
+                page <= max_identity_page and any(k in normalized for k in normalized_keywords["identity"])
+            ):
+                return 0
+            if any(k in normalized for k in normalized_keywords["tables"]):
+                return 1
+            return 2
+
+        page_priority: dict[int, int] = {}
+        current_page, texts = None, []
+        for page, _, section in iter_page_sections(full_text):
+            if page != current_page and texts:
+                page_priority[current_page] = min(page_priority.get(current_page, 2), classify(current_page, texts))
+                texts = []
+            current_page = page
+            texts.append(section)
+        if texts:
+            page_priority[current_page] = min(page_priority.get(current_page, 2), classify(current_page, texts))
+        return page_priority
+
+    def _save_late_aliases(self, document, late_aliases: dict) -> None:
+        """
+        Write the alias pages found after their kept chunk was saved (see
+        _iter_chunk_plan); rows that already hold them are left alone.
+        """
+        if not late_aliases:
+            return
+        close_old_connections()
+        rows = document.chunks.filter(
+            content_hash__in={content_hash for content_hash, _ in late_aliases},
+        ).values_list('id', 'content_hash', 'page_number', 'alias_pages')
+        updates = []
+        for row_id, content_hash, page, stored in rows:
+            aliases = late_aliases.get((content_hash, page))
+            if aliases is not None and sorted(aliases) != sorted(stored or []):
+                updates.append(DocumentChunk(id=row_id, alias_pages=aliases))
+        if updates:
+            DocumentChunk.objects.bulk_update(updates, ['alias_pages'], batch_size=500)
+
+    def _get_resumable_checkpoint(self, document):
+        """Return the document's unfinished checkpoint, or None."""
         try:
-            # Backwards compatibility: some callers might use `return_sources` (plural).
-            if "return_sources" in kwargs and kwargs["return_sources"] is True:
-                return_source = True
+            checkpoint = document.rag_checkpoint
+        except RagIngestionCheckpoint.DoesNotExist:
+            return None
+        if checkpoint.stage == 'completed':
+            return None
+        return checkpoint
 
-            document = Document.objects.get(id=document_id)
+    def _read_stored_markdown(self, document) -> str:
+        """Markdown saved by a previous extraction (Document.markdown_file), or ''."""
+        if not document.markdown_file:
+            return ""
+        try:
+            with document.markdown_file.open('rb') as f:
+                return f.read().decode('utf-8')
+        except Exception as e:
+            logger.warning(f"Could not read stored markdown for Doc {document.id}: {e}")
+            return ""
 
-            def get_value(field_data):
-                if isinstance(field_data, dict) and 'value' in field_data:
-                    return field_data['value']
-                return field_data
+    def _embed_chunk_plan(
+        self,
+        document_id: int,
+        items: Iterable[dict],
+        checkpoint=None,
+        start: int = 0,
+        total_pages: int = 0,
+        pages_done: set | None = None,
+        batch_size: int = 50,
+    ):
+        """
+        Embed plan items in batches as `items` (a list or a lazy iterator) yields
+        them, and yield (plan_items, embeddings) per batch. Progress goes 30% ->
+        95% with the pages covered out of `total_pages` (default: the pages of
+        `items`); `pages_done` are pages covered before `items`.
+
+        `start` is the position of the first item in the list being embedded.
+        Items before `checkpoint.embedded_chunks` were embedded by an earlier
+        attempt; their vectors come back from the embedding cache.
+        """
+        if not total_pages:
+            items = list(items)
+            total_pages = len({item['page_number'] for item in items})
+        already_embedded = checkpoint.embedded_chunks if checkpoint is not None else 0
+        pages = set(pages_done or ())
+        items = iter(items)
+        end = start
+        batch_no = start // batch_size
+
+        while True:
+            batch = list(itertools.islice(items, batch_size))
+            if not batch:
+                break
+            end += len(batch)
+            batch_no += 1
+            pages.update(item['page_number'] for item in batch)
 
-            def safe_text(val, max_len: int = 1200) -> str:
-                if val is None:
-                    return "Không có"
-                if isinstance(val, (dict, list)):
+            # Progress: 30% -> 95% across embedding work
+            try:
+                pct = 30 + int((len(pages) / (total_pages or 1)) * 65)
+                Document.objects.filter(id=document_id).update(rag_progress=min(max(pct, 30), 95))
+            except Exception:
+                pass
+
+            resumed = " (from checkpoint)" if end <= already_embedded else ""
+            logger.info(f"Embedding batch {batch_no} ({len(batch)} chunks, {len(pages)}/{total_pages} pages){resumed}")
+            embeddings = self.embedder.embed([item['embed_text'] for item in batch])
+
+            if checkpoint is not None and end > checkpoint.embedded_chunks:
+                checkpoint.stage = 'embedding'
+                checkpoint.embedded_chunks = end
+                checkpoint.completed_batches = batch_no
+                checkpoint.save(update_fields=['stage', 'embedded_chunks', 'completed_batches', 'updated_at'])
+            yield batch, embeddings
+
+        # The batch count of a streamed plan is only known once it is exhausted.
+        if checkpoint is not None and checkpoint.total_batches != batch_no:
+            checkpoint.total_batches = batch_no
+            checkpoint.save(update_fields=['total_batches', 'updated_at'])
+
+    def _ingest_full(self, document, chunk_plan: Iterable[dict], checkpoint, total_pages: int = 0) -> None:
+        """
+        Embed every planned chunk and insert it (document has no chunks yet).
+
+        `chunk_plan` is consumed lazily, so embedding starts with the first batch
+        of chunks. Chunks are committed page range by page range in plan order
+        (priority pages first, see _page_priorities): a write happens at a page
+        boundary once `db_write_interval` chunks are buffered or the priority tier
+        changes, and updates Document.rag_pages_indexed so chat can start on the
+        pages already indexed. Each write commits together with
+        `checkpoint.saved_chunks` and the stable IDs of the saved chunks, so a
+        resumed run skips the chunks already stored (and starts over if the
+        chunker now plans them differently).
+        """
+        db_write_interval = 200  # Write to DB every ~200 chunks instead of every batch
+        chunks_to_create = []
+        chunk_ids: list[str] = []
+        buffered_pages: list[int] = []
+        buffered_priority = None
+
+        items = iter(chunk_plan)
+        saved = checkpoint.saved_chunks
+        pages_done: set[int] = set()
+        if saved:
+            done = list(itertools.islice(items, saved))
+            if [item['id'] for item in done] == checkpoint.chunk_plan[:saved]:
+                logger.info(f"Skipping {saved} chunks already saved by a previous attempt")
+                pages_done = {item['page_number'] for item in done}
+            else:
+                # Chunk settings changed since the interrupted run: the saved rows do not match the plan.
+                logger.info(f"Chunk plan of Doc {document.id} changed since its checkpoint; saving all chunks again")
+                with transaction.atomic():
+                    document.chunks.all().delete()
+                    checkpoint.chunk_plan = []
+                    checkpoint.saved_chunks = checkpoint.embedded_chunks = checkpoint.completed_batches = 0
+                    checkpoint.save(update_fields=[
+                        'chunk_plan', 'saved_chunks', 'embedded_chunks', 'completed_batches', 'updated_at',
+                    ])
+                items = itertools.chain(done, items)
+                saved = 0
+
+        indexed_pages = set(pages_done)
+
+        def flush(rows: list, ids: list[str], pages: list[int]) -> None:
+            # Refresh DB connection in case it timed out during API calls
+            close_old_connections()
+            with transaction.atomic():
+                save_document_chunks(rows)
+                checkpoint.saved_chunks += len(rows)
+                checkpoint.chunk_plan = checkpoint.chunk_plan + ids
+                RagIngestionCheckpoint.objects.filter(pk=checkpoint.pk).update(
+                    saved_chunks=checkpoint.saved_chunks,
+                    chunk_plan=checkpoint.chunk_plan,
+                    updated_at=timezone.now(),
+                )
+                indexed_pages.update(pages)
+                Document.objects.filter(id=document.id).update(rag_pages_indexed=len(indexed_pages))
+            # Read by retrieve() to plan searches without counting the rows (see _stored_chunk_count)
+            update_rag_metrics(document.id, chunks={'stored': checkpoint.saved_chunks})
+            logger.info(
+                f"Saved {len(rows)} chunks to database (pages {min(pages)}-{max(pages)}; "
+                f"{len(indexed_pages)} pages indexed)"
+            )
+
+        embedded = self._embed_chunk_plan(
+            document.id, items, checkpoint, start=saved, total_pages=total_pages, pages_done=pages_done,
+        )
+        for batch, embeddings in embedded:
+            for item, embedding in zip(batch, embeddings):
+                page = item['page_number']
+                priority = item.get('priority', 0)
+                at_page_boundary = bool(buffered_pages) and page != buffered_pages[-1]
+                if at_page_boundary and (len(chunks_to_create) >= db_write_interval or priority != buffered_priority):
                     try:
-                        val = json.dumps(val, ensure_ascii=False)
-                    except Exception:
-                        val = str(val)
-                val = str(val)
-                val = val.strip()
-                if not val:
-                    return "Không có"
-                return val if len(val) <= max_len else (val[:max_len] + " …")
-
-            # 1. Lấy dữ liệu cấu trúc đã trích xuất ("Phao cứu sinh" cho câu hỏi về phí, tên, mã...)
-            structured_info = ""
-
-            extracted_data = document.extracted_data or {}
-            minimum_investment = extracted_data.get('minimum_investment')
-            investment_objective = extracted_data.get('investment_objective')
-            asset_allocation = extracted_data.get('asset_allocation')
-            inception_date = extracted_data.get('inception_date')
-            effective_date = extracted_data.get('effective_date')
-
-            fees_extracted = extracted_data.get('fees') or {}
-            operational_details = extracted_data.get('operational_details') or {}
-            valuation = extracted_data.get('valuation') or {}
-            risk_factors = extracted_data.get('risk_factors') or {}
+                        flush(chunks_to_create, chunk_ids, buffered_pages)
+                    except Exception as e:
+                        logger.error(f"Failed to save chunk batch: {str(e)}")
+                        raise
+                    chunks_to_create, chunk_ids, buffered_pages = [], [], []
 
+                # Prepare DB objects
+                chunks_to_create.append(DocumentChunk(
+                    document=document,
+                    content=item['content'],
+                    page_number=page,
+                    alias_pages=item.get('alias_pages', []),
+                    content_hash=item['content_hash'],
+                    embedding=embedding,
+                ))
+                chunk_ids.append(item['id'])
+                if not buffered_pages or buffered_pages[-1] != page:
+                    buffered_pages.append(page)
+                buffered_priority = priority
+
+        # Save any remaining chunks
+        if chunks_to_create:
             try:
-                fund_data = ExtractedFundData.objects.get(document_id=document_id)
-                structured_info = f"""
-THÔNG TIN CƠ BẢN ĐÃ ĐƯỢC TRÍCH XUẤT (ƯU TIÊN DÙNG CHO CÂU HỎI VỀ PHÍ / TÊN / MÃ / NGÂN HÀNG):
-- Tên quỹ: {fund_data.fund_name}
-- Mã quỹ: {fund_data.fund_code}
-- Loại quỹ (fund_type): {safe_text(fund_data.fund_type, 300)}
-- Cấu trúc pháp lý (legal_structure): {safe_text(fund_data.legal_structure, 300)}
-- Số giấy phép (license_number): {safe_text(fund_data.license_number, 300)}
-- Cơ quan quản lý (regulator): {safe_text(fund_data.regulator, 300)}
-- Công ty quản lý: {fund_data.management_company}
-- Ngân hàng giám sát: {fund_data.custodian_bank}
-- Người/đơn vị giám sát quỹ (fund_supervisor): {safe_text(fund_data.fund_supervisor, 300)}
-- Kiểm toán (auditor): {safe_text(fund_data.auditor, 300)}
-
-- Phí quản lý: {fund_data.management_fee}
-- Phí phát hành (mua): {fund_data.subscription_fee}
-- Phí mua lại (bán): {fund_data.redemption_fee}
-- Phí chuyển đổi: {fund_data.switching_fee}
-- Tổng chi phí (TER): {safe_text(fund_data.total_expense_ratio, 300)}
-- Phí lưu ký: {safe_text(fund_data.custody_fee, 300)}
-- Phí kiểm toán: {safe_text(fund_data.audit_fee, 300)}
-- Phí giám sát: {safe_text(fund_data.supervisory_fee, 300)}
-- Chi phí khác: {safe_text(fund_data.other_expenses, 600)}
-
-- Ngày thành lập/quỹ bắt đầu hoạt động (inception_date): {inception_date or 'Không có'}
-- Ngày hiệu lực (effective_date): {effective_date or 'Không có'}
-- Mục tiêu đầu tư: {investment_objective or 'Không có'}
-- Chiến lược đầu tư: {safe_text(fund_data.investment_strategy, 900)}
-- Phong cách đầu tư: {safe_text(fund_data.investment_style, 200)}
-- Ngành/nhóm tài sản trọng tâm: {safe_text(fund_data.sector_focus, 600)}
-- Benchmark: {safe_text(fund_data.benchmark, 300)}
-
-- Hạn chế đầu tư: {safe_text(fund_data.investment_restrictions, 900)}
-- Giới hạn vay (borrowing_limit): {safe_text(fund_data.borrowing_limit, 300)}
-- Giới hạn đòn bẩy (leverage_limit): {safe_text(fund_data.leverage_limit, 300)}
-
-- Thông tin giao dịch (trading_frequency): {safe_text(fund_data.trading_frequency, 300)}
-- Cut-off time: {safe_text(fund_data.cut_off_time, 300)}
-- Tần suất tính NAV: {safe_text(fund_data.nav_calculation_frequency, 300)}
-- Công bố NAV: {safe_text(fund_data.nav_publication, 300)}
-- Chu kỳ thanh toán (settlement_cycle): {safe_text(fund_data.settlement_cycle, 300)}
-
-- Phương pháp định giá: {safe_text(fund_data.valuation_method, 900)}
-- Nguồn giá: {safe_text(fund_data.pricing_source, 900)}
-
-- Quyền nhà đầu tư: {safe_text(fund_data.investor_rights, 900)}
-- Đại lý phân phối: {safe_text(fund_data.distribution_agent, 400)}
-- Kênh phân phối: {safe_text(fund_data.sales_channels, 600)}
-
-- Rủi ro tập trung: {safe_text(fund_data.concentration_risk, 700)}
-- Rủi ro thanh khoản: {safe_text(fund_data.liquidity_risk, 700)}
-- Rủi ro lãi suất: {safe_text(fund_data.interest_rate_risk, 700)}
-
-- Số tiền đầu tư tối thiểu (ban đầu / bổ sung): {json.dumps(minimum_investment or {}, ensure_ascii=False)}
-- Cơ cấu phân bổ tài sản: {json.dumps(asset_allocation or {}, ensure_ascii=False)}
-- Danh mục đầu tư (trích xuất): {json.dumps(fund_data.portfolio or [], ensure_ascii=False)}
-""".strip()
-            except ExtractedFundData.DoesNotExist:
-                structured_info = f"""
-THÔNG TIN CƠ BẢN ĐÃ ĐƯỢC TRÍCH XUẤT (từ Document.extracted_data):
-- Ngày thành lập/quỹ bắt đầu hoạt động (inception_date): {inception_date or 'Không có'}
-- Ngày hiệu lực (effective_date): {effective_date or 'Không có'}
-- Mục tiêu đầu tư: {investment_objective or 'Không có'}
-- Chiến lược đầu tư: {safe_text(get_value(extracted_data.get('investment_strategy')), 900)}
-- Phí (fees): {safe_text(fees_extracted, 900)}
-- Thông tin giao dịch (operational_details): {safe_text(operational_details, 900)}
-- Định giá (valuation): {safe_text(valuation, 900)}
-- Hạn chế/giới hạn đầu tư: {safe_text(get_value(extracted_data.get('investment_restrictions')) or get_value(extracted_data.get('borrowing_limit')) or get_value(extracted_data.get('leverage_limit')), 900)}
-- Quyền NĐT / Phân phối: {safe_text(get_value(extracted_data.get('investor_rights')) or get_value(extracted_data.get('distribution_agent')) or get_value(extracted_data.get('sales_channels')), 900)}
-- Rủi ro (risk_factors): {safe_text(risk_factors, 900)}
-- Số tiền đầu tư tối thiểu (ban đầu / bổ sung): {json.dumps(minimum_investment or {}, ensure_ascii=False)}
-- Cơ cấu phân bổ tài sản: {json.dumps(asset_allocation or {}, ensure_ascii=False)}
-""".strip()
+                flush(chunks_to_create, chunk_ids, buffered_pages)
+            except Exception as e:
+                logger.error(f"Failed to save final chunk batch: {str(e)}")
+                raise
+
+    def _ingest_incremental(self, document, chunk_plan: list[dict], checkpoint) -> None:
+        """
+        Diff the new chunk plan against stored chunks and apply only the changes.
+
+        Chunks are matched by content hash, preferring the same page. Matches on a
+        different page get their page number updated in place; unmatched stored rows
+        are deleted and unmatched plan items are embedded and inserted. All writes
+        happen in one transaction, so chat keeps reading the old chunks until the
+        swap is committed. A resumed run recomputes the same diff and gets the
+        vectors of already-embedded batches back from the embedding cache.
+        """
+        close_old_connections()
+        existing = list(document.chunks.values_list('id', 'content_hash', 'page_number', 'alias_pages'))
+
+        # Rows written before content hashes existed: hash them once, in place.
+        legacy_ids = [row_id for row_id, content_hash, _, _ in existing if not content_hash]
+        if legacy_ids:
+            legacy_hashes = {
+                row_id: embedding_text_hash(content)
+                for row_id, content in DocumentChunk.objects.filter(id__in=legacy_ids).values_list('id', 'content')
+            }
+            DocumentChunk.objects.bulk_update(
+                [DocumentChunk(id=row_id, content_hash=h) for row_id, h in legacy_hashes.items()],
+                ['content_hash'],
+                batch_size=500,
+            )
+            existing = [
+                (row_id, content_hash or legacy_hashes.get(row_id, ''), page, aliases)
+                for row_id, content_hash, page, aliases in existing
+            ]
+
+        stored_aliases = {row_id: sorted(aliases or []) for row_id, _, _, aliases in existing}
+        by_hash_and_page: dict[tuple[str, int], list[int]] = {}
+        for row_id, content_hash, page, _ in existing:
+            by_hash_and_page.setdefault((content_hash, page), []).append(row_id)
+
+        # Pass 1: same text on the same page -> keep untouched (refresh aliases if they changed).
+        kept = 0
+        alias_updates: list[DocumentChunk] = []
+        unmatched: list[dict] = []
+        for item in chunk_plan:
+            ids = by_hash_and_page.get((item['content_hash'], item['page_number']))
+            if ids:
+                row_id = ids.pop()
+                kept += 1
+                aliases = item.get('alias_pages', [])
+                if sorted(aliases) != stored_aliases.get(row_id, []):
+                    alias_updates.append(DocumentChunk(id=row_id, alias_pages=aliases))
+            else:
+                unmatched.append(item)
+
+        # Pass 2: same text on another page -> update page number in place.
+        by_hash: dict[str, list[int]] = {}
+        for (content_hash, _), ids in by_hash_and_page.items():
+            by_hash.setdefault(content_hash, []).extend(ids)
+
+        page_updates: list[DocumentChunk] = []
+        new_items: list[dict] = []
+        for item in unmatched:
+            ids = by_hash.get(item['content_hash'])
+            if ids:
+                page_updates.append(DocumentChunk(
+                    id=ids.pop(),
+                    page_number=item['page_number'],
+                    alias_pages=item.get('alias_pages', []),
+                ))
+            else:
+                new_items.append(item)
+
+        vanished_ids = [row_id for ids in by_hash.values() for row_id in ids]
+
+        logger.info(
+            f"Incremental ingestion for Doc {document.id}: {kept} unchanged, {len(page_updates)} moved, "
+            f"{len(new_items)} new, {len(vanished_ids)} removed"
+        )
+
+        # Embed new chunks outside the transaction (slow network calls).
+        chunks_to_create = []
+        for batch, embeddings in self._embed_chunk_plan(document.id, new_items, checkpoint):
+            for item, embedding in zip(batch, embeddings):
+                chunks_to_create.append(DocumentChunk(
+                    document=document,
+                    content=item['content'],
+                    page_number=item['page_number'],
+                    alias_pages=item.get('alias_pages', []),
+                    content_hash=item['content_hash'],
+                    embedding=embedding,
+                ))
+
+        close_old_connections()
+        with transaction.atomic():
+            if vanished_ids:
+                DocumentChunk.objects.filter(id__in=vanished_ids).delete()
+            if page_updates:
+                DocumentChunk.objects.bulk_update(page_updates, ['page_number', 'alias_pages'], batch_size=500)
+            if alias_updates:
+                DocumentChunk.objects.bulk_update(alias_updates, ['alias_pages'], batch_size=500)
+            if chunks_to_create:
+                save_document_chunks(chunks_to_create)
+
+        update_rag_metrics(
+            document.id,
+            incremental={
+                'unchanged': kept,
+                'moved': len(page_updates),
+                'inserted': len(chunks_to_create),
+                'deleted': len(vanished_ids),
+            },
+            chunks={'stored': kept + len(page_updates) + len(chunks_to_create)},
+        )
+
+    def retrieve(self, document, user_query: str, limit: int = 25) -> RetrievalResult:
+        """
+        Embed `user_query` and fetch the `limit` closest chunks of `document` in a
+        single query (id, page, aliases, content, distance only). Raises
+        EmbeddingModelMismatch for chunks embedded by another backend.
 
-            # 2. Vector Search (Semantic Retrieval) cho câu hỏi giải thích / chiến lược / rủi ro...
-            rag_context_str = ""
-            retrieved_chunks = []
+        With hybrid search, a keyword query runs in a worker thread while the query
+        is embedded and searched; both rankings (`hybrid_candidates` each) are
+        merged with reciprocal rank fusion.
+        """
+        self._check_embedding_model(document)
+        queryset = DocumentChunk.objects.filter(document_id=document.id)
+        chunk_count = self._stored_chunk_count(document, queryset)
+        if not self.hybrid_search:
+            return self._vector_retrieve(queryset, user_query, limit, chunk_count)
+
+        candidates = max(self.hybrid_candidates, limit)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            keyword_future = pool.submit(keyword_search, queryset, user_query, candidates, True)
+            result = self._vector_retrieve(queryset, user_query, candidates, chunk_count)
             try:
-                query_embedding = self.mistral_client.embeddings.create(
-                    model=self.embedding_model,
-                    inputs=[user_query],
-                ).data[0].embedding
-                retrieved_chunks = DocumentChunk.objects.filter(document_id=document_id) \
-                    .annotate(distance=CosineDistance('embedding', query_embedding)) \
-                    .order_by('distance')[:25]
-                # Create the string for the LLM
-                rag_context_str = "\n\n---\n\n".join(
-                    [f"=== PAGE {c.page_number} ===\n{c.content}" for c in retrieved_chunks]
-                )
-                relevant_chunks = DocumentChunk.objects.filter(document_id=document_id) \
-                    .annotate(distance=CosineDistance('embedding', query_embedding)) \
-                    .order_by('distance')[:25]
+                keyword_chunks, keyword_ms = keyword_future.result()
+            except Exception as e:
+                logger.warning(f"Keyword search failed for document {document.id}: {e}")
+                keyword_chunks, keyword_ms = [], 0.0
+
+        result.chunks = reciprocal_rank_fusion([result.chunks, keyword_chunks], limit=limit, k=self.rrf_k)
+        result.keyword_ms = keyword_ms
+        result.keyword_hits = len(keyword_chunks)
+        return result
 
-                rag_context = "\n\n---\n\n".join(
-                    [f"=== PAGE {c.page_number} ===\n{c.content}" for c in relevant_chunks]
+    @staticmethod
+    def _stored_chunk_count(document, queryset) -> int:
+        """
+        Chunk count of `document` for search planning, as kept in
+        rag_metrics['chunks'] by ingestion. Documents ingested before the count
+        was kept are counted once and the count is stored.
+        """
+        stored = ((document.rag_metrics or {}).get('chunks') or {}).get('stored')
+        if stored is not None:
+            return stored
+        count = queryset.count()
+        update_rag_metrics(document.id, chunks={'stored': count})
+        return count
+
+    def _vector_retrieve(self, queryset, user_query: str, limit: int, chunk_count: int | None = None) -> RetrievalResult:
+        start = time.perf_counter()
+        query_embedding = self.query_embedder.embed_query(user_query)
+        embed_ms = (time.perf_counter() - start) * 1000
+
+        # Exact scan for small documents, tuned HNSW for large ones (RAG_SEARCH_STRATEGY);
+        # RAG_VECTOR_STORAGE picks the full, halfvec or binary-quantized index (api/vector_store.py).
+        plan_start = time.perf_counter()
+        plan = plan_search(queryset, limit, chunk_count=chunk_count)
+        plan_ms = (time.perf_counter() - plan_start) * 1000
+        chunks, search_ms = search_chunks(queryset, query_embedding, limit=limit, plan=plan)
+        search_ms += plan_ms
+        return RetrievalResult(
+            chunks=chunks,
+            embed_ms=embed_ms,
+            search_ms=search_ms,
+            query_cache=self.query_embedder.last_source or '',
+            search_plan=plan.describe(),
+        )
+
+    def search_corpus(self, user_query: str, filters: dict | None = None, page: int = 1,
+                      page_size: int = 10, chunks_per_document: int = 3) -> dict:
+        """
+        Search every document indexed with the current embedding model; results
+        are grouped per document with page citations (api/corpus_search.py).
+
+        Without metadata filters the whole corpus is searched through the HNSW
+        index (counting millions of rows to plan would cost more than the search);
+        with filters the planner may pick an exact scan of the few matching chunks.
+        """
+        filters = {k: v for k, v in (filters or {}).items() if v}
+        queryset = corpus_queryset(self.embedding_model, filters)
+        candidates = candidate_count(page, page_size, chunks_per_document)
+        strategy = None if filters else 'hnsw'
+
+        start = time.perf_counter()
+        query_embedding = self.query_embedder.embed_query(user_query)
+        embed_ms = (time.perf_counter() - start) * 1000
+
+        keyword_chunks, keyword_ms = [], 0.0
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            keyword_future = (
+                pool.submit(keyword_search, queryset, user_query, candidates, True) if self.hybrid_search else None
+            )
+            plan_start = time.perf_counter()
+            plan = plan_search(queryset, candidates, strategy=strategy)
+            plan_ms = (time.perf_counter() - plan_start) * 1000
+            chunks, search_ms = search_chunks(queryset, query_embedding, limit=candidates, plan=plan)
+            search_ms += plan_ms
+            if keyword_future is not None:
+                try:
+                    keyword_chunks, keyword_ms = keyword_future.result()
+                except Exception as e:
+                    logger.warning(f"Corpus keyword search failed: {e}")
+
+        if keyword_chunks:
+            chunks = reciprocal_rank_fusion([chunks, keyword_chunks], limit=candidates, k=self.rrf_k)
+
+        group_start = time.perf_counter()
+        groups = group_by_document(chunks, chunk_document_ids([c.id for c in chunks]), chunks_per_document)
+        offset = (page - 1) * page_size
+        results = describe_groups(groups[offset:offset + page_size])
+        group_ms = (time.perf_counter() - group_start) * 1000
+
+        return {
+            'query': user_query,
+            'filters': filters,
+            'page': page,
+            'page_size': page_size,
+            'documents_found': len(groups),
+            'has_next': len(groups) > offset + page_size,
+            'candidates': len(chunks),
+            'results': results,
+            'timings': {
+                'embed_ms': round(embed_ms, 1),
+                'search_ms': round(search_ms, 1),
+                'keyword_ms': round(keyword_ms, 1),
+                'group_ms': round(group_ms, 1),
+                'keyword_hits': len(keyword_chunks),
+                'query_cache': self.query_embedder.last_source or '',
+                'search_plan': plan.describe(),
+            },
+        }
+
+    @staticmethod
+    def _format_context_chunk(chunk) -> str:
+        """Prompt block for a retrieved chunk; near-duplicate pages are listed so they can be cited."""
+        header = f"=== PAGE {chunk.page_number} ==="
+        if chunk.alias_pages:
+            others = ", ".join(str(p) for p in sorted(chunk.alias_pages))
+            header = f"=== PAGE {chunk.page_number} (nội dung tương tự ở trang {others}) ==="
+        return f"{header}\n{chunk.content}"
+
+    def _check_embedding_model(self, document) -> None:
+        """
+        Refuse to search chunks embedded by another backend: an ONNX model's
+        zero-padded vectors and mistral-embed vectors both fit the 1024-dim
+        column, but distances between the two spaces are meaningless.
+        """
+        if document.rag_embedding_model and document.rag_embedding_model != self.embedding_model:
+            raise EmbeddingModelMismatch(
+                f"Document {document.id} was embedded with {document.rag_embedding_model}, the current "
+                f"embedding backend is {self.embedding_model}; re-ingest the document"
+            )
+
+    def _structured_fields(self, document) -> tuple[str, list[StructuredField]]:
+        """Header and fields of the structured prompt block (precomputed per document)."""
+        return load_structured_summary(document)
+
+    def _prepare_chat(self, document_id: int, user_query: str, history: list | None = None) -> ChatTurn:
+        """
+        Everything before the LLM call: field router, structured block, answer
+        cache lookup, retrieval, context packing and the system prompt. When the
+        router or the answer cache answers, the turn carries the answer and no
+        prompt. Raises EmbeddingModelMismatch when the document's chunks were
+        embedded by another embedding backend.
+        """
+        document = Document.objects.get(id=document_id)
+        self._check_embedding_model(document)
+        turn = ChatTurn(document=document, user_query=user_query, history=history or [])
+
+        # 0. Câu hỏi tra cứu một trường (mã quỹ, phí, ngân hàng giám sát...): trả lời từ dữ liệu cấu trúc
+        if self.field_router:
+            try:
+                turn.routed = route_question(
+                    document,
+                    user_query,
+                    embed_query=self.query_embedder.embed_query if self.router_embeddings else None,
+                    model=self.embedding_model,
                 )
             except Exception as e:
-                logger.warning(f"RAG retrieval failed for document {document_id}: {str(e)}")
-                rag_context = ""
+                logger.warning(f"Field router failed for Doc {document_id}: {e}")
+            if turn.routed is not None:
+                record_router_outcome(turn.counters, 'routed', turn.routed.elapsed_ms)
+                logger.info(
+                    f"Field router answered Doc {document_id} from {turn.routed.summary()['fields']} "
+                    f"({turn.routed.method}, {turn.routed.elapsed_ms:.0f} ms)"
+                )
+                turn.ready_answer = turn.routed.text
+                turn.contexts = [f"{f.label}: {f.value}" for f in turn.routed.fields]
+                turn.timings = {'total_ms': round(turn.routed.elapsed_ms, 1), 'field_router': turn.routed.method}
+                return turn
+            record_router_outcome(turn.counters, 'fallthrough')
+        # History only steers retrieval through the rewritten query; the prompt gets a bounded memory.
+        turn.retrieval_query = rewrite_query(user_query, turn.history)
+
+        # 1. Dữ liệu cấu trúc: chỉ các trường liên quan tới câu hỏi, trong ngân sách token
+        context_budget_tokens = context_budget(self.chat_provider)
+        structured_header, structured_fields = self._structured_fields(document)
+        structured_budget = int(context_budget_tokens * self.structured_budget_share)
+        supplement = None
+        if self.stable_prompt_prefix:
+            # Same block for every question on this document (catalog order), so it can stay in the
+            # cached prefix; fields the question asks about that did not fit follow with the chunks.
+            prefix = pack_structured(structured_header, structured_fields, "", self.prefix_budget)
+            wanted = matching_fields(turn.retrieval_query)
+            missing = [f for f in structured_fields if f.key in wanted and f.key not in prefix.fields]
+            supplement = pack_structured("", missing, turn.retrieval_query, structured_budget) if missing else None
+            structured = prefix
+        else:
+            structured = pack_structured(
+                structured_header,
+                structured_fields,
+                turn.retrieval_query,
+                structured_budget,
+            )
+        supplement_text = supplement.text.strip() if supplement else ""
+        supplement_tokens = supplement.tokens if supplement else 0
+        structured_info = structured.text
+        turn.structured_info = f"{structured_info}\n{supplement_text}" if supplement_text else structured_info
+
+        # Cached answer for the same document version + question (+ history): no LLM call.
+        if self.answer_cache_enabled:
+            lookup_start = time.perf_counter()
+            turn.answer_cache = AnswerCache(
+                document,
+                document_answer_version(document, self.chat_model_id, self.embedding_model),
+                history=history,
+                semantic_threshold=self.answer_cache_threshold,
+                ttl_days=self.answer_cache_ttl_days,
+            )
+            if turn.answer_cache.semantic:
+                try:
+                    # Also warms the query LRU for retrieve() on a miss.
+                    turn.query_vector = self.query_embedder.embed_query(user_query)
+                except Exception as e:
+                    logger.warning(f"Answer cache: query embedding failed: {e}")
+            cached, kind = turn.answer_cache.lookup(user_query, turn.query_vector)
+            if cached is not None:
+                lookup_ms = (time.perf_counter() - lookup_start) * 1000
+                record_answer_cache_outcome(turn.counters, 'hits' if kind == 'exact' else 'semantic_hits')
+                logger.info(f"Answer cache {kind} hit for Doc {document_id} ({lookup_ms:.0f} ms)")
+                turn.cached = kind
+                turn.ready_answer = cached.answer
+                turn.contexts = cached.contexts
+                turn.timings = {'total_ms': round(lookup_ms, 1), 'answer_cache': kind}
+                return turn
+            record_answer_cache_outcome(turn.counters, 'misses')
+
+        turn.memory = build_memory(document, turn.history, self.chat_provider)
+        if turn.memory.needs_refresh:
+            refresh_summary_async(document_id, turn.history, self._summarize_history)
+
+        # 2. Vector Search (Semantic Retrieval) cho câu hỏi giải thích / chiến lược / rủi ro...
+        retrieval = RetrievalResult()
+        rag_context = ""
+        packed = PackedChunks()
+        try:
+            retrieval = self.retrieve(document, turn.retrieval_query, limit=self.retrieval_k)
+            # Most relevant, mutually distinct chunks that fit the rest of the budget
+            packed = pack_chunks(
+                retrieval.chunks,
+                # The stable prefix is evaluated once and cached, so it does not shrink the chunk budget.
+                max(context_budget_tokens - (supplement_tokens if self.stable_prompt_prefix else structured.tokens), 0),
+                self._format_context_chunk,
+                mmr_lambda=self.mmr_lambda,
+            )
+            rag_context = "\n\n---\n\n".join(
+                [self._format_context_chunk(c) for c in packed.chunks]
+            )
+            logger.info(
+                f"RAG retrieval for Doc {document_id}: {len(retrieval.chunks)} chunks, "
+                f"embed {retrieval.embed_ms:.0f} ms ({retrieval.query_cache}), search {retrieval.search_ms:.0f} ms, "
+                f"keyword {retrieval.keyword_ms:.0f} ms ({retrieval.keyword_hits} hits)"
+            )
+        except Exception as e:
+            logger.warning(f"RAG retrieval failed for document {document_id}: {str(e)}")
+            rag_context = ""
+            turn.retrieval_failed = True
+
+        # The stable prefix has its own budget (OLLAMA_PREFIX_BUDGET) and is reported apart:
+        # total_tokens is the per-turn context, which stays within budget_tokens.
+        prefix_tokens = structured.tokens if self.stable_prompt_prefix else 0
+        turn_structured_tokens = supplement_tokens if self.stable_prompt_prefix else structured.tokens
+        turn.context_usage = {
+            'budget_tokens': context_budget_tokens,
+            'structured_tokens': turn_structured_tokens,
+            'chunk_tokens': packed.tokens,
+            'total_tokens': turn_structured_tokens + packed.tokens,
+            'prefix_tokens': prefix_tokens,
+            'prefix_budget_tokens': self.prefix_budget if self.stable_prompt_prefix else 0,
+            'prompt_context_tokens': prefix_tokens + turn_structured_tokens + packed.tokens,
+            'structured_fields': structured.fields + (supplement.fields if supplement else []),
+            'stable_prefix': self.stable_prompt_prefix,
+            'chunks_retrieved': len(retrieval.chunks),
+            'chunks_used': len(packed.chunks),
+            'chunks_dropped_duplicate': packed.dropped_duplicates,
+            'chunks_dropped_budget': packed.dropped_budget,
+            'retrieval_query_rewritten': turn.retrieval_query != user_query,
+            **turn.memory.usage(),
+        }
+        logger.info(
+            f"RAG context for Doc {document_id}: ~{turn.context_usage['total_tokens']}/{context_budget_tokens} tokens "
+            f"(+{prefix_tokens} prefix; {len(structured.fields)} fields, {len(packed.chunks)}/{len(retrieval.chunks)} chunks)"
+        )
+        turn.chunks = packed.chunks
+        turn.contexts = [c.content for c in packed.chunks]
+        turn.timings = retrieval.timings()
+
+        # Ingestion still running: answer over the pages indexed so far, but say so.
+        coverage_rule = ""
+        turn.is_partial = document.rag_status != 'completed' and document.rag_coverage < 1.0
+        if turn.is_partial:
+            coverage_rule = (
+                f"\n6. LƯU Ý: Tài liệu đang được lập chỉ mục, mới có {document.rag_pages_indexed}/"
+                f"{document.rag_pages_total} trang ({document.rag_coverage:.0%}) trong NGUỒN 2. "
+                "Nếu không tìm thấy thông tin, hãy nói rõ là tài liệu chưa được xử lý xong "
+                "(có thể hỏi lại sau) thay vì khẳng định tài liệu không có thông tin đó."
+            )
 
-            # 3. Tổng hợp Prompt: dùng cả JSON + Vector
-            system_prompt = f"""
+        # 3. Tổng hợp Prompt: dùng cả JSON + Vector
+        intro = """
 Bạn là trợ lý phân tích tài chính thông minh chuyên về Quỹ đầu tư.
 
 HÃY SỬ DỤNG CẢ HAI NGUỒN THÔNG TIN SAU ĐỂ TRẢ LỜI:
-
-NGUỒN 1: DỮ LIỆU CẤU TRÚC (ƯU TIÊN dùng cho câu hỏi về Phí, Tên, Mã số, Ngân hàng, Công ty quản lý)
-{structured_info}
-
-NGUỒN 2: TRÍCH ĐOẠN VĂN BẢN CHI TIẾT (dùng cho câu hỏi giải thích, chiến lược, rủi ro, điều khoản...)
-{rag_context}
-
+""".strip()
+        source_1 = f"NGUỒN 1: DỮ LIỆU CẤU TRÚC (ƯU TIÊN dùng cho câu hỏi về Phí, Tên, Mã số, Ngân hàng, Công ty quản lý)\n{structured_info}"
+        source_2 = f"NGUỒN 2: TRÍCH ĐOẠN VĂN BẢN CHI TIẾT (dùng cho câu hỏi giải thích, chiến lược, rủi ro, điều khoản...)\n{rag_context}"
+        rules = """
 QUY TẮC:
 1. Nếu người dùng hỏi về Phí hoặc Số liệu cụ thể, hãy kiểm tra NGUỒN 1 trước.
 2. Nếu NGUỒN 1 không có / không đủ, hãy dùng NGUỒN 2.
@@ -2582,73 +3327,263 @@ Luôn bao gồm các điều kiện đi kèm nếu có (ví dụ: phí áp dụn
 4. Cuối mỗi câu trả lời, hãy ghi rõ thông tin này được lấy từ trang mấy (ví dụ: Nguồn: Trang 5)
 5. Nếu không tìm thấy thông tin từ cả hai nguồn, hãy nói: "Tôi không tìm thấy thông tin đó trong tài liệu."
 """.strip()
-            
-            # Generate response based on provider
-            response_text = ""
-            
-            if self.chat_provider == 'ollama':
-                # Use Ollama API (OpenAI-compatible)
-                messages = [{"role": "system", "content": system_prompt}]
-                if history:
-                    for h in history:
-                        role = "user" if h.get('sender') == 'user' else "assistant"
-                        messages.append({"role": role, "content": h.get('text', '')})
-                messages.append({"role": "user", "content": f"CÂU HỎI: {user_query}"})
-                
-                try:
-                    response = requests.post(
-                        f"{self.ollama_base_url}/api/chat",
-                        json={
-                            "model": self.ollama_model,
-                            "messages": messages,
-                            "stream": False,
-                            "options": {"temperature": 0}
-                        },
-                        timeout=60
-                    )
-                    response.raise_for_status()
-                    response_text = response.json().get('message', {}).get('content', '')
-                except Exception as ollama_error:
-                    logger.error(f"Ollama API error: {ollama_error}")
-                    raise
-                    
-            elif self.chat_provider == 'mistral':
-                # Use Mistral API
-                messages = [{"role": "system", "content": system_prompt}]
-                if history:
-                    for h in history:
-                        role = "user" if h.get('sender') == 'user' else "assistant"
-                        messages.append({"role": role, "content": h.get('text', '')})
-                messages.append({"role": "user", "content": f"CÂU HỎI: {user_query}"})
-                
-                chat_response = self.mistral_client.chat.complete(
-                    model=self.mistral_chat_model,
-                    messages=messages,
-                    temperature=0
+        earlier_conversation = turn.memory.render()
+        memory_block = (
+            "TÓM TẮT HỘI THOẠI TRƯỚC ĐÓ (chỉ để hiểu ngữ cảnh câu hỏi, không phải nguồn thông tin):\n"
+            f"{earlier_conversation}"
+        ) if earlier_conversation else ""
+
+        if self.stable_prompt_prefix:
+            # Prefix identical on every turn of this document; everything query-specific goes last.
+            system_prompt = "\n\n".join([intro, rules + "\nNGUỒN 2 được gửi kèm từng câu hỏi.", source_1])
+            parts = []
+            if supplement_text:
+                parts.append(f"NGUỒN 1 (BỔ SUNG CHO CÂU HỎI NÀY):\n{supplement_text}")
+            parts.append(source_2)
+            if coverage_rule:
+                parts.append(coverage_rule.strip())
+            if memory_block:
+                parts.append(memory_block)
+            turn.turn_context = "\n\n".join(parts)
+        else:
+            system_prompt = "\n\n".join([intro, source_1, source_2, rules + coverage_rule])
+            if memory_block:
+                system_prompt += f"\n\n{memory_block}"
+        turn.system_prompt = system_prompt
+        return turn
+
+    @staticmethod
+    def _prompt_history(turn: ChatTurn) -> list:
+        """Messages replayed verbatim: the bounded recent turns, never the whole conversation."""
+        return turn.memory.recent if turn.memory is not None else turn.history
+
+    def _chat_messages(self, turn: ChatTurn) -> list[dict]:
+        """OpenAI-style messages (Ollama / Mistral): system prompt, recent history, question."""
+        messages = [{"role": "system", "content": turn.system_prompt}]
+        for h in self._prompt_history(turn):
+            role = "user" if h.get('sender') == 'user' else "assistant"
+            messages.append({"role": role, "content": h.get('text', '')})
+        question = f"CÂU HỎI: {turn.user_query}"
+        if turn.turn_context:
+            question = f"{turn.turn_context}\n\n{question}"
+        messages.append({"role": "user", "content": question})
+        return messages
+
+    def _record_ollama_stats(self, turn: ChatTurn, payload: dict) -> None:
+        """Prompt evaluation vs generation time of an Ollama turn, into the turn timings."""
+        stats = ollama.generation_stats(payload)
+        if not stats:
+            return
+        turn.timings = {**turn.timings, 'ollama': stats}
+        logger.info(
+            f"Ollama turn for Doc {turn.document.id}: load {stats['load_ms']:.0f} ms, prompt eval "
+            f"{stats['prompt_eval_ms']:.0f} ms ({stats['prompt_tokens']} tokens), generation "
+            f"{stats['eval_ms']:.0f} ms ({stats['eval_tokens']} tokens, {stats['tokens_per_s']} tok/s)"
+        )
+
+    def _gemini_session(self, turn: ChatTurn):
+        chat_history = []
+        for h in self._prompt_history(turn):
+            role = "user" if h.get('sender') == 'user' else "model"
+            chat_history.append({"role": role, "parts": [h.get('text', '')]})
+        return self.chat_model.start_chat(history=chat_history)
+
+    def _generate(self, turn: ChatTurn) -> str:
+        """Complete answer from the configured provider."""
+        if self.chat_provider == 'ollama':
+            try:
+                response = requests.post(
+                    f"{self.ollama_base_url}/api/chat",
+                    json={
+                        "model": self.ollama_model,
+                        "messages": self._chat_messages(turn),
+                        "stream": False,
+                        "keep_alive": ollama.keep_alive(),
+                        "options": ollama.model_options()
+                    },
+                    timeout=ollama.request_timeout()
                 )
-                response_text = chat_response.choices[0].message.content
-                
-            else:  # gemini
-                # Prepare chat history for Gemini
-                chat_history = []
-                if history:
-                    for h in history:
-                        role = "user" if h.get('sender') == 'user' else "model"
-                        chat_history.append({"role": role, "parts": [h.get('text', '')]})
-
-                # Start chat session
-                chat = self.chat_model.start_chat(history=chat_history)
-                response = chat.send_message(f"{system_prompt}\n\nCÂU HỎI: {user_query}")
-                response_text = response.text
-            
+                response.raise_for_status()
+                payload = response.json()
+                self._record_ollama_stats(turn, payload)
+                return payload.get('message', {}).get('content', '')
+            except Exception as ollama_error:
+                logger.error(f"Ollama API error: {ollama_error}")
+                raise
+
+        if self.chat_provider == 'mistral':
+            chat_response = self.mistral_client.chat.complete(
+                model=self.mistral_chat_model,
+                messages=self._chat_messages(turn),
+                temperature=0
+            )
+            return chat_response.choices[0].message.content
+
+        # gemini
+        chat = self._gemini_session(turn)
+        response = chat.send_message(f"{turn.system_prompt}\n\nCÂU HỎI: {turn.user_query}")
+        return response.text
+
+    def _generate_stream(self, turn: ChatTurn):
+        """Yield answer text deltas from the configured provider as they arrive."""
+        if self.chat_provider == 'ollama':
+            # Streamed NDJSON: one {"message": {"content": ...}, "done": false} object per line.
+            with requests.post(
+                f"{self.ollama_base_url}/api/chat",
+                json={
+                    "model": self.ollama_model,
+                    "messages": self._chat_messages(turn),
+                    "stream": True,
+                    "keep_alive": ollama.keep_alive(),
+                    "options": ollama.model_options()
+                },
+                stream=True,
+                timeout=ollama.request_timeout(),
+            ) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    payload = json.loads(line)
+                    if payload.get('error'):
+                        raise RuntimeError(f"Ollama API error: {payload['error']}")
+                    delta = payload.get('message', {}).get('content', '')
+                    if delta:
+                        yield delta
+                    if payload.get('done'):
+                        # The final object carries the load / prompt eval / eval durations.
+                        self._record_ollama_stats(turn, payload)
+                        break
+            return
+
+        if self.chat_provider == 'mistral':
+            stream = self.mistral_client.chat.stream(
+                model=self.mistral_chat_model,
+                messages=self._chat_messages(turn),
+                temperature=0,
+            )
+            with stream as events:
+                for event in events:
+                    choices = event.data.choices
+                    delta = choices[0].delta.content if choices else None
+                    if delta:
+                        yield delta
+            return
+
+        # gemini
+        chat = self._gemini_session(turn)
+        response = chat.send_message(f"{turn.system_prompt}\n\nCÂU HỎI: {turn.user_query}", stream=True)
+        for chunk in response:
+            try:
+                delta = chunk.text
+            except ValueError:
+                # Chunks without text parts (e.g. safety/finish metadata)
+                continue
+            if delta:
+                yield delta
+
+    def _summarize_history(self, previous_summary: str, transcript: str) -> str:
+        """Rolling summary of older chat turns (runs in a background thread, see conversation_memory)."""
+        instructions = (
+            "Tóm tắt ngắn gọn cuộc hội thoại giữa người dùng và trợ lý về một bản cáo bạch quỹ đầu tư. "
+            "Giữ lại các chủ đề đã hỏi, các con số/kết luận quan trọng và số trang được trích dẫn. "
+            "Viết bằng tiếng Việt, tối đa 150 từ, không thêm thông tin mới."
+        )
+        content = f"TÓM TẮT HIỆN CÓ:\n{previous_summary or '(chưa có)'}\n\nHỘI THOẠI CẦN BỔ SUNG:\n{transcript}"
+
+        if self.chat_provider == 'ollama':
+            response = requests.post(
+                f"{self.ollama_base_url}/api/chat",
+                json={
+                    "model": self.ollama_model,
+                    "messages": [
+                        {"role": "system", "content": instructions},
+                        {"role": "user", "content": content},
+                    ],
+                    "stream": False,
+                    "keep_alive": ollama.keep_alive(),
+                    "options": ollama.model_options()
+                },
+                timeout=ollama.request_timeout()
+            )
+            response.raise_for_status()
+            return response.json().get('message', {}).get('content', '')
+
+        if self.chat_provider == 'mistral':
+            chat_response = self.mistral_client.chat.complete(
+                model=self.mistral_chat_model,
+                messages=[
+                    {"role": "system", "content": instructions},
+                    {"role": "user", "content": content},
+                ],
+                temperature=0
+            )
+            return chat_response.choices[0].message.content
+
+        # gemini
+        return self.chat_model.generate_content(f"{instructions}\n\n{content}").text
+
+    def _finish_chat(self, turn: ChatTurn, response_text: str) -> None:
+        # Answers over a partial index or without retrieval would go stale/wrong; don't keep them.
+        answer_cache = turn.answer_cache
+        if answer_cache is not None and response_text and not turn.is_partial and not turn.retrieval_failed:
+            query_vector = turn.query_vector
+            if query_vector is None and answer_cache.semantic:
+                # Same vector retrieve() just used (query LRU), kept for paraphrase matching.
+                try:
+                    query_vector = self.query_embedder.embed_query(turn.user_query)
+                except Exception as e:
+                    logger.warning(f"Answer cache: query embedding failed, storing without it: {e}")
+            answer_cache.store(turn.user_query, response_text, turn.contexts, query_vector)
+            record_answer_cache_outcome(turn.counters, 'stores')
+
+    @staticmethod
+    def _chat_result(turn: ChatTurn, text: str) -> dict:
+        result = {
+            "text": text,
+            "contexts": turn.contexts,
+            "structured_data_used": turn.structured_info,
+            "rag_coverage": turn.document.rag_coverage,
+            "timings": turn.timings,
+        }
+        if turn.routed:
+            result["routed"] = turn.routed.summary()
+            result["sources"] = turn.routed.sources()
+        elif turn.cached:
+            result["cached"] = turn.cached
+        else:
+            result["context_usage"] = turn.context_usage
+        return result
+
+    def chat(self, document_id: int, user_query: str, history: list = None, return_source=False, **kwargs) -> dict|str:
+        """
+        Answer a user question using RAG.
+
+        Raises EmbeddingModelMismatch when the document's chunks were embedded by
+        another embedding backend.
+        """
+        try:
+            # Backwards compatibility: some callers might use `return_sources` (plural).
+            if "return_sources" in kwargs and kwargs["return_sources"] is True:
+                return_source = True
+
+            start = time.perf_counter()
+            turn = self._prepare_chat(document_id, user_query, history)
+            if turn.answered:
+                response_text = turn.ready_answer
+            else:
+                response_text = self._generate(turn)
+                self._finish_chat(turn, response_text)
+                if self.field_router:
+                    record_router_outcome(turn.counters, 'generated', (time.perf_counter() - start) * 1000)
+            flush_counters(document_id, turn.counters)
+
             if return_source:
-                return {
-                    "text": response_text,
-                    "contexts": [c.content for c in retrieved_chunks],
-                    "structured_data_used": structured_info
-                }
+                return self._chat_result(turn, response_text)
             return response_text
 
+        except EmbeddingModelMismatch:
+            raise
         except Exception as e:
             logger.error(f"RAG Chat Error: {str(e)}")
             if return_source:
@@ -2660,6 +3595,56 @@ Luôn bao gồm các điều kiện đi kèm nếu có (ví dụ: phí áp dụn
                 }
             return "Xin lỗi, tôi gặp sự cố khi xử lý câu hỏi."
 
+    def chat_stream(self, document_id: int, user_query: str, history: list = None):
+        """
+        Streaming variant of `chat`: yields ('token', {'text': delta}) events while
+        the provider generates, then one ('done', result) event with the full text,
+        sources and timings (same keys as `chat(..., return_source=True)`), or
+        ('error', {...}) if the turn fails.
+        """
+        start = time.perf_counter()
+        parts: list[str] = []
+        try:
+            turn = self._prepare_chat(document_id, user_query, history)
+            if turn.answered:
+                flush_counters(document_id, turn.counters)
+                yield 'token', {'text': turn.ready_answer}
+                yield 'done', self._chat_result(turn, turn.ready_answer)
+                return
+
+            prepare_ms = (time.perf_counter() - start) * 1000
+            first_token_ms = None
+            generation_start = time.perf_counter()
+            for delta in self._generate_stream(turn):
+                if first_token_ms is None:
+                    first_token_ms = (time.perf_counter() - start) * 1000
+                parts.append(delta)
+                yield 'token', {'text': delta}
+
+            response_text = "".join(parts)
+            self._finish_chat(turn, response_text)
+            if self.field_router:
+                record_router_outcome(turn.counters, 'generated', (time.perf_counter() - start) * 1000)
+            flush_counters(document_id, turn.counters)
+            result = self._chat_result(turn, response_text)
+            result["timings"] = {
+                **turn.timings,
+                'prepare_ms': round(prepare_ms, 1),
+                'first_token_ms': round(first_token_ms, 1) if first_token_ms is not None else None,
+                'generation_ms': round((time.perf_counter() - generation_start) * 1000, 1),
+            }
+            result["sources"] = [
+                {'page': c.page_number, 'alias_pages': list(c.alias_pages or [])} for c in turn.chunks
+            ]
+            yield 'done', result
+
+        except Exception as e:
+            logger.error(f"RAG Chat stream error: {str(e)}")
+            yield 'error', {
+                "text": "".join(parts) or "Xin lỗi, tôi gặp sự cố khi xử lý câu hỏi.",
+                "error": str(e),
+            }
+
     def _extract_content_for_rag(self, document) -> str:
         """
         Helper to get raw text for RAG with page markers.
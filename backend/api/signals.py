@@ -0,0 +1,36 @@
+"""
+Model signal handlers (connected in ApiConfig.ready).
+
+The structured prompt block stored on Document.structured_summary is read by
+chat without looking at its sources, so every save of those sources clears
+it; the next chat turn rebuilds it (api/structured_summary.py).
+"""
+import logging
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Document, ExtractedFundData
+from .structured_summary import invalidate_structured_summary
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=Document)
+def clear_structured_summary_on_document_save(sender, instance, created=False, update_fields=None, **kwargs):
+    # Status, progress and chat history saves name their fields and leave the summary alone.
+    if created or (update_fields is not None and 'extracted_data' not in update_fields):
+        return
+    try:
+        invalidate_structured_summary(instance)
+    except Exception as e:
+        logger.warning(f"Failed to clear structured summary of document {instance.id}: {e}")
+
+
+@receiver(post_save, sender=ExtractedFundData)
+@receiver(post_delete, sender=ExtractedFundData)
+def clear_structured_summary_on_fund_data_change(sender, instance, **kwargs):
+    try:
+        invalidate_structured_summary(instance.document_id)
+    except Exception as e:
+        logger.warning(f"Failed to clear structured summary of document {instance.document_id}: {e}")
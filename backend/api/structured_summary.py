@@ -0,0 +1,203 @@
+"""
+Precomputed structured block of the chat prompt.
+
+Rendering the structured fields (ExtractedFundData lookup, truncation, JSON
+dumps of the portfolio) used to happen on every chat turn. The field list and
+its rendered text are now stored on Document.structured_summary when
+extraction or an edit completes, with a content digest in
+Document.structured_summary_version; chat reads them from the already loaded
+Document row without checking the sources again.
+
+The stored summary is therefore cleared on every write to its sources:
+`views.update` clears it when extracted_data changes and rebuilds it after
+ExtractedFundData is re-synced, extraction rebuilds it when it finishes, and
+the post_save/post_delete handlers in api/signals.py clear it for any other
+save of Document.extracted_data or ExtractedFundData (admin, shell, scripts).
+Queryset `.update()` calls bypass the signals and must call
+`invalidate_structured_summary` themselves.
+"""
+import hashlib
+import json
+import logging
+
+from django.utils import timezone
+
+from .context_packer import StructuredField
+from .models import Document, ExtractedFundData
+
+logger = logging.getLogger(__name__)
+
+# Bump when the rendering below changes, so stored summaries are rebuilt.
+STRUCTURED_SUMMARY_FORMAT = 1
+
+
+def build_structured_fields(document) -> tuple[str, list[StructuredField]]:
+    """
+    Header and fields of the structured block of the chat prompt, from
+    ExtractedFundData when it exists, otherwise from Document.extracted_data.
+    """
+    def get_value(field_data):
+        if isinstance(field_data, dict) and 'value' in field_data:
+            return field_data['value']
+        return field_data
+
+    def safe_text(val, max_len: int = 1200) -> str:
+        if val is None:
+            return "Không có"
+        if isinstance(val, (dict, list)):
+            try:
+                val = json.dumps(val, ensure_ascii=False)
+            except Exception:
+                val = str(val)
+        val = str(val)
+        val = val.strip()
+        if not val:
+            return "Không có"
+        return val if len(val) <= max_len else (val[:max_len] + " …")
+
+    extracted_data = document.extracted_data or {}
+    minimum_investment = extracted_data.get('minimum_investment')
+    investment_objective = extracted_data.get('investment_objective')
+    asset_allocation = extracted_data.get('asset_allocation')
+    inception_date = extracted_data.get('inception_date')
+    effective_date = extracted_data.get('effective_date')
+
+    common_tail = [
+        ('minimum_investment', "Số tiền đầu tư tối thiểu (ban đầu / bổ sung)",
+         json.dumps(minimum_investment or {}, ensure_ascii=False)),
+        ('asset_allocation', "Cơ cấu phân bổ tài sản", json.dumps(asset_allocation or {}, ensure_ascii=False)),
+    ]
+
+    try:
+        fund_data = ExtractedFundData.objects.get(document_id=document.id)
+    except ExtractedFundData.DoesNotExist:
+        fund_data = None
+
+    if fund_data is not None:
+        header = "THÔNG TIN CƠ BẢN ĐÃ ĐƯỢC TRÍCH XUẤT (ƯU TIÊN DÙNG CHO CÂU HỎI VỀ PHÍ / TÊN / MÃ / NGÂN HÀNG):"
+        rows = [
+            ('fund_name', "Tên quỹ", fund_data.fund_name),
+            ('fund_code', "Mã quỹ", fund_data.fund_code),
+            ('fund_type', "Loại quỹ (fund_type)", safe_text(fund_data.fund_type, 300)),
+            ('legal_structure', "Cấu trúc pháp lý (legal_structure)", safe_text(fund_data.legal_structure, 300)),
+            ('license_number', "Số giấy phép (license_number)", safe_text(fund_data.license_number, 300)),
+            ('regulator', "Cơ quan quản lý (regulator)", safe_text(fund_data.regulator, 300)),
+            ('management_company', "Công ty quản lý", fund_data.management_company),
+            ('custodian_bank', "Ngân hàng giám sát", fund_data.custodian_bank),
+            ('fund_supervisor', "Người/đơn vị giám sát quỹ (fund_supervisor)", safe_text(fund_data.fund_supervisor, 300)),
+            ('auditor', "Kiểm toán (auditor)", safe_text(fund_data.auditor, 300)),
+            ('management_fee', "Phí quản lý", fund_data.management_fee),
+            ('subscription_fee', "Phí phát hành (mua)", fund_data.subscription_fee),
+            ('redemption_fee', "Phí mua lại (bán)", fund_data.redemption_fee),
+            ('switching_fee', "Phí chuyển đổi", fund_data.switching_fee),
+            ('total_expense_ratio', "Tổng chi phí (TER)", safe_text(fund_data.total_expense_ratio, 300)),
+            ('custody_fee', "Phí lưu ký", safe_text(fund_data.custody_fee, 300)),
+            ('audit_fee', "Phí kiểm toán", safe_text(fund_data.audit_fee, 300)),
+            ('supervisory_fee', "Phí giám sát", safe_text(fund_data.supervisory_fee, 300)),
+            ('other_expenses', "Chi phí khác", safe_text(fund_data.other_expenses, 600)),
+            ('inception_date', "Ngày thành lập/quỹ bắt đầu hoạt động (inception_date)", inception_date or 'Không có'),
+            ('effective_date', "Ngày hiệu lực (effective_date)", effective_date or 'Không có'),
+            ('investment_objective', "Mục tiêu đầu tư", investment_objective or 'Không có'),
+            ('investment_strategy', "Chiến lược đầu tư", safe_text(fund_data.investment_strategy, 900)),
+            ('investment_style', "Phong cách đầu tư", safe_text(fund_data.investment_style, 200)),
+            ('sector_focus', "Ngành/nhóm tài sản trọng tâm", safe_text(fund_data.sector_focus, 600)),
+            ('benchmark', "Benchmark", safe_text(fund_data.benchmark, 300)),
+            ('investment_restrictions', "Hạn chế đầu tư", safe_text(fund_data.investment_restrictions, 900)),
+            ('borrowing_limit', "Giới hạn vay (borrowing_limit)", safe_text(fund_data.borrowing_limit, 300)),
+            ('leverage_limit', "Giới hạn đòn bẩy (leverage_limit)", safe_text(fund_data.leverage_limit, 300)),
+            ('trading_frequency', "Thông tin giao dịch (trading_frequency)", safe_text(fund_data.trading_frequency, 300)),
+            ('cut_off_time', "Cut-off time", safe_text(fund_data.cut_off_time, 300)),
+            ('nav_calculation_frequency', "Tần suất tính NAV", safe_text(fund_data.nav_calculation_frequency, 300)),
+            ('nav_publication', "Công bố NAV", safe_text(fund_data.nav_publication, 300)),
+            ('settlement_cycle', "Chu kỳ thanh toán (settlement_cycle)", safe_text(fund_data.settlement_cycle, 300)),
+            ('valuation_method', "Phương pháp định giá", safe_text(fund_data.valuation_method, 900)),
+            ('pricing_source', "Nguồn giá", safe_text(fund_data.pricing_source, 900)),
+            ('investor_rights', "Quyền nhà đầu tư", safe_text(fund_data.investor_rights, 900)),
+            ('distribution_agent', "Đại lý phân phối", safe_text(fund_data.distribution_agent, 400)),
+            ('sales_channels', "Kênh phân phối", safe_text(fund_data.sales_channels, 600)),
+            ('concentration_risk', "Rủi ro tập trung", safe_text(fund_data.concentration_risk, 700)),
+            ('liquidity_risk', "Rủi ro thanh khoản", safe_text(fund_data.liquidity_risk, 700)),
+            ('interest_rate_risk', "Rủi ro lãi suất", safe_text(fund_data.interest_rate_risk, 700)),
+            *common_tail,
+            ('portfolio', "Danh mục đầu tư (trích xuất)", json.dumps(fund_data.portfolio or [], ensure_ascii=False)),
+        ]
+    else:
+        header = "THÔNG TIN CƠ BẢN ĐÃ ĐƯỢC TRÍCH XUẤT (từ Document.extracted_data):"
+        rows = [
+            ('inception_date', "Ngày thành lập/quỹ bắt đầu hoạt động (inception_date)", inception_date or 'Không có'),
+            ('effective_date', "Ngày hiệu lực (effective_date)", effective_date or 'Không có'),
+            ('investment_objective', "Mục tiêu đầu tư", investment_objective or 'Không có'),
+            ('investment_strategy', "Chiến lược đầu tư",
+             safe_text(get_value(extracted_data.get('investment_strategy')), 900)),
+            ('fees', "Phí (fees)", safe_text(extracted_data.get('fees') or {}, 900)),
+            ('operational_details', "Thông tin giao dịch (operational_details)",
+             safe_text(extracted_data.get('operational_details') or {}, 900)),
+            ('valuation', "Định giá (valuation)", safe_text(extracted_data.get('valuation') or {}, 900)),
+            ('investment_restrictions', "Hạn chế/giới hạn đầu tư", safe_text(
+                get_value(extracted_data.get('investment_restrictions'))
+                or get_value(extracted_data.get('borrowing_limit'))
+                or get_value(extracted_data.get('leverage_limit')), 900)),
+            ('investor_rights', "Quyền NĐT / Phân phối", safe_text(
+                get_value(extracted_data.get('investor_rights'))
+                or get_value(extracted_data.get('distribution_agent'))
+                or get_value(extracted_data.get('sales_channels')), 900)),
+            ('risk_factors', "Rủi ro (risk_factors)", safe_text(extracted_data.get('risk_factors') or {}, 900)),
+            *common_tail,
+        ]
+
+    return header, [StructuredField(key, label, str(value)) for key, label, value in rows]
+
+
+def render_structured_summary(header: str, fields: list[StructuredField]) -> str:
+    return "\n".join([header] + [f.render() for f in fields])
+
+
+def refresh_structured_summary(document) -> dict:
+    """Rebuild and store the structured summary of `document` (a Document or its id)."""
+    if not isinstance(document, Document):
+        document = Document.objects.get(id=document)
+    header, fields = build_structured_fields(document)
+    summary = {
+        'format': STRUCTURED_SUMMARY_FORMAT,
+        'header': header,
+        'fields': [{'key': f.key, 'label': f.label, 'value': f.value} for f in fields],
+        'text': render_structured_summary(header, fields),
+        'built_at': timezone.now().isoformat(),
+    }
+    digest_source = json.dumps([header, summary['fields']], ensure_ascii=False, sort_keys=True)
+    version = hashlib.sha256(digest_source.encode('utf-8')).hexdigest()[:16]
+    Document.objects.filter(id=document.id).update(
+        structured_summary=summary,
+        structured_summary_version=version,
+    )
+    document.structured_summary = summary
+    document.structured_summary_version = version
+    return summary
+
+
+def invalidate_structured_summary(document) -> None:
+    """
+    Clear the stored summary of `document` (a Document or its id): on the row,
+    and on a loaded instance, which may be saved later.
+    """
+    if isinstance(document, Document):
+        document.structured_summary = {}
+        document.structured_summary_version = ''
+        document = document.id
+    Document.objects.filter(id=document).update(structured_summary={}, structured_summary_version='')
+
+
+def load_structured_summary(document) -> tuple[str, list[StructuredField]]:
+    """
+    Stored header and fields of `document`; built (and stored) on a miss, e.g.
+    for documents extracted before summaries existed or after an invalidation.
+    """
+    summary = document.structured_summary or {}
+    if summary.get('format') != STRUCTURED_SUMMARY_FORMAT or 'fields' not in summary:
+        try:
+            summary = refresh_structured_summary(document)
+        except Exception as e:
+            logger.warning(f"Failed to store structured summary for document {document.id}: {e}")
+            return build_structured_fields(document)
+    fields = [StructuredField(f['key'], f['label'], f['value']) for f in summary['fields']]
+    return summary['header'], fields
@@ -1,3 +1,1236 @@
-from django.test import TestCase
+import hashlib
+import importlib.util
+import itertools
+import struct
+import tempfile
+import unicodedata
+from io import StringIO
+from pathlib import Path
+from datetime import datetime, timezone as dt_timezone
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.core.management.base import CommandError
+from django.db.models.signals import post_delete, post_save
+from django.test import SimpleTestCase
+from rest_framework.test import APIClient
+
+from . import signals, vector_store
+from .answer_cache import answer_cache_stats, history_digest, record_answer_cache_outcome
+from .chat_counters import chat_metrics
+from .chunking import NearDuplicateFilter, format_chunk_content, iter_markdown_chunks, iter_page_sections
+from .conversation_memory import MEMORY_FORMAT, build_memory, rewrite_query
+from .corpus_search import candidate_count, corpus_queryset, group_by_document
+from .context_packer import StructuredField, match_field_keywords, matching_fields, pack_chunks, pack_structured
+from .field_router import is_lookup_question, match_fields, record_router_outcome, route_question, router_stats
+from .eval_cases import load_test_cases
+from .embeddings import (
+    EMBEDDING_DIMENSIONS,
+    CachedEmbedder,
+    CachedQueryEmbedder,
+    EmbeddingBackend,
+    EmbeddingModelMismatch,
+    OnnxEmbeddingBackend,
+    embedding_text_hash,
+    get_embedding_backend,
+    normalize_query_text,
+    query_cache_stats,
+)
+from .management.commands.benchmark_retrieval import Command as BenchmarkRetrievalCommand, fact_terms, lexical_recall
+from .management.commands.run_rag_eval import Command as RunRagEvalCommand, parse_grid
+from .models import Document, ExtractedFundData
+from .ollama import generation_stats, preload_on_startup
+from .services import ChatTurn, RAGService
+from .structured_summary import STRUCTURED_SUMMARY_FORMAT, load_structured_summary
+from .text_cleaning import collapse_repeated_phrases, strip_running_headers_footers
+from .text_normalize import fold_words, remove_vietnamese_diacritics
+from .vector_store import MAX_EF_SEARCH, plan_search
+from .views import DocumentViewSet
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+    def test_hash_ignores_whitespace_and_unicode_form(self):
+        composed = "Phí quản lý  1,5%/năm\n"
+        decomposed = "Phí quản lý 1,5%/năm"
+        self.assertEqual(embedding_text_hash(composed), embedding_text_hash(decomposed))
+        self.assertNotEqual(embedding_text_hash(composed), embedding_text_hash("Phí quản lý 2%/năm"))
+
+    def test_only_uncached_texts_are_embedded_once(self):
+        embed_fn = mock.Mock(side_effect=lambda texts: [[float(len(t))] for t in texts])
+        embedder = CachedEmbedder(embed_fn, 'mistral-embed')
+        cached = {embedding_text_hash('cached'): [9.0]}
+        with mock.patch.object(CachedEmbedder, 'lookup', return_value=cached), \
+                mock.patch.object(CachedEmbedder, 'store') as store:
+            vectors = embedder.embed(['cached', 'new text', 'new text'])
+        embed_fn.assert_called_once_with(['new text'])
+        self.assertEqual(vectors, [[9.0], [8.0], [8.0]])
+        store.assert_called_once_with({embedding_text_hash('new text'): [8.0]})
+        self.assertEqual(embedder.stats()['hits'], 2)
+        self.assertEqual(embedder.stats()['misses'], 1)
+        self.assertEqual(embedder.stats()['api_calls'], 1)
+
+    def test_disabled_cache_embeds_everything(self):
+        embed_fn = mock.Mock(return_value=[[1.0], [2.0]])
+        embedder = CachedEmbedder(embed_fn, 'mistral-embed', enabled=False)
+        with mock.patch.object(CachedEmbedder, 'lookup') as lookup:
+            self.assertEqual(embedder.embed(['a', 'b']), [[1.0], [2.0]])
+        lookup.assert_not_called()
+        self.assertEqual(embedder.stats()['misses'], 2)
+
+
+def _plan_item(text: str, page: int) -> dict:
+    return {'page_number': page, 'content': text, 'embed_text': text, 'content_hash': embedding_text_hash(text)}
+
+
+class IncrementalIngestTests(SimpleTestCase):
+    def test_only_changed_chunks_are_written(self):
+        document = mock.Mock(id=7)
+        document.chunks.values_list.return_value = [
+            (1, embedding_text_hash('giữ nguyên'), 1, []),
+            (2, embedding_text_hash('chuyển trang'), 2, []),
+            (3, embedding_text_hash('đã xóa'), 3, []),
+        ]
+        plan = [_plan_item('giữ nguyên', 1), _plan_item('chuyển trang', 5), _plan_item('mới', 6)]
+        service = RAGService.__new__(RAGService)
+        embed = mock.Mock(side_effect=lambda document_id, items, *args: iter([(items, [[0.1]] * len(items))]))
+        with mock.patch.object(RAGService, '_embed_chunk_plan', embed), \
+                mock.patch('api.services.DocumentChunk') as chunk_model, \
+                mock.patch('api.services.transaction'), \
+                mock.patch('api.services.close_old_connections'), \
+                mock.patch('api.services.save_document_chunks'), \
+                mock.patch('api.services.update_rag_metrics') as metrics:
+            service._ingest_incremental(document, plan, None)
+        self.assertEqual([item['embed_text'] for item in embed.call_args.args[1]], ['mới'])
+        chunk_model.objects.filter.assert_called_once_with(id__in=[3])
+        metrics.assert_called_once_with(
+            7, incremental={'unchanged': 1, 'moved': 1, 'inserted': 1, 'deleted': 1}, chunks={'stored': 3},
+        )
+
+
+class ResumableIngestTests(SimpleTestCase):
+    def setUp(self):
+        self.service = RAGService.__new__(RAGService)
+        self.service.chunk_size, self.service.chunk_overlap = 800, 100
+        self.service.embedder = mock.Mock()
+        self.service.embedder.stats.return_value = {'hits': 0, 'misses': 0, 'hit_rate': 0.0, 'api_calls': 0}
+        self.service.embedding_model = 'mistral-embed-2312'
+        self.document = mock.Mock(id=7, rag_embedding_model='mistral-embed-2312')
+        self.document.chunks.exists.return_value = False
+        self.checkpoint = mock.Mock(stage='extracted', mode='full', completed_batches=0, total_batches=0)
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        patches = [
+            mock.patch('api.services.Document'),
+            mock.patch('api.services.RagIngestionCheckpoint'),
+            mock.patch('api.services.settings', MEDIA_ROOT=media_root.name),
+            mock.patch('api.services.update_rag_metrics'),
+            mock.patch.object(RAGService, '_clean_text_for_rag', side_effect=lambda text, document_id=None: text),
+        ]
+        mocks = [p.start() for p in patches]
+        for p in patches:
+            self.addCleanup(p.stop)
+        document_model, checkpoint_model = mocks[0], mocks[1]
+        document_model.objects.get.return_value = self.document
+        checkpoint_model.objects.update_or_create.side_effect = self._create_checkpoint
+
+    def _create_checkpoint(self, document, defaults):
+        for name, value in defaults.items():
+            setattr(self.checkpoint, name, value)
+        return self.checkpoint, True
+
+    def _ingest(self, checkpoint, markdown):
+        with mock.patch.object(RAGService, '_get_resumable_checkpoint', return_value=checkpoint), \
+                mock.patch.object(RAGService, '_read_stored_markdown', return_value=markdown), \
+                mock.patch.object(RAGService, '_extract_content_for_rag', return_value='văn bản mới') as extract, \
+                mock.patch.object(RAGService, '_ingest_full') as ingest_full:
+            self.service.ingest_document(7)
+        return extract, ingest_full
+
+    def test_interrupted_run_resumes_from_its_plan(self):
+        with self.assertRaises(RuntimeError):
+            with mock.patch.object(RAGService, '_get_resumable_checkpoint', return_value=None), \
+                    mock.patch.object(RAGService, '_extract_content_for_rag', return_value='văn bản'), \
+                    mock.patch.object(RAGService, '_ingest_full', side_effect=RuntimeError('embedding API down')):
+                self.service.ingest_document(7)
+        self.assertEqual(self.checkpoint.stage, 'planned')
+
+        extract, ingest_full = self._ingest(self.checkpoint, 'văn bản')
+        extract.assert_not_called()
+        self.assertEqual([item['embed_text'] for item in ingest_full.call_args.args[1]], ['văn bản'])
+        self.checkpoint.delete.assert_not_called()
+
+    def test_stale_checkpoint_is_discarded(self):
+        self.checkpoint.stage = 'planned'
+        self.checkpoint.text_digest = hashlib.sha256('văn bản cũ'.encode('utf-8')).hexdigest()
+        self.checkpoint.chunk_plan = []
+        self.document.chunks.exists.return_value = True
+
+        extract, ingest_full = self._ingest(self.checkpoint, 'văn bản mới')
+        self.checkpoint.delete.assert_called_once()
+        self.document.chunks.all.return_value.delete.assert_called_once()
+        self.assertEqual([item['embed_text'] for item in ingest_full.call_args.args[1]], ['văn bản mới'])
+
+
+class StreamingIngestTests(SimpleTestCase):
+    def setUp(self):
+        self.service = RAGService.__new__(RAGService)
+        self.service.chunk_size, self.service.chunk_overlap = 800, 100
+        self.service.embedder = mock.Mock()
+        self.service.embedder.embed.side_effect = lambda texts: [[0.1]] * len(texts)
+        self.document = mock.Mock(id=7)
+        self.checkpoint = mock.Mock(saved_chunks=0, embedded_chunks=0, chunk_plan=[])
+        document_patch = mock.patch('api.services.Document')
+        self.document_model = document_patch.start()
+        self.addCleanup(document_patch.stop)
+        patches = [
+            mock.patch('api.services.DocumentChunk'),
+            mock.patch('api.services.RagIngestionCheckpoint'),
+            mock.patch('api.services.transaction'),
+            mock.patch('api.services.close_old_connections'),
+            mock.patch('api.services.save_document_chunks'),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _text(self, pages: int) -> str:
+        return "".join(f"--- PAGE {n} ---\nNội dung riêng của trang {n}.\n" for n in range(1, pages + 1))
+
+    def test_embedding_starts_before_the_plan_is_complete(self):
+        def plan():
+            yield from itertools.islice(self.service._iter_chunk_plan(self._text(60)), 55)
+            raise RuntimeError('chunker stopped')
+
+        with self.assertRaises(RuntimeError):
+            self.service._ingest_full(self.document, plan(), self.checkpoint, total_pages=60)
+        self.service.embedder.embed.assert_called_once()
+        self.assertEqual(len(self.service.embedder.embed.call_args.args[0]), 50)
+
+    def test_resume_skips_the_saved_chunks(self):
+        text = self._text(250)
+        saved = [item['id'] for item in itertools.islice(self.service._iter_chunk_plan(text), 200)]
+        self.checkpoint.saved_chunks = 200
+        self.checkpoint.chunk_plan = saved
+        self.service._ingest_full(self.document, self.service._iter_chunk_plan(text), self.checkpoint, total_pages=250)
+        self.assertEqual(self.service.embedder.embed.call_count, 1)
+        self.assertEqual(self.checkpoint.saved_chunks, 250)
+        self.assertEqual(len(self.checkpoint.chunk_plan), 250)
+        self.document.chunks.all.return_value.delete.assert_not_called()
+
+    def test_resume_with_a_different_plan_saves_everything_again(self):
+        self.checkpoint.saved_chunks = 2
+        self.checkpoint.chunk_plan = ['00000-aaaaaaaaaaaa', '00001-bbbbbbbbbbbb']
+        self.service._ingest_full(self.document, self.service._iter_chunk_plan(self._text(3)), self.checkpoint, 3)
+        self.document.chunks.all.return_value.delete.assert_called_once()
+        self.assertEqual(self.checkpoint.saved_chunks, 3)
+
+    def test_each_priority_tier_is_committed_separately(self):
+        plan = [
+            dict(_plan_item('bìa', 1), id='a', priority=0),
+            dict(_plan_item('biểu phí', 9), id='b', priority=0),
+            dict(_plan_item('phụ lục', 7), id='c', priority=2),
+        ]
+        with mock.patch('api.services.save_document_chunks') as save:
+            self.service._ingest_full(self.document, iter(plan), self.checkpoint, total_pages=3)
+        self.assertEqual([len(call.args[0]) for call in save.call_args_list], [2, 1])
+        update = self.document_model.objects.filter.return_value.update
+        self.assertEqual(
+            [call.kwargs['rag_pages_indexed'] for call in update.call_args_list if 'rag_pages_indexed' in call.kwargs],
+            [2, 3],
+        )
+        self.assertEqual(self.checkpoint.chunk_plan, ['a', 'b', 'c'])
+
+
+class MarkdownChunkerTests(SimpleTestCase):
+    TEXT = (
+        "--- PAGE 1 ---\n# Điều lệ\nGiới thiệu quỹ.\n## Phí\nPhí quản lý 1,5%/năm.\n"
+        "--- PAGE 2 ---\n```\n# không phải tiêu đề\n--- PAGE 9 ---\n```\n### Chi tiết\nPhí mua 0%."
+    )
+
+    def test_sections_follow_pages_and_headers(self):
+        sections = list(iter_page_sections(self.TEXT))
+        self.assertEqual(sections[0], (1, ('Điều lệ', None, None), 'Giới thiệu quỹ.'))
+        self.assertEqual(sections[1], (1, ('Điều lệ', 'Phí', None), 'Phí quản lý 1,5%/năm.'))
+        # Markers and headers inside a code fence are text.
+        self.assertEqual(sections[2][0], 2)
+        self.assertIn('# không phải tiêu đề', sections[2][2])
+        # Header context starts over on every page.
+        self.assertEqual(sections[3], (2, (None, None, 'Chi tiết'), 'Phí mua 0%.'))
+
+    def test_chunks_respect_the_size_and_carry_their_headers(self):
+        text = "--- PAGE 3 ---\n# Rủi ro\n" + "\n\n".join(f"Đoạn {i}: " + "rủi ro thị trường " * 8 for i in range(10))
+        chunks = list(iter_markdown_chunks(text, chunk_size=200, chunk_overlap=20))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk.text) <= 200 and chunk.page_number == 3 for chunk in chunks))
+        self.assertTrue(format_chunk_content(chunks[0]).startswith('# Rủi ro\n'))
+
+
+class RepeatedPhraseTests(SimpleTestCase):
+    def test_looping_phrase_keeps_one_copy(self):
+        text = "Tài sản là " + "sở hữu của một Quỹ " * 6 + "đại chúng."
+        self.assertEqual(collapse_repeated_phrases(text), "Tài sản là sở hữu của một Quỹ đại chúng.")
+
+    def test_short_repeats_and_other_lines_are_untouched(self):
+        text = "ha ha ha ha ha\nPhí quản lý 1,5%/năm"
+        self.assertEqual(collapse_repeated_phrases(text), text)
+
+    def test_long_line_without_short_repeats_is_kept(self):
+        line = "".join(chr(0x4E00 + (i * 7919) % 20000) for i in range(200_000))
+        self.assertEqual(collapse_repeated_phrases(line), line)
+
+
+class TextNormalizeTests(SimpleTestCase):
+    def test_diacritics_are_removed_and_lower_cased(self):
+        self.assertEqual(remove_vietnamese_diacritics("Công ty Quản lý ĐẦU TƯ"), "cong ty quan ly dau tu")
+        self.assertEqual(remove_vietnamese_diacritics(None), "")
+
+    def test_fold_words_keeps_only_words(self):
+        self.assertEqual(fold_words("Phí  quản lý (năm)?"), "phi quan ly nam")
+        self.assertEqual(fold_words("N/A"), "n a")
+
+
+class RunningHeaderTests(SimpleTestCase):
+    def _pages(self, pages):
+        return "\n".join(f"--- PAGE {n} ---\n" + "\n".join(lines) for n, lines in enumerate(pages, 1))
+
+    def test_page_numbers_and_repeated_header_are_removed(self):
+        text = self._pages([
+            ["QUỸ ĐẦU TƯ ABC", *[f"Nội dung trang {n}, đoạn {chr(97 + i) * 3}." for i in range(6)],
+             f"Trang {n}/5"]
+            for n in range(1, 6)
+        ])
+        cleaned, stats = strip_running_headers_footers(text)
+        self.assertNotIn("QUỸ ĐẦU TƯ ABC", cleaned)
+        self.assertNotIn("Trang 3/5", cleaned)
+        self.assertIn("Nội dung trang 3, đoạn aaa.", cleaned)
+        self.assertEqual(stats["removed_lines"], 10)
+
+    def test_body_lines_differing_only_in_numbers_are_kept(self):
+        text = self._pages([
+            ["Mục lục", f"Phí quản lý: {n},5%/năm", f"Trang {n}"]
+            for n in range(1, 6)
+        ])
+        cleaned, stats = strip_running_headers_footers(text)
+        for n in range(1, 6):
+            self.assertIn(f"Phí quản lý: {n},5%/năm", cleaned)
+            self.assertNotIn(f"Trang {n}", cleaned)
+        self.assertEqual(stats["removed_lines"], 10)
+
+    def test_short_pages_keep_their_middle_lines(self):
+        text = self._pages([
+            ["Báo cáo", "Nội dung giống nhau", "Điều khoản", "Kết luận", f"- {n} -"]
+            for n in range(1, 6)
+        ])
+        cleaned, _ = strip_running_headers_footers(text)
+        self.assertIn("Nội dung giống nhau", cleaned)
+        self.assertNotIn("- 3 -", cleaned)
+
+
+class NearDuplicateTests(SimpleTestCase):
+    FEES = "Phí phát hành tối đa 3% giá trị giao dịch, phí mua lại tối đa 2% giá trị giao dịch, " \
+           "phí chuyển đổi 0,5% giá trị chuyển đổi giữa các quỹ cùng công ty quản lý."
+
+    def test_near_duplicate_returns_the_kept_key(self):
+        dedup = NearDuplicateFilter(threshold=0.8)
+        self.assertIsNone(dedup.find_or_add(self.FEES, 0))
+        self.assertIsNone(dedup.find_or_add("Ngân hàng giám sát là Ngân hàng TMCP Đầu tư và Phát triển Việt Nam.", 1))
+        self.assertEqual(dedup.find_or_add(self.FEES.replace("0,5%", "0,5 %"), 2), 0)
+        self.assertEqual(dedup.stats(), {'threshold': 0.8, 'checked': 3, 'duplicates': 1, 'kept': 2})
+
+    def test_chunk_plan_keeps_the_pages_of_dropped_duplicates(self):
+        service = RAGService.__new__(RAGService)
+        service.chunk_size, service.chunk_overlap = 800, 100
+        text = "".join(f"--- PAGE {n} ---\n{self.FEES}\n" for n in (4, 9, 9))
+        text += "--- PAGE 10 ---\nTổ chức kiểm toán được Đại hội nhà đầu tư lựa chọn hằng năm.\n"
+        late_aliases = {}
+        with mock.patch.dict('os.environ', {'RAG_NEAR_DUP_THRESHOLD': '0.9'}):
+            plan = list(service._iter_chunk_plan(text, late_aliases=late_aliases))
+        self.assertEqual([(c['page_number'], c['alias_pages']) for c in plan], [(4, [9]), (10, [])])
+        self.assertEqual([c['id'][:5] for c in plan], ['00000', '00001'])
+        self.assertEqual(late_aliases, {(plan[0]['content_hash'], 4): [9]})
+
+    def test_aliases_found_after_the_kept_chunk_was_saved_are_written(self):
+        service = RAGService.__new__(RAGService)
+        document = mock.Mock()
+        document.chunks.filter.return_value.values_list.return_value = [(1, 'aaa', 4, []), (2, 'bbb', 5, [7])]
+        with mock.patch('api.services.DocumentChunk') as chunk_model, \
+                mock.patch('api.services.close_old_connections'):
+            service._save_late_aliases(document, {('aaa', 4): [9], ('bbb', 5): [7]})
+        chunk_model.assert_called_once_with(id=1, alias_pages=[9])
+        chunk_model.objects.bulk_update.assert_called_once_with(
+            [chunk_model.return_value], ['alias_pages'], batch_size=500,
+        )
+
+
+class CopyEncoderTests(SimpleTestCase):
+    def test_int4_array_and_vector_use_the_binary_wire_format(self):
+        self.assertEqual(vector_store._encode_int4_array([]), struct.pack(">iii", 0, 0, vector_store.INT4_OID))
+        self.assertEqual(
+            vector_store._encode_int4_array([9, 12]),
+            struct.pack(">iiiiiiiii", 1, 0, vector_store.INT4_OID, 2, 1, 4, 9, 4, 12),
+        )
+        self.assertEqual(vector_store._encode_vector([1.0, 0.5]), struct.pack(">HHff", 2, 0, 1.0, 0.5))
+        with self.assertRaises(ValueError):
+            vector_store._encode_vector([[1.0]])
+
+    def test_timestamps_count_microseconds_from_2000(self):
+        moment = datetime(2000, 1, 2, 0, 0, 1, 5, tzinfo=dt_timezone.utc)
+        self.assertEqual(vector_store._encode_timestamptz(moment), struct.pack(">q", 86_401_000_005))
+
+    def test_row_has_one_length_prefixed_field_per_column(self):
+        chunk = mock.Mock(
+            document_id=7, content="Phí", page_number=3, content_hash="ab", alias_pages=[5],
+            embedding=[0.25], created_at=None,
+        )
+        row = vector_store.encode_chunk_row(chunk, datetime(2000, 1, 1, tzinfo=dt_timezone.utc))
+        (count,) = struct.unpack_from(">h", row)
+        offset, fields = 2, []
+        for _ in range(count):
+            (size,) = struct.unpack_from(">i", row, offset)
+            fields.append(row[offset + 4:offset + 4 + size])
+            offset += 4 + size
+        self.assertEqual(offset, len(row))
+        self.assertEqual(count, len(vector_store.COPY_FIELDS))
+        self.assertEqual(fields[1], "Phí".encode("utf-8"))
+        self.assertEqual(fields[2], struct.pack(">i", 3))
+        self.assertEqual(fields[6], struct.pack(">q", 0))
+
+    def test_falls_back_to_bulk_create_when_disabled(self):
+        chunks = [mock.Mock(), mock.Mock()]
+        with mock.patch.dict('os.environ', {'RAG_COPY_LOAD': '0'}), \
+                mock.patch.object(vector_store, 'DocumentChunk') as chunk_model, \
+                mock.patch.object(vector_store, 'copy_document_chunks') as copy:
+            self.assertEqual(vector_store.save_document_chunks(chunks), 2)
+        copy.assert_not_called()
+        chunk_model.objects.bulk_create.assert_called_once_with(chunks, batch_size=500)
+
+
+class PagePriorityTests(SimpleTestCase):
+    TEXT = (
+        "".join(f"--- PAGE {n} ---\nGiới thiệu chung {n}.\n" for n in range(1, 5))
+        + "--- PAGE 5 ---\nThuyết minh hoạt động.\n"
+        + "--- PAGE 6 ---\nDanh mục đầu tư của Quỹ.\n"
+        + "--- PAGE 7 ---\nBiểu phí áp dụng.\n"
+    )
+
+    def setUp(self):
+        self.service = RAGService.__new__(RAGService)
+        self.service.chunk_size, self.service.chunk_overlap = 800, 100
+
+    def test_pages_are_tiered_by_keywords(self):
+        self.assertEqual(
+            self.service._page_priorities(self.TEXT),
+            {1: 0, 2: 0, 3: 0, 4: 0, 5: 2, 6: 1, 7: 0},
+        )
+
+    def test_plan_follows_the_tiers(self):
+        with mock.patch.dict('os.environ', {'RAG_NEAR_DUP_THRESHOLD': '0'}):
+            plan = list(self.service._iter_chunk_plan(
+                self.TEXT, page_priority=self.service._page_priorities(self.TEXT),
+            ))
+        self.assertEqual([item['page_number'] for item in plan], [1, 2, 3, 4, 7, 6, 5])
+        self.assertEqual([item['priority'] for item in plan], [0, 0, 0, 0, 0, 1, 2])
+        self.assertEqual([item['id'][:5] for item in plan], [f"{i:05d}" for i in range(7)])
+
+    def test_coverage_is_the_share_of_indexed_pages(self):
+        self.assertEqual(Document(rag_pages_total=4, rag_pages_indexed=1, rag_status='running').rag_coverage, 0.25)
+        self.assertEqual(Document(rag_pages_total=0, rag_status='completed').rag_coverage, 1.0)
+
+
+class EmbeddingBackendTests(SimpleTestCase):
+    def test_backend_interface_is_abstract(self):
+        with self.assertRaises(TypeError):
+            EmbeddingBackend()
+
+        class Fixed(EmbeddingBackend):
+            name = 'fixed'
+
+            def embed(self, texts):
+                return [[float(len(t))] for t in texts]
+
+        self.assertEqual(Fixed().embed_query('phí'), [3.0])
+
+    def test_backend_settings_are_validated(self):
+        with mock.patch.dict('os.environ', {'RAG_EMBEDDING_BACKEND': 'mistral'}):
+            with self.assertRaisesMessage(ValueError, 'MISTRAL_API_KEY'):
+                get_embedding_backend(None)
+        with mock.patch.dict('os.environ', {'RAG_EMBEDDING_BACKEND': 'onnx', 'RAG_EMBEDDING_MODEL_DIR': ''}):
+            with self.assertRaisesMessage(ValueError, 'RAG_EMBEDDING_MODEL_DIR'):
+                get_embedding_backend(None)
+        with mock.patch.dict('os.environ', {'RAG_EMBEDDING_BACKEND': 'openai'}):
+            with self.assertRaisesMessage(ValueError, 'Invalid RAG_EMBEDDING_BACKEND'):
+                get_embedding_backend(None)
+
+    def test_onnx_output_is_pooled_normalized_and_padded(self):
+        import numpy as np
+
+        backend = OnnxEmbeddingBackend.__new__(OnnxEmbeddingBackend)
+        backend.name, backend.batch_size, backend.pooling = 'onnx:test', 16, 'mean'
+        backend.query_prefix, backend.passage_prefix = 'query: ', 'passage: '
+        backend._input_names = {'input_ids', 'attention_mask'}
+        backend._lock = mock.MagicMock()
+        backend.tokenizer = mock.Mock()
+        backend.tokenizer.encode_batch.return_value = [mock.Mock(ids=[1, 2], attention_mask=[1, 0])]
+        backend.session = mock.Mock()
+        backend.session.run.return_value = [np.array([[[3.0, 4.0], [100.0, 100.0]]])]
+
+        vector = backend.embed_query('phí quản lý')
+        backend.tokenizer.encode_batch.assert_called_once_with(['query: phí quản lý'])
+        self.assertEqual(len(vector), EMBEDDING_DIMENSIONS)
+        self.assertAlmostEqual(vector[0], 0.6, places=5)
+        self.assertAlmostEqual(vector[1], 0.8, places=5)
+        self.assertFalse(any(vector[2:]))
+
+    def test_chat_rejects_chunks_from_another_backend(self):
+        service = RAGService.__new__(RAGService)
+        service.embedding_model = 'onnx:bge-m3'
+        document = mock.Mock(id=7, rag_embedding_model='mistral-embed-2312')
+        with mock.patch('api.services.Document') as document_model:
+            document_model.objects.get.return_value = document
+            with self.assertRaisesMessage(EmbeddingModelMismatch, 're-ingest'):
+                service.chat(7, 'Phí quản lý là bao nhiêu?')
+        document.rag_embedding_model = 'onnx:bge-m3'
+        service._check_embedding_model(document)
+
+
+class NearestChunksTests(SimpleTestCase):
+    def _sql(self, mode, rerank_factor=None):
+        queryset = vector_store.DocumentChunk.objects.filter(document_id=7)
+        return str(vector_store.nearest_chunks(queryset, [0.5] * 1024, limit=5, mode=mode, rerank_factor=rerank_factor).query)
+
+    def test_storage_mode_is_validated(self):
+        with mock.patch.dict('os.environ', {'RAG_VECTOR_STORAGE': 'HalfVec'}):
+            self.assertEqual(vector_store.vector_storage_mode(), 'halfvec')
+        with mock.patch.dict('os.environ', {'RAG_VECTOR_STORAGE': 'int8'}):
+            with self.assertRaises(ValueError):
+                vector_store.vector_storage_mode()
+
+    def test_full_mode_orders_by_exact_distance(self):
+        sql = self._sql('full')
+        self.assertNotIn('halfvec', sql)
+        self.assertIn('LIMIT 5', sql)
+
+    def test_quantized_modes_rerank_a_wider_candidate_set(self):
+        halfvec = self._sql('halfvec', rerank_factor=4)
+        self.assertIn('halfvec(1024)', halfvec)
+        self.assertIn('LIMIT 20', halfvec)
+        binary = self._sql('binary', rerank_factor=3)
+        self.assertIn('binary_quantize', binary)
+        self.assertIn('LIMIT 15', binary)
+        # The exact re-ranking on the full vectors is the outer query.
+        self.assertTrue(binary.rstrip().endswith('LIMIT 5'))
+
+
+class RetrievalTests(SimpleTestCase):
+    def test_search_fetches_only_the_prompt_columns_once(self):
+        rows = [(3, 5, [8], 'Phí quản lý 1,5%/năm', 0.12)]
+        plan = vector_store.SearchPlan('exact', 40)
+        with mock.patch.object(vector_store, 'nearest_chunks') as nearest, \
+                mock.patch.object(vector_store, 'apply_search_plan') as apply_plan, \
+                mock.patch.object(vector_store.transaction, 'atomic'):
+            nearest.return_value.values_list.return_value = rows
+            chunks, elapsed_ms = vector_store.search_chunks(mock.Mock(), [0.1], limit=25, mode='binary', plan=plan)
+        apply_plan.assert_called_once_with(plan)
+        # Exact scans read the full vectors whatever the storage mode
+        self.assertEqual(nearest.call_args.kwargs['mode'], 'full')
+        nearest.return_value.values_list.assert_called_once_with('id', 'page_number', 'alias_pages', 'content', 'distance')
+        self.assertEqual(chunks, [vector_store.RetrievedChunk(3, 5, [8], 'Phí quản lý 1,5%/năm', 0.12)])
+        self.assertGreaterEqual(elapsed_ms, 0)
+
+    def test_result_reports_contexts_and_timings(self):
+        result = vector_store.RetrievalResult(
+            chunks=[vector_store.RetrievedChunk(1, 2, [], 'Nội dung', 0.3)], embed_ms=12.34, search_ms=5.01,
+        )
+        self.assertEqual(result.contexts, ['Nội dung'])
+        self.assertEqual(
+            result.timings(),
+            {
+                'embed_ms': 12.3, 'search_ms': 5.0, 'keyword_ms': 0.0, 'total_ms': 17.4,
+                'query_cache': '', 'keyword_hits': 0, 'search_plan': '',
+            },
+        )
+
+    def test_retrieve_embeds_the_query_and_searches_the_document(self):
+        service = RAGService.__new__(RAGService)
+        service.embedding_model = 'mistral-embed-2312'
+        service.hybrid_search = False
+        service.query_embedder = mock.Mock(last_source='memory')
+        service.query_embedder.embed_query.return_value = [0.1]
+        document = mock.Mock(id=7, rag_embedding_model='mistral-embed-2312', rag_metrics={'chunks': {'stored': 40}})
+        with mock.patch('api.services.search_chunks', return_value=([], 4.0)) as search, \
+                mock.patch('api.services.DocumentChunk') as chunk_model, \
+                mock.patch.dict('os.environ', {'RAG_SEARCH_STRATEGY': 'auto'}):
+            result = service.retrieve(document, 'Phí quản lý?', limit=10)
+        chunk_model.objects.filter.assert_called_once_with(document_id=7)
+        # The stored chunk count plans the search: no count query per question
+        chunk_model.objects.filter.return_value.count.assert_not_called()
+        self.assertEqual(search.call_args.args[1], [0.1])
+        self.assertEqual(search.call_args.kwargs['limit'], 10)
+        self.assertEqual(search.call_args.kwargs['plan'].strategy, 'exact')
+        self.assertGreaterEqual(result.search_ms, 4.0)
+        self.assertEqual(result.query_cache, 'memory')
+        self.assertEqual(result.search_plan, 'exact (40 chunks)')
+
+    def test_documents_without_a_stored_count_are_counted_once(self):
+        queryset = mock.Mock()
+        queryset.count.return_value = 12
+        document = mock.Mock(id=7, rag_metrics={})
+        with mock.patch('api.services.update_rag_metrics') as update:
+            self.assertEqual(RAGService._stored_chunk_count(document, queryset), 12)
+        update.assert_called_once_with(7, chunks={'stored': 12})
+
+
+class HybridRetrievalTests(SimpleTestCase):
+    def test_keyword_terms_drop_question_words_and_keep_codes(self):
+        terms = vector_store.keyword_terms("Phí quản lý của quỹ VCBF-BCF là bao nhiêu? Phi quan ly 1,5%")
+        self.assertEqual(terms, ['Phí', 'quản', 'lý', 'quỹ', 'VCBF-BCF', '1,5%'])
+        self.assertEqual(vector_store.keyword_terms("là gì?"), [])
+        self.assertIsNone(vector_store.keyword_query("là gì?"))
+
+    def test_rank_fusion_rewards_chunks_found_by_both_searches(self):
+        chunk = vector_store.RetrievedChunk
+        vector = [chunk(1, 1, [], 'a', 0.1), chunk(2, 2, [], 'b', 0.2)]
+        keyword = [chunk(3, 3, [], 'c', None, 0.9), chunk(2, 2, [], 'b', None, 0.5)]
+        fused = vector_store.reciprocal_rank_fusion([vector, keyword], limit=2, k=60)
+        self.assertEqual([c.id for c in fused], [2, 1])
+        # The vector distance survives when the keyword hit comes second
+        self.assertEqual(fused[0].distance, 0.2)
+        self.assertEqual(fused[0].score, round(1 / 62 + 1 / 62, 6))
+
+    def test_keyword_failure_falls_back_to_the_vector_ranking(self):
+        service = RAGService.__new__(RAGService)
+        service.embedding_model = 'mistral-embed-2312'
+        service.hybrid_search = True
+        service.hybrid_candidates = 30
+        service.rrf_k = 60
+        service.query_embedder = mock.Mock(last_source='backend')
+        service.query_embedder.embed_query.return_value = [0.1]
+        document = mock.Mock(id=7, rag_embedding_model='mistral-embed-2312', rag_metrics={'chunks': {'stored': 40}})
+        vector_hits = [vector_store.RetrievedChunk(i, i, [], f'c{i}', 0.1 * i) for i in range(1, 4)]
+        with mock.patch('api.services.search_chunks', return_value=(vector_hits, 4.0)) as search, \
+                mock.patch('api.services.keyword_search', side_effect=RuntimeError('no unaccent')), \
+                mock.patch('api.services.DocumentChunk'):
+            result = service.retrieve(document, 'Phí quản lý?', limit=2)
+        self.assertEqual(search.call_args.kwargs['limit'], 30)
+        self.assertEqual([c.id for c in result.chunks], [1, 2])
+        self.assertEqual(result.keyword_hits, 0)
+
+
+class QueryCacheStatsTests(SimpleTestCase):
+    def test_query_key_ignores_case_spacing_and_unicode_form(self):
+        composed = normalize_query_text("  Phí quản lý  của QUỸ? ")
+        decomposed = normalize_query_text(unicodedata.normalize('NFD', "phí quản lý của quỹ"))
+        self.assertEqual(composed, decomposed)
+        self.assertNotEqual(composed, normalize_query_text("phi quan ly cua quy"))
+
+    def test_memory_hit_is_counted(self):
+        backend = mock.Mock()
+        backend.name = 'test-embed-stats'
+        backend.embed_query.return_value = [0.1, 0.2]
+        embedder = CachedQueryEmbedder(backend)
+        before = query_cache_stats()
+        with mock.patch.object(CachedQueryEmbedder, '_lookup', return_value=None), \
+                mock.patch.object(CachedQueryEmbedder, '_store'):
+            embedder.embed_query('Phí quản lý của quỹ stats?')
+            embedder.embed_query('Phí quản lý của quỹ stats?')
+        after = query_cache_stats()
+        backend.embed_query.assert_called_once()
+        self.assertEqual(embedder.last_source, 'memory')
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['memory_hits'] - before['memory_hits'], 1)
+        self.assertGreater(after['hit_rate'], 0)
+
+
+class AnswerCacheTests(SimpleTestCase):
+    def test_history_digest_is_empty_for_a_fresh_conversation(self):
+        self.assertEqual(history_digest([]), '')
+        first = history_digest([{'sender': 'user', 'text': 'Phí quản lý?'}])
+        same = history_digest([{'sender': 'user', 'text': '  phí QUẢN lý? '}])
+        self.assertEqual(first, same)
+        self.assertNotEqual(first, history_digest([{'sender': 'bot', 'text': 'Phí quản lý?'}]))
+
+    def test_turn_counts_accumulate_without_touching_the_database(self):
+        counters = {}
+        record_answer_cache_outcome(counters, 'misses')
+        record_answer_cache_outcome(counters, 'stores')
+        record_answer_cache_outcome(counters, 'misses')
+        self.assertEqual(counters, {'answer_cache.misses': 2, 'answer_cache.stores': 1})
+
+    def test_reported_stats_are_derived_on_read(self):
+        stats = answer_cache_stats({'hits': 3.0, 'semantic_hits': 1.0, 'misses': 4.0})
+        self.assertEqual((stats['hits'], stats['stores'], stats['hit_rate']), (3, 0, 0.5))
+        self.assertEqual(answer_cache_stats({})['hit_rate'], 0.0)
+
+    def _store(self, semantic: bool, embed_error: Exception | None = None):
+        service = RAGService.__new__(RAGService)  # no provider clients needed
+        service.query_embedder = mock.Mock()
+        if embed_error:
+            service.query_embedder.embed_query.side_effect = embed_error
+        else:
+            service.query_embedder.embed_query.return_value = [0.1] * 4
+        turn = ChatTurn(document=mock.Mock(id=7), user_query='Phí quản lý?')
+        turn.answer_cache = mock.Mock(semantic=semantic)
+        service._finish_chat(turn, 'Phí quản lý là 1,5%/năm')
+        self.assertEqual(turn.counters, {'answer_cache.stores': 1})
+        return service.query_embedder.embed_query, turn.answer_cache.store
+
+    def test_no_embedding_when_paraphrase_matching_is_off(self):
+        embed, store = self._store(semantic=False)
+        embed.assert_not_called()
+        self.assertIsNone(store.call_args.args[3])
+
+    def test_embedding_failure_still_stores_the_answer(self):
+        embed, store = self._store(semantic=True, embed_error=RuntimeError('backend down'))
+        embed.assert_called_once()
+        store.assert_called_once()
+        self.assertIsNone(store.call_args.args[3])
+
+
+class ContextPackerTests(SimpleTestCase):
+    def setUp(self):
+        self.fields = [
+            StructuredField('fund_name', 'Tên quỹ', 'Quỹ Đầu tư Cổ phiếu TCSME'),
+            StructuredField('fund_code', 'Mã quỹ', 'TCSME'),
+            StructuredField('management_fee', 'Phí quản lý', '1,5%/năm'),
+            StructuredField('redemption_fee', 'Phí bán', '0,5%'),
+            StructuredField('liquidity_risk', 'Rủi ro thanh khoản', 'Cổ phiếu vốn hóa nhỏ ' * 20),
+            StructuredField('borrowing_limit', 'Giới hạn vay', '5% NAV'),
+        ]
+
+    def test_folded_syllables_do_not_select_fields(self):
+        self.assertEqual(matching_fields("Quỹ mà tôi hỏi là gì?"), set())
+        self.assertNotIn('redemption_fee', matching_fields("Bạn cho tôi biết quỹ này có an toàn không?"))
+        self.assertNotIn('borrowing_limit', matching_fields("Vậy quỹ đầu tư vào đâu?"))
+
+    def test_phrases_match_with_or_without_diacritics(self):
+        self.assertIn('fund_code', matching_fields("Mã quỹ là gì?"))
+        self.assertIn('fund_code', matching_fields("ma quy la gi"))
+        self.assertIn('liquidity_risk', matching_fields("Bạn cho tôi biết quỹ này có an toàn không?"))
+
+    def test_weak_match_keeps_every_field(self):
+        strong, weak = match_field_keywords("Quỹ có được vay không?")
+        self.assertEqual((strong, weak), (set(), {'borrowing_limit'}))
+        packed = pack_structured("Thông tin quỹ:", self.fields, "Quỹ có được vay không?", 10_000)
+        self.assertEqual(len(packed.fields), len(self.fields))
+        self.assertEqual(packed.fields[2], 'borrowing_limit')
+
+    def test_phrase_match_narrows_to_core_and_matched_fields(self):
+        packed = pack_structured("Thông tin quỹ:", self.fields, "Phí quản lý là bao nhiêu?", 10_000)
+        self.assertEqual(packed.fields, ['fund_name', 'fund_code', 'management_fee', 'redemption_fee'])
+
+    def test_packed_block_stays_within_budget(self):
+        packed = pack_structured("Thông tin quỹ:", self.fields, "", 120)
+        self.assertLessEqual(packed.tokens, 120)
+        self.assertIn('liquidity_risk', packed.truncated)
+
+    def test_near_identical_chunks_are_dropped(self):
+        chunk = vector_store.RetrievedChunk
+        chunks = [
+            chunk(1, 3, [], 'Phí quản lý của quỹ là 1,5%/năm trên giá trị tài sản ròng', 0.1),
+            chunk(2, 9, [], 'Phí quản lý của quỹ là 1,5%/năm trên giá trị tài sản ròng.', 0.1),
+            chunk(3, 4, [], 'Ngân hàng giám sát là Ngân hàng TMCP Đầu tư và Phát triển', 0.2),
+        ]
+        packed = pack_chunks(chunks, 10_000, lambda c: c.content)
+        self.assertEqual([c.id for c in packed.chunks], [1, 3])
+        self.assertEqual(packed.dropped_duplicates, 1)
+
+        tight = pack_chunks(chunks, 25, lambda c: c.content)
+        self.assertEqual([c.id for c in tight.chunks], [1])
+        self.assertLessEqual(tight.tokens, 25)
+
+
+class StructuredSummaryTests(SimpleTestCase):
+    def _document(self):
+        document = mock.Mock(id=7, extracted_data={'management_fee': '1,5%/năm'})
+        document.structured_summary = {
+            'format': STRUCTURED_SUMMARY_FORMAT,
+            'header': 'Thông tin quỹ:',
+            'fields': [{'key': 'management_fee', 'label': 'Phí quản lý', 'value': '1,5%/năm'}],
+        }
+        return document
+
+    def test_stored_summary_is_used_without_touching_its_sources(self):
+        with mock.patch('api.structured_summary.refresh_structured_summary') as refresh, \
+                mock.patch('api.structured_summary.ExtractedFundData') as fund_model:
+            header, fields = load_structured_summary(self._document())
+        refresh.assert_not_called()
+        fund_model.objects.filter.assert_not_called()
+        fund_model.objects.get.assert_not_called()
+        self.assertEqual((header, fields[0].value), ('Thông tin quỹ:', '1,5%/năm'))
+
+    def test_cleared_or_outdated_summary_is_rebuilt(self):
+        rebuilt = {'header': 'Thông tin quỹ:', 'fields': [
+            {'key': 'management_fee', 'label': 'Phí quản lý', 'value': '1,2%/năm'},
+        ]}
+        for stored in ({}, {**self._document().structured_summary, 'format': STRUCTURED_SUMMARY_FORMAT - 1}):
+            document = self._document()
+            document.structured_summary = stored
+            with mock.patch('api.structured_summary.refresh_structured_summary', return_value=rebuilt) as refresh:
+                header, fields = load_structured_summary(document)
+            refresh.assert_called_once_with(document)
+            self.assertEqual(fields[0].value, '1,2%/năm')
+
+    def test_handlers_are_connected(self):
+        self.assertTrue(post_save.has_listeners(Document))
+        self.assertTrue(post_save.has_listeners(ExtractedFundData))
+        self.assertTrue(post_delete.has_listeners(ExtractedFundData))
+
+    def test_only_saves_of_extracted_data_clear_the_summary(self):
+        document = mock.Mock(id=7)
+        with mock.patch('api.signals.invalidate_structured_summary') as invalidate:
+            signals.clear_structured_summary_on_document_save(Document, document, update_fields=frozenset({'chat_history'}))
+            signals.clear_structured_summary_on_document_save(Document, document, created=True)
+            invalidate.assert_not_called()
+
+            signals.clear_structured_summary_on_document_save(
+                Document, document, update_fields=frozenset({'status', 'extracted_data'}),
+            )
+            signals.clear_structured_summary_on_document_save(Document, document, update_fields=None)
+        self.assertEqual(invalidate.call_args_list, [mock.call(document), mock.call(document)])
+
+    def test_fund_data_writes_clear_the_summary(self):
+        with mock.patch('api.signals.invalidate_structured_summary') as invalidate:
+            signals.clear_structured_summary_on_fund_data_change(ExtractedFundData, mock.Mock(document_id=7))
+        invalidate.assert_called_once_with(7)
+
+
+def _ingested_document(chunks: bool = True):
+    document = mock.Mock(id=7, rag_status='completed', rag_coverage=1.0)
+    document.chunks.exists.return_value = chunks
+    document.chunks.count.return_value = 3 if chunks else 0
+    return document
+
+
+class ChatViewTests(SimpleTestCase):
+    def _post(self, action: str, document, accept: str = 'application/json'):
+        # Through the router, so the action's renderer classes apply as in production.
+        with mock.patch.object(DocumentViewSet, 'get_object', return_value=document):
+            return APIClient().post(
+                f'/api/documents/7/{action}/',
+                {'query': 'Phí quản lý là bao nhiêu?', 'history': []},
+                format='json',
+                HTTP_ACCEPT=accept,
+            )
+
+    def test_streams_tokens_then_done(self):
+        events = [
+            ('token', {'text': 'Phí quản lý '}),
+            ('token', {'text': 'là 1,5%/năm'}),
+            ('done', {'text': 'Phí quản lý là 1,5%/năm', 'sources': [{'page': 4}], 'timings': {}}),
+        ]
+        with mock.patch('api.views.RAGService') as service, \
+                mock.patch.object(DocumentViewSet, '_append_chat_turn') as append:
+            service.return_value.chat_stream.return_value = iter(events)
+            response = self._post('chat_stream', _ingested_document(), accept='text/event-stream')
+            body = b''.join(response.streaming_content).decode('utf-8')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/event-stream'))
+        self.assertEqual(body.count('event: token'), 2)
+        self.assertIn('event: done', body)
+        self.assertIn('"answer": "Phí quản lý là 1,5%/năm"', body)
+        append.assert_called_once()
+
+    def test_error_before_stream_is_json_when_accepted(self):
+        response = self._post(
+            'chat_stream', _ingested_document(chunks=False), accept='text/event-stream, application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('not ingested', response.data['error'])
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    def test_error_before_stream_is_an_event_for_sse_only_clients(self):
+        response = self._post('chat_stream', _ingested_document(chunks=False), accept='text/event-stream')
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(response.rendered_content.startswith(b'event: error\n'))
+
+    def test_non_streaming_chat_also_persists_the_turn(self):
+        document = _ingested_document()
+        with mock.patch('api.views.RAGService') as service, \
+                mock.patch.object(DocumentViewSet, '_append_chat_turn') as append:
+            service.return_value.chat.return_value = {'text': 'Phí quản lý là 1,5%/năm', 'contexts': []}
+            response = self._post('chat', document)
+        self.assertEqual(response.status_code, 200)
+        append.assert_called_once()
+        self.assertEqual(append.call_args.args[1:3], ('Phí quản lý là bao nhiêu?', 'Phí quản lý là 1,5%/năm'))
+
+    def test_failed_turn_is_not_persisted(self):
+        with mock.patch('api.views.RAGService') as service, \
+                mock.patch.object(DocumentViewSet, '_append_chat_turn') as append:
+            service.return_value.chat.return_value = {'text': 'Xin lỗi', 'contexts': [], 'error': 'timeout'}
+            self._post('chat', _ingested_document())
+        append.assert_not_called()
+
+
+class ChatStreamServiceTests(SimpleTestCase):
+    def _service(self):
+        service = RAGService.__new__(RAGService)  # no provider clients needed
+        service.field_router = False
+        turn = ChatTurn(document=mock.Mock(id=7, rag_coverage=1.0), user_query='Phí quản lý?')
+        turn.counters = {'answer_cache.misses': 1}
+        service._prepare_chat = mock.Mock(return_value=turn)
+        service._finish_chat = mock.Mock()
+        return service
+
+    def test_tokens_then_done_with_counters_flushed_once(self):
+        service = self._service()
+        service._generate_stream = mock.Mock(return_value=iter(['Phí quản lý ', 'là 1,5%/năm']))
+        with mock.patch('api.services.flush_counters') as flush:
+            events = list(service.chat_stream(7, 'Phí quản lý?'))
+        self.assertEqual([e for e, _ in events], ['token', 'token', 'done'])
+        self.assertEqual(events[-1][1]['text'], 'Phí quản lý là 1,5%/năm')
+        self.assertIn('first_token_ms', events[-1][1]['timings'])
+        flush.assert_called_once_with(7, {'answer_cache.misses': 1})
+
+    def test_generation_failure_ends_with_an_error_event(self):
+        def failing_stream(turn):
+            yield 'Phí quản lý '
+            raise RuntimeError('connection reset')
+
+        service = self._service()
+        service._generate_stream = failing_stream
+        with mock.patch('api.services.flush_counters'):
+            events = list(service.chat_stream(7, 'Phí quản lý?'))
+        self.assertEqual([e for e, _ in events], ['token', 'error'])
+        self.assertEqual(events[-1][1]['text'], 'Phí quản lý ')
+        service._finish_chat.assert_not_called()
+
+
+class PlanSearchTests(SimpleTestCase):
+    def _plan(self, limit, mode, version=(0, 8, 0), env=None, **kwargs):
+        env = {'RAG_HNSW_EF_SEARCH': '100', 'RAG_RERANK_FACTOR': '4', **(env or {})}
+        with mock.patch('api.vector_store.pgvector_version', return_value=version), \
+                mock.patch.dict('os.environ', env):
+            return plan_search(None, limit, strategy='hnsw', mode=mode, **kwargs)
+
+    def test_auto_uses_the_given_chunk_count(self):
+        queryset = mock.Mock()
+        with mock.patch.dict('os.environ', {'RAG_EXACT_SEARCH_MAX_CHUNKS': '5000'}):
+            small = plan_search(queryset, 25, strategy='auto', chunk_count=300)
+            with mock.patch('api.vector_store.pgvector_version', return_value=(0, 8, 0)):
+                large = plan_search(queryset, 25, strategy='auto', chunk_count=8000, mode='full')
+        queryset.count.assert_not_called()
+        self.assertEqual((small.strategy, large.strategy), ('exact', 'hnsw'))
+
+    def test_exact_strategy_needs_no_tuning(self):
+        plan = plan_search(None, 25, strategy='exact')
+        self.assertEqual((plan.strategy, plan.ef_search), ('exact', None))
+
+    def test_ef_search_covers_the_rows_requested(self):
+        self.assertEqual(self._plan(25, 'full').ef_search, 100)
+        self.assertEqual(self._plan(300, 'full').ef_search, 300)
+
+    def test_quantized_modes_size_ef_search_from_the_rerank_pool(self):
+        plan = self._plan(60, 'halfvec')
+        self.assertEqual((plan.ef_search, plan.rerank_factor), (240, 4))
+
+    def test_pool_is_shrunk_to_fit_without_iterative_scan(self):
+        plan = self._plan(400, 'binary', version=(0, 7, 4))
+        self.assertEqual(plan.rerank_factor, 2)
+        self.assertEqual(plan.ef_search, 800)
+        self.assertIsNone(plan.iterative_scan)
+
+    def test_iterative_scan_keeps_the_pool(self):
+        plan = self._plan(400, 'binary')
+        self.assertEqual((plan.ef_search, plan.rerank_factor, plan.iterative_scan), (MAX_EF_SEARCH, 4, 'relaxed_order'))
+
+    def test_explicit_ef_search_is_still_raised_to_the_rows_fetched(self):
+        self.assertEqual(self._plan(30, 'full', ef_search=20).ef_search, 30)
+
+
+class CorpusSearchTests(SimpleTestCase):
+    def test_chunks_are_grouped_by_their_best_ranked_document(self):
+        chunks = [vector_store.RetrievedChunk(i, i, [], f'c{i}', 0.1 * i) for i in range(1, 6)]
+        documents = {1: 7, 2: 9, 3: 7, 4: 7, 5: 9}
+        groups = group_by_document(chunks, documents, chunks_per_document=2)
+        self.assertEqual([g.document_id for g in groups], [7, 9])
+        self.assertEqual([c.id for c in groups[0].chunks], [1, 3])
+        self.assertEqual((groups[1].best_rank, groups[1].best_distance), (2, 0.2))
+
+    def test_candidate_pool_grows_with_the_page_up_to_the_cap(self):
+        with mock.patch.dict('os.environ', {'RAG_CORPUS_SEARCH_CANDIDATES': '200'}):
+            self.assertEqual(candidate_count(1, 10, 3), 200)
+            self.assertEqual(candidate_count(5, 10, 3), 300)
+            self.assertEqual(candidate_count(50, 10, 3), 1000)
+
+    def test_unknown_filters_are_rejected(self):
+        with self.assertRaises(ValueError):
+            corpus_queryset('bge-m3', {'fund_name': 'VCBF'})
+
+    def test_unfiltered_search_goes_straight_to_hnsw(self):
+        service = RAGService.__new__(RAGService)
+        service.embedding_model = 'bge-m3'
+        service.hybrid_search = False
+        service.query_embedder = mock.Mock(last_source='miss')
+        service.query_embedder.embed_query.return_value = [0.1]
+        plan = mock.Mock()
+        plan.describe.return_value = 'hnsw'
+        with mock.patch('api.services.corpus_queryset') as queryset, \
+                mock.patch('api.services.plan_search', return_value=plan) as planner, \
+                mock.patch('api.services.search_chunks', return_value=([], 1.0)), \
+                mock.patch('api.services.chunk_document_ids', return_value={}), \
+                mock.patch('api.services.describe_groups', return_value=[]):
+            result = service.search_corpus('phái sinh', filters={'fund_type': ''})
+        queryset.assert_called_once_with('bge-m3', {})
+        self.assertEqual(planner.call_args.kwargs['strategy'], 'hnsw')
+        self.assertEqual((result['documents_found'], result['has_next']), (0, False))
+
+
+class RewriteQueryTests(SimpleTestCase):
+    history = [
+        {'sender': 'user', 'text': 'Rủi ro thanh khoản của quỹ là gì?'},
+        {'sender': 'ai', 'text': 'Quỹ đầu tư vào cổ phiếu vốn hóa nhỏ...'},
+    ]
+
+    def test_short_standalone_questions_are_not_rewritten(self):
+        for query in ("Mã quỹ là gì?", "Ngân hàng giám sát?", "Quỹ này có an toàn không?"):
+            self.assertEqual(rewrite_query(query, self.history), query)
+
+    def test_follow_ups_keep_the_previous_subject(self):
+        for query in ("Còn phí mua lại?", "Nó được đo thế nào?", "Giải thích thêm về khoản đó"):
+            self.assertEqual(
+                rewrite_query(query, self.history),
+                f"Rủi ro thanh khoản của quỹ là gì? {query}",
+            )
+
+    def test_accent_folded_phrases_count_as_follow_ups(self):
+        self.assertEqual(
+            rewrite_query("phi mua lai thi sao", self.history),
+            "Rủi ro thanh khoản của quỹ là gì? phi mua lai thi sao",
+        )
+
+    def test_without_history_the_query_is_unchanged(self):
+        self.assertEqual(rewrite_query("Còn phí mua lại?", []), "Còn phí mua lại?")
+
+
+class ConversationMemoryTests(SimpleTestCase):
+    history = [
+        {'sender': 'user' if i % 2 == 0 else 'ai', 'text': f'Tin nhắn {i}'}
+        for i in range(8)
+    ]
+
+    def test_older_turns_are_listed_by_question_until_summarized(self):
+        document = mock.Mock(chat_memory={})
+        memory = build_memory(document, self.history, 'mistral', turns=2)
+        self.assertEqual([m['text'] for m in memory.recent], [f'Tin nhắn {i}' for i in range(4, 8)])
+        self.assertEqual(memory.pending_questions, ['Tin nhắn 0', 'Tin nhắn 2'])
+        self.assertTrue(memory.needs_refresh)
+
+    def test_stored_summary_covers_the_messages_it_was_built_from(self):
+        older = self.history[:4]
+        document = mock.Mock(chat_memory={
+            'format': MEMORY_FORMAT, 'summary': 'Đã hỏi về phí.', 'covered': 4, 'digest': history_digest(older),
+        })
+        memory = build_memory(document, self.history, 'mistral', turns=2)
+        self.assertEqual((memory.summary, memory.pending_questions), ('Đã hỏi về phí.', []))
+        self.assertFalse(memory.needs_refresh)
+
+    def test_summary_of_another_conversation_is_ignored(self):
+        document = mock.Mock(chat_memory={
+            'format': MEMORY_FORMAT, 'summary': 'Khác.', 'covered': 4, 'digest': 'other',
+        })
+        memory = build_memory(document, self.history, 'mistral', turns=2)
+        self.assertEqual(memory.summary, '')
+        self.assertEqual(memory.unsummarized, 4)
+
+    def test_verbatim_history_stays_within_the_budget(self):
+        history = [{'sender': 'user', 'text': 'x ' * 2000}, {'sender': 'ai', 'text': 'y ' * 2000}]
+        with mock.patch.dict('os.environ', {'RAG_HISTORY_BUDGET_OLLAMA': '300'}):
+            memory = build_memory(mock.Mock(chat_memory={}), history, 'ollama', turns=1)
+        self.assertLessEqual(memory.tokens, 300)
+        self.assertEqual([m['sender'] for m in memory.recent], ['ai'])
+
+
+class FieldRouterTests(SimpleTestCase):
+    def _service(self, routed):
+        service = RAGService.__new__(RAGService)  # no provider clients needed
+        service.field_router = True
+        turn = ChatTurn(document=mock.Mock(id=7), user_query='Mã quỹ?', routed=routed,
+                        ready_answer=routed.text if routed else '')
+        service._prepare_chat = mock.Mock(return_value=turn)
+        service._generate = mock.Mock(return_value='Theo tài liệu...')
+        service._finish_chat = mock.Mock()
+        return service
+
+    def test_longest_phrase_wins(self):
+        self.assertEqual(match_fields('Phí mua lại của quỹ là bao nhiêu?'), ['redemption_fee'])
+        self.assertEqual(match_fields('Phí quản lý và ngân hàng giám sát?'), ['management_fee', 'custodian_bank'])
+        self.assertEqual(match_fields('Quỹ đầu tư vào đâu?'), [])
+
+    def test_explanations_are_not_lookups(self):
+        self.assertTrue(is_lookup_question('Phí quản lý là bao nhiêu?'))
+        self.assertFalse(is_lookup_question('Phí quản lý được tính như thế nào?'))
+        self.assertFalse(is_lookup_question('Cho tôi biết ' + 'phí quản lý ' * 10))
+
+    def test_route_question_answers_from_extracted_data(self):
+        document = mock.Mock(id=7, extracted_data={
+            'fees': {'management_fee': {'value': '1,5%/năm', 'page': 12}, 'redemption_fee': 'N/A'},
+        })
+        with mock.patch('api.field_router.ExtractedFundData') as fund_data:
+            fund_data.objects.filter.return_value.first.return_value = None
+            routed = route_question(document, 'Phí quản lý là bao nhiêu?')
+            missing = route_question(document, 'Phí mua lại là bao nhiêu?')
+        self.assertEqual(routed.text, 'Phí quản lý: 1,5%/năm\n(Nguồn: Trang 12)')
+        self.assertEqual(routed.method, 'keyword')
+        self.assertIsNone(missing)
+
+    def test_router_counts_go_to_the_turn_counters(self):
+        counters = {}
+        record_router_outcome(counters, 'fallthrough')
+        record_answer_cache_outcome(counters, 'misses')
+        record_router_outcome(counters, 'generated', 900.0)
+        self.assertEqual(counters, {
+            'field_router.fallthrough': 1,
+            'answer_cache.misses': 1,
+            'field_router.generated': 1,
+            'field_router.generated_ms_total': 900.0,
+        })
+
+    def test_reported_stats_are_derived_on_read(self):
+        router = router_stats({
+            'routed': 2.0, 'fallthrough': 2.0, 'generated': 2.0,
+            'routed_ms_total': 40.0, 'generated_ms_total': 4000.0,
+        })
+        self.assertEqual(router['hit_rate'], 0.5)
+        self.assertEqual((router['routed_ms_avg'], router['generated_ms_avg']), (20.0, 2000.0))
+        self.assertEqual(router['saved_ms_estimate'], 3960.0)
+
+    def test_chat_metrics_reports_the_router_section(self):
+        raw = {'field_router': {'routed': 1.0, 'fallthrough': 3.0}, 'unknown': {'x': 1.0}}
+        with mock.patch('api.chat_counters.document_counters', return_value=raw):
+            metrics = chat_metrics(7)
+        self.assertEqual(set(metrics), {'field_router'})
+        self.assertEqual(metrics['field_router']['hit_rate'], 0.25)
+
+    def test_routed_turns_are_not_generated(self):
+        routed = mock.Mock(text='Mã quỹ: VCBF-BCF', elapsed_ms=3.0)
+        service = self._service(routed)
+        with mock.patch('api.services.flush_counters') as flush:
+            events = list(service.chat_stream(7, 'Mã quỹ?'))
+        self.assertEqual(events[0], ('token', {'text': 'Mã quỹ: VCBF-BCF'}))
+        service._finish_chat.assert_not_called()
+        flush.assert_called_once()
+
+    def test_generated_turns_record_their_latency(self):
+        service = self._service(None)
+        with mock.patch('api.services.flush_counters') as flush:
+            service.chat(7, 'Mã quỹ?')
+        counters = flush.call_args.args[1]
+        self.assertEqual(counters['field_router.generated'], 1)
+        self.assertIn('field_router.generated_ms_total', counters)
+
+
+class OllamaPreloadTests(SimpleTestCase):
+    def _preloads(self, argv, env=None, **kwargs) -> bool:
+        env = {'RAG_CHAT_PROVIDER': 'ollama', 'OLLAMA_PRELOAD': 'true', **(env or {})}
+        with mock.patch('sys.argv', argv), mock.patch.dict('os.environ', env), \
+                mock.patch('api.ollama.threading.Thread') as thread:
+            preload_on_startup(**kwargs)
+        return thread.called
+
+    def test_scripts_and_other_commands_do_not_preload(self):
+        self.assertFalse(self._preloads(['-c']))
+        self.assertFalse(self._preloads(['manage.py', 'migrate']))
+        self.assertFalse(self._preloads(['manage.py', 'test', 'api']))
+
+    def test_serving_processes_preload(self):
+        self.assertTrue(self._preloads(['manage.py', 'runserver'], {'RUN_MAIN': 'true'}))
+        self.assertFalse(self._preloads(['manage.py', 'runserver'], {'RUN_MAIN': ''}))
+        self.assertTrue(self._preloads(['gunicorn'], server=True))
+        self.assertFalse(self._preloads(['gunicorn'], {'OLLAMA_PRELOAD': 'off'}, server=True))
+        self.assertFalse(self._preloads(['gunicorn'], {'RAG_CHAT_PROVIDER': 'mistral'}, server=True))
+
+    def test_generation_stats_from_the_final_response(self):
+        stats = generation_stats({
+            'load_duration': 5_000_000, 'prompt_eval_duration': 120_000_000, 'prompt_eval_count': 40,
+            'eval_duration': 2_000_000_000, 'eval_count': 100, 'total_duration': 2_200_000_000,
+        })
+        self.assertEqual((stats['load_ms'], stats['prompt_tokens'], stats['tokens_per_s']), (5.0, 40, 50.0))
+        self.assertEqual(generation_stats({'message': {'content': 'x'}}), {})
+
+    def test_per_turn_context_follows_the_history(self):
+        turn = ChatTurn(
+            document=mock.Mock(id=7), user_query='Còn phí mua lại?',
+            history=[{'sender': 'user', 'text': 'Phí quản lý?'}, {'sender': 'ai', 'text': '1,5%/năm'}],
+            system_prompt='Hướng dẫn + dữ liệu cấu trúc', turn_context='=== PAGE 12 ===\nPhí mua lại: 0%',
+        )
+        messages = RAGService._chat_messages(RAGService.__new__(RAGService), turn)
+        self.assertEqual(messages[0], {'role': 'system', 'content': 'Hướng dẫn + dữ liệu cấu trúc'})
+        self.assertEqual([m['role'] for m in messages], ['system', 'user', 'assistant', 'user'])
+        self.assertEqual(messages[-1]['content'], '=== PAGE 12 ===\nPhí mua lại: 0%\n\nCÂU HỎI: Còn phí mua lại?')
+
+
+class RunRagEvalTests(SimpleTestCase):
+    def test_grid_is_every_combination_of_the_settings(self):
+        self.assertEqual(parse_grid(['k=15,25', 'provider=ollama']), [
+            {'RAG_RETRIEVAL_K': '15', 'RAG_CHAT_PROVIDER': 'ollama'},
+            {'RAG_RETRIEVAL_K': '25', 'RAG_CHAT_PROVIDER': 'ollama'},
+        ])
+        self.assertEqual(parse_grid([]), [{}])
+        with self.assertRaises(CommandError):
+            parse_grid(['k'])
+
+    def test_rerun_skips_answers_but_retries_errors_on_request(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = Path(directory) / 'results.jsonl'
+            store.write_text(
+                '{"config_id": "c", "document_id": 7, "case_id": "q1"}\n'
+                '{"config_id": "c", "document_id": 7, "case_id": "q2", "error": "timeout"}\n'
+                '{"config_id": "c", "docu',
+                encoding='utf-8',
+            )
+            command = RunRagEvalCommand()
+            self.assertEqual(command._completed(store, retry_errors=False), {('c', 7, 'q1'), ('c', 7, 'q2')})
+            self.assertEqual(command._completed(store, retry_errors=True), {('c', 7, 'q1')})
+
+    def test_jsonl_cases_get_stable_ids(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', encoding='utf-8', delete=False) as f:
+            f.write('{"question": "Mã quỹ là gì?"}\n{"id": "fee", "question": "Phí quản lý?", "ground_truth": "1,5%"}\n')
+        cases = load_test_cases(f.name)
+        Path(f.name).unlink()
+        self.assertEqual((cases[0]['ground_truth'], cases[1]['id']), ('', 'fee'))
+        self.assertEqual(cases[0]['id'], hashlib.sha256('Mã quỹ là gì?'.encode('utf-8')).hexdigest()[:12])
+
+    def test_failed_reingestion_records_errors_and_restores_chunks(self):
+        command = RunRagEvalCommand(stdout=StringIO(), stderr=StringIO())
+        command._write_lock = mock.MagicMock()
+        command._reingested = set()
+        store = StringIO()
+        case = {'id': 'q1', 'question': 'Phí quản lý?', 'ground_truth': '1,5%'}
+        with mock.patch('api.management.commands.run_rag_eval.RAGService') as service:
+            service.return_value.ingest_document.return_value = False
+            command._run_config({'RAG_CHUNK_SIZE': '800'}, [7], [case], set(), store,
+                                {'use_answer_cache': False, 'concurrency': 1})
+            service.return_value.chat_stream.assert_not_called()
+            command._restore_chunks()
+        self.assertIn('"error": "Re-ingestion failed"', store.getvalue())
+        self.assertEqual(service.return_value.ingest_document.call_count, 2)
+
+
+class BenchmarkRetrievalCaseTests(SimpleTestCase):
+    @skipUnless(importlib.util.find_spec('pandas'), 'pandas is not installed')
+    def test_csv_rows_without_ground_truth_are_skipped(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', encoding='utf-8', delete=False) as f:
+            f.write('question,ground_truth\nPhí quản lý?,"1,5%/năm"\nNgân hàng giám sát?,\n')
+        cases = BenchmarkRetrievalCommand._load_cases({'csv': f.name, 'cases': None})
+        Path(f.name).unlink()
+        self.assertEqual([case['ground_truth'] for case in cases], ['1,5%/năm'])
+
+    def test_case_files_without_ground_truth_are_skipped(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', encoding='utf-8', delete=False) as f:
+            f.write('{"question": "Mã quỹ?", "ground_truth": "VCBF-BCF"}\n{"question": "Ngân hàng giám sát?"}\n')
+        cases = BenchmarkRetrievalCommand._load_cases({'csv': None, 'cases': f.name})
+        Path(f.name).unlink()
+        self.assertEqual([case['question'] for case in cases], ['Mã quỹ?'])
+
+    def test_fact_terms_keep_numbers_and_content_words(self):
+        facts = fact_terms('Phí quản lý là 1,5%/năm của NAV')
+        self.assertIn('1,5', facts)
+        self.assertIn('quan', facts)
+        self.assertNotIn('la', facts)
+        recall, numeric = lexical_recall(facts, ['Phí quản lý 1,5% mỗi năm'])
+        self.assertEqual(numeric, 1.0)
+        self.assertLess(recall, 1.0)
+
+    def test_recall_ignores_accents_lost_by_ocr(self):
+        facts = fact_terms('Ngân hàng giám sát: Đầu tư và Phát triển')
+        self.assertEqual(lexical_recall(facts, ['NGAN HANG GIAM SAT: DAU TU VA PHAT TRIEN'])[0], 1.0)
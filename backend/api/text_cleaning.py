@@ -0,0 +1,275 @@
+"""
+Text cleaning for RAG ingestion.
+
+OCR output (Mistral/Gemini) sometimes "loops" and repeats a phrase many times
+in a row ("sở hữu của một Quỹ sở hữu của một Quỹ ..."). The original cleaner
+used `re.sub(r'(.{10,})\\1+', r'\\1', text)`, which backtracks catastrophically
+on long lines. `collapse_repeated_phrases` keeps the same intent with a
+single left-to-right scan per line.
+
+`strip_running_headers_footers` removes running headers, footers and page
+numbers that OCR repeats on every page of a prospectus, so they are not
+chunked and embedded once per page.
+"""
+import difflib
+import re
+from collections import defaultdict
+
+from .chunking import HEADER_RE, PAGE_MARKER_RE
+from .text_normalize import remove_vietnamese_diacritics
+
+DEFAULT_MIN_PERIOD = 10
+DEFAULT_MAX_PERIOD = 400
+# How many earlier positions of the same k-gram are tried as the start of a repeat.
+_MAX_CANDIDATES = 4
+
+
+def _collapse_line(line: str, min_period: int, max_period: int) -> str:
+    n = len(line)
+    if n < 2 * min_period:
+        return line
+
+    k = min_period
+    out: list[str] = []
+    emitted = 0          # line[:emitted] already copied to `out`
+    floor = 0            # repeats may not start before this (text already collapsed)
+    seen: dict[str, list[int]] = {}
+    i = 0
+
+    while i + k <= n:
+        gram = line[i:i + k]
+        positions = seen.get(gram)
+        collapsed = False
+
+        if positions:
+            for j in reversed(positions):
+                period = i - j
+                if j < floor or period < min_period or period > max_period or i + period > n:
+                    continue
+                unit = line[j:i]
+                if line.startswith(unit, i):
+                    # Tandem repeat of `unit` starting at j: keep one copy, drop the rest.
+                    end = i + period
+                    while line.startswith(unit, end):
+                        end += period
+                    out.append(line[emitted:i])
+                    emitted = end
+                    floor = end
+                    seen.clear()
+                    i = end
+                    collapsed = True
+                    break
+
+        if collapsed:
+            continue
+
+        if positions is None:
+            seen[gram] = [i]
+        else:
+            if i - positions[-1] < min_period:
+                # Short-period run (table rules, dotted leaders): track only the latest
+                # position so these are never mistaken for a repeated phrase.
+                positions[-1] = i
+            else:
+                positions.append(i)
+                if len(positions) > _MAX_CANDIDATES:
+                    del positions[0]
+        i += 1
+
+    if emitted == 0:
+        return line
+    out.append(line[emitted:])
+    return "".join(out)
+
+
+def collapse_repeated_phrases(
+    text: str,
+    min_period: int = DEFAULT_MIN_PERIOD,
+    max_period: int = DEFAULT_MAX_PERIOD,
+) -> str:
+    """
+    Collapse immediately repeated phrases (`XX...X` -> `X`) of length
+    `min_period`..`max_period` within each line.
+
+    Each position is looked up in a table of recent `min_period`-grams and only a
+    bounded number of candidate periods is verified, so the cost is linear in the
+    text length (times `max_period` in the worst case) instead of the regex's
+    exponential backtracking.
+    """
+    if not text:
+        return text
+    return "\n".join(_collapse_line(line, min_period, max_period) for line in text.split("\n"))
+
+
+# --- Running headers / footers -------------------------------------------------
+
+HEADER_FOOTER_WINDOW = 3          # non-empty lines inspected at the top and bottom of each page
+DEFAULT_MIN_PAGE_RATIO = 0.3      # a line must occur on at least this share of pages...
+DEFAULT_MIN_PAGES = 3             # ...and on at least this many pages
+DEFAULT_SIMILARITY = 0.85         # difflib ratio for fuzzy matches ("Trang 1O" vs "Trang 10")
+_MAX_HEADER_CHARS = 200           # longer lines are body text, never running headers
+
+_DIGITS_RE = re.compile(r"\d+")
+_MARKUP_RE = re.compile(r"[#*_`>|]+")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def header_footer_key(line: str) -> str:
+    """
+    Comparison key for a candidate header/footer line: markdown stripped,
+    diacritics folded, lower-cased, digits replaced by '#' so that
+    "Trang 3/120" and "Trang 4/120" share a key.
+
+    Markdown headings keep their digits and get a "h:" prefix: "## Mục 3" and
+    "## Mục 4" are section titles, only an identical heading on many pages is
+    a running header.
+    """
+    heading = HEADER_RE.match(line) is not None
+    line = _MARKUP_RE.sub(" ", line)
+    line = remove_vietnamese_diacritics(line)
+    if not heading:
+        line = _DIGITS_RE.sub("#", line)
+    line = _SPACES_RE.sub(" ", line).strip()
+    return f"h:{line}" if heading and line else line
+
+
+def _split_pages(lines: list[str]) -> list[list[int]]:
+    """Line indices of each page's content (page marker lines excluded)."""
+    pages: list[list[int]] = [[]]
+    for index, line in enumerate(lines):
+        if PAGE_MARKER_RE.match(line):
+            pages.append([])
+        else:
+            pages[-1].append(index)
+    return [page for page in pages if page]
+
+
+def _edge_lines(lines: list[str], page: list[int], window: int) -> list[tuple[int, bool]]:
+    """
+    (index, outermost) for the first and last `window` non-empty lines of a
+    page; `outermost` marks the very first and very last line. Short pages get
+    a narrower window (a third of their lines) so their body is not all "edge".
+    """
+    non_empty = [i for i in page if lines[i].strip()]
+    if not non_empty:
+        return []
+    width = min(window, max(1, len(non_empty) // 3))
+    edge = sorted(set(non_empty[:width]) | set(non_empty[-width:]))
+    outer = {non_empty[0], non_empty[-1]}
+    return [(index, index in outer) for index in edge]
+
+
+def _is_candidate(line: str) -> bool:
+    stripped = line.strip()
+    # Table rows are page content even when they sit at the top or bottom of a page.
+    return bool(stripped) and not stripped.startswith("|") and len(stripped) <= _MAX_HEADER_CHARS
+
+
+def strip_running_headers_footers(
+    text: str,
+    min_page_ratio: float = DEFAULT_MIN_PAGE_RATIO,
+    min_pages: int = DEFAULT_MIN_PAGES,
+    similarity: float = DEFAULT_SIMILARITY,
+    window: int = HEADER_FOOTER_WINDOW,
+) -> tuple[str, dict]:
+    """
+    Remove lines that repeat at the top or bottom of many pages of page-marked
+    markdown. Returns (cleaned_text, stats).
+
+    Candidate lines (the first/last `window` non-empty lines of every page) are
+    grouped by `header_footer_key`; keys that occur on several pages seed the
+    groups and the remaining keys are attached to a seed when their difflib
+    ratio is at least `similarity`, which absorbs OCR noise. A group found on at
+    least max(`min_pages`, `min_page_ratio` * pages) pages is a running
+    header/footer and its lines are dropped, but only from the page edges.
+    Lines whose digits differ between pages are only taken from the very first
+    or last line of a page, where page numbers sit.
+    """
+    stats = {"pages": 0, "removed_lines": 0, "removed_chars": 0, "patterns": []}
+    if not text:
+        return text, stats
+
+    lines = text.split("\n")
+    pages = _split_pages(lines)
+    stats["pages"] = len(pages)
+    threshold = max(min_pages, int(min_page_ratio * len(pages) + 0.999))
+    if len(pages) < threshold:
+        return text, stats
+
+    key_variants: dict[str, set[str]] = defaultdict(set)
+    key_example: dict[str, str] = {}
+    edges: list[list[tuple[int, str, bool]]] = []
+    for page in pages:
+        page_edges = []
+        for index, outermost in _edge_lines(lines, page, window):
+            if not _is_candidate(lines[index]):
+                continue
+            key = header_footer_key(lines[index])
+            if not key:
+                continue
+            page_edges.append((index, key, outermost))
+            key_variants[key].add(lines[index].strip())
+            key_example.setdefault(key, lines[index].strip())
+        edges.append(page_edges)
+
+    # Lines that only share a key once their digits are masked ("Trang 3" /
+    # "Trang 4", but also "Phí quản lý: 1,5%" / "Phí quản lý: 2%") count only
+    # in the page-number position: the very first or last line of a page.
+    masked = {key for key, variants in key_variants.items() if len(variants) > 1 and "#" in key}
+    for page_edges in edges:
+        page_edges[:] = [edge for edge in page_edges if edge[2] or edge[1] not in masked]
+
+    # key -> pages it appears on (at a page edge)
+    key_pages: dict[str, set[int]] = defaultdict(set)
+    for page_no, page_edges in enumerate(edges):
+        for _, key, _ in page_edges:
+            key_pages[key].add(page_no)
+
+    # Keys seen on 2+ pages seed the groups (most frequent first); one-off keys
+    # and near-duplicate seeds join the closest seed. Comparing against seeds
+    # only keeps this at O(candidates * seeds) difflib calls.
+    seeds = {key for key, seen_on in key_pages.items() if len(seen_on) > 1}
+    group_of: dict[str, str] = {}
+    group_pages: dict[str, set[int]] = {}
+    for key in sorted(key_pages, key=lambda k: -len(key_pages[k])):
+        target = None
+        matcher = difflib.SequenceMatcher(None, b=key)
+        for seed in group_pages:
+            if key.startswith("h:") or seed.startswith("h:"):
+                continue  # headings only group on an exact key
+            if abs(len(seed) - len(key)) > (1 - similarity) * max(len(seed), len(key)) + 1:
+                continue
+            matcher.set_seq1(seed)
+            if matcher.real_quick_ratio() >= similarity and matcher.quick_ratio() >= similarity \
+                    and matcher.ratio() >= similarity:
+                target = seed
+                break
+        if target is None:
+            if key not in seeds:
+                continue
+            target = key
+            group_pages[target] = set()
+        group_of[key] = target
+        group_pages[target] |= key_pages[key]
+
+    running = {seed for seed, seen_on in group_pages.items() if len(seen_on) >= threshold}
+    if not running:
+        return text, stats
+
+    drop: set[int] = set()
+    removed_per_group: dict[str, int] = defaultdict(int)
+    for page_edges in edges:
+        for index, key, _ in page_edges:
+            group = group_of.get(key)
+            if group in running:
+                drop.add(index)
+                removed_per_group[group] += 1
+
+    stats["removed_lines"] = len(drop)
+    stats["removed_chars"] = sum(len(lines[i]) + 1 for i in drop)
+    stats["patterns"] = [
+        {"text": key_example[seed], "pages": len(group_pages[seed]), "removed": removed_per_group[seed]}
+        for seed in sorted(running, key=lambda g: -removed_per_group[g])[:20]
+    ]
+    cleaned = "\n".join(line for i, line in enumerate(lines) if i not in drop)
+    return cleaned, stats
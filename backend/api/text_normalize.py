@@ -0,0 +1,37 @@
+"""
+Accent-insensitive text normalization shared by the matching heuristics.
+
+OCR output and user questions mix accented and unaccented Vietnamese
+("phí quản lý" / "phi quan ly"), so keyword, header and phrase matching all
+compare folded text.
+"""
+import re
+import unicodedata
+
+WORD_RE = re.compile(r"\w+")
+
+# Characters that do not decompose into a base letter and a combining mark.
+_NON_DECOMPOSING = str.maketrans({"đ": "d", "Đ": "D", "ð": "d"})
+
+
+def remove_vietnamese_diacritics(text: str) -> str:
+    """
+    Remove Vietnamese diacritics and lower-case the text.
+    Used for flexible matching when OCR strips diacritics.
+
+    Examples:
+        'tên quỹ' → 'ten quy'
+        'công ty quản lý' → 'cong ty quan ly'
+    """
+    text = unicodedata.normalize("NFD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return text.translate(_NON_DECOMPOSING).lower()
+
+
+def fold_words(text: str) -> str:
+    """
+    Folded text reduced to its words, separated by single spaces:
+    'Phí  quản lý (năm)?' → 'phi quan ly nam'. Padding the result with spaces
+    allows whole-phrase lookups with `in`.
+    """
+    return " ".join(WORD_RE.findall(remove_vietnamese_diacritics(text)))
@@ -0,0 +1,490 @@
+"""
+Bulk loading and nearest-neighbour search for DocumentChunk rows.
+
+`bulk_create` sends every 1024-dim embedding as a text literal through the
+ORM. `copy_document_chunks` streams rows with `COPY ... FROM STDIN (FORMAT
+BINARY)` instead: the PGCOPY stream is encoded here, embeddings use pgvector's
+binary wire format (uint16 dim, uint16 unused, dim x float32 big-endian), so
+nothing is formatted or parsed as text on either side.
+
+`nearest_chunks` searches one of three HNSW indexes (RAG_VECTOR_STORAGE):
+the full-precision `vector` index, a `halfvec` expression index (half the
+memory) or a binary-quantized expression index (1/32 of the memory). The
+quantized modes fetch `limit * RAG_RERANK_FACTOR` candidates from their index
+and re-rank them by exact cosine distance on the stored full vectors.
+
+All chunks share one HNSW index, but chat filters on one document. With a
+filter, HNSW returns the `ef_search` nearest chunks of the whole corpus and
+drops those of other documents, so a small document may get fewer rows
+than requested. Postgres may also pick the index when a scan of the
+document's few rows would be cheaper. `plan_search` picks the strategy per
+query. Documents up to RAG_EXACT_SEARCH_MAX_CHUNKS chunks get an exact
+scan of their own rows, with index scans disabled for the query. Larger
+ones get HNSW with a raised `hnsw.ef_search` and, on pgvector >= 0.8,
+`hnsw.iterative_scan`, so the filtered scan continues until `limit` rows
+are found.
+
+`keyword_search` ranks chunks with Postgres full-text search over the
+generated `search_vector` column (GIN index, accent-insensitive), which finds
+exact tokens such as fund codes, license numbers and percentages that
+embeddings blur. `reciprocal_rank_fusion` merges the keyword and vector
+rankings for hybrid retrieval (RAG_HYBRID_SEARCH).
+"""
+import os
+import re
+import struct
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone as dt_timezone
+from typing import NamedTuple
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection, transaction
+from django.db.models import F, Func, Value
+from django.db.models.functions import Cast
+from django.utils import timezone
+from pgvector.django import BitField, CosineDistance, HalfVectorField, HammingDistance, VectorField
+
+from .embeddings import EMBEDDING_DIMENSIONS
+from .models import SEARCH_CONFIG, DocumentChunk
+from .text_normalize import remove_vietnamese_diacritics
+
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PGCOPY_TRAILER = struct.pack(">h", -1)
+INT4_OID = 23
+_PG_EPOCH = datetime(2000, 1, 1, tzinfo=dt_timezone.utc)
+_FLUSH_BYTES = 1 << 20
+
+# Column order of the COPY statement (generated columns are computed by Postgres).
+COPY_FIELDS = ('document', 'content', 'page_number', 'content_hash', 'alias_pages', 'embedding', 'created_at')
+
+
+def _field(payload: bytes) -> bytes:
+    return struct.pack(">i", len(payload)) + payload
+
+
+def _encode_int4_array(values) -> bytes:
+    values = list(values or [])
+    if not values:
+        return struct.pack(">iii", 0, 0, INT4_OID)
+    head = struct.pack(">iiiii", 1, 0, INT4_OID, len(values), 1)
+    body = b"".join(struct.pack(">ii", 4, int(v)) for v in values)
+    return head + body
+
+
+def _encode_vector(vector) -> bytes:
+    import numpy as np
+
+    values = np.asarray(vector, dtype=">f4")
+    if values.ndim != 1:
+        raise ValueError(f"expected a 1-d embedding, got shape {values.shape}")
+    return struct.pack(">HH", values.shape[0], 0) + values.tobytes()
+
+
+def _encode_timestamptz(value: datetime) -> bytes:
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, dt_timezone.utc)
+    delta = value - _PG_EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+    return struct.pack(">q", micros)
+
+
+def encode_chunk_row(chunk: DocumentChunk, created_at: datetime) -> bytes:
+    """One PGCOPY binary tuple for an unsaved DocumentChunk, in COPY_FIELDS order."""
+    return b"".join((
+        struct.pack(">h", len(COPY_FIELDS)),
+        _field(struct.pack(">q", chunk.document_id)),
+        _field(chunk.content.encode("utf-8")),
+        _field(struct.pack(">i", chunk.page_number)),
+        _field((chunk.content_hash or "").encode("utf-8")),
+        _field(_encode_int4_array(chunk.alias_pages)),
+        _field(_encode_vector(chunk.embedding)),
+        _field(_encode_timestamptz(chunk.created_at or created_at)),
+    ))
+
+
+def copy_supported() -> bool:
+    """COPY loading needs PostgreSQL through psycopg 3 (psycopg2 has no `cursor.copy`)."""
+    if connection.vendor != 'postgresql':
+        return False
+    try:
+        import psycopg  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def copy_document_chunks(chunks: list[DocumentChunk]) -> int:
+    """
+    Insert unsaved DocumentChunk objects with a binary COPY. Returns the row count.
+
+    Runs on Django's connection, so it joins the caller's transaction.atomic()
+    block. Row ids are not set on the objects.
+    """
+    if not chunks:
+        return 0
+
+    opts = DocumentChunk._meta
+    qn = connection.ops.quote_name
+    columns = ", ".join(qn(opts.get_field(name).column) for name in COPY_FIELDS)
+    statement = f"COPY {qn(opts.db_table)} ({columns}) FROM STDIN WITH (FORMAT BINARY)"
+    created_at = timezone.now()
+
+    connection.ensure_connection()
+    with connection.cursor() as cursor:
+        # Django's CursorWrapper -> underlying psycopg 3 cursor
+        with cursor.cursor.copy(statement) as copy:
+            buffer = bytearray(PGCOPY_HEADER)
+            for chunk in chunks:
+                buffer += encode_chunk_row(chunk, created_at)
+                if len(buffer) >= _FLUSH_BYTES:
+                    copy.write(bytes(buffer))
+                    buffer.clear()
+            buffer += PGCOPY_TRAILER
+            copy.write(bytes(buffer))
+    return len(chunks)
+
+
+def save_document_chunks(chunks: list[DocumentChunk], batch_size: int = 500) -> int:
+    """
+    Persist new chunks: binary COPY when available (RAG_COPY_LOAD, default on),
+    otherwise DocumentChunk.objects.bulk_create.
+    """
+    copy_raw = os.getenv("RAG_COPY_LOAD", "true").strip().lower()
+    if copy_raw not in {"0", "false", "no", "off"} and copy_supported():
+        return copy_document_chunks(chunks)
+    DocumentChunk.objects.bulk_create(chunks, batch_size=batch_size)
+    return len(chunks)
+
+
+# --- Nearest-neighbour search ------------------------------------------------
+
+VECTOR_STORAGE_MODES = ('full', 'halfvec', 'binary')
+DEFAULT_RERANK_FACTOR = 4
+
+
+def vector_storage_mode() -> str:
+    mode = os.getenv("RAG_VECTOR_STORAGE", "full").strip().lower()
+    if mode not in VECTOR_STORAGE_MODES:
+        raise ValueError(f"Invalid RAG_VECTOR_STORAGE: {mode}. Use 'full', 'halfvec', or 'binary'")
+    return mode
+
+
+def default_rerank_factor() -> int:
+    return max(int(os.getenv("RAG_RERANK_FACTOR", str(DEFAULT_RERANK_FACTOR))), 1)
+
+
+def _vector_literal(vector) -> str:
+    return "[" + ",".join(repr(float(x)) for x in vector) + "]"
+
+
+def halfvec_distance(query_vector):
+    """Cosine distance on `embedding::halfvec(1024)` (matches chunk_embedding_halfvec_idx)."""
+    return CosineDistance(
+        Cast('embedding', HalfVectorField(dimensions=EMBEDDING_DIMENSIONS)),
+        Cast(Value(_vector_literal(query_vector)), HalfVectorField(dimensions=EMBEDDING_DIMENSIONS)),
+    )
+
+
+def binary_distance(query_vector):
+    """Hamming distance on `binary_quantize(embedding)::bit(1024)` (matches chunk_embedding_bit_idx)."""
+    return HammingDistance(
+        Cast(Func('embedding', function='binary_quantize'), BitField(length=EMBEDDING_DIMENSIONS)),
+        Func(
+            Cast(Value(_vector_literal(query_vector)), VectorField(dimensions=EMBEDDING_DIMENSIONS)),
+            function='binary_quantize',
+            output_field=BitField(length=EMBEDDING_DIMENSIONS),
+        ),
+    )
+
+
+def nearest_chunks(queryset, query_vector, limit: int = 25, mode: str | None = None, rerank_factor: int | None = None):
+    """
+    The `limit` chunks of `queryset` closest to `query_vector`, ordered by exact
+    cosine distance (annotated as `distance`). Still a lazy queryset: callers
+    can add .only()/.values() before evaluating it.
+    """
+    mode = mode or vector_storage_mode()
+    if mode == 'full':
+        return queryset.annotate(distance=CosineDistance('embedding', query_vector)).order_by('distance')[:limit]
+
+    if rerank_factor is None:
+        rerank_factor = default_rerank_factor()
+    approximate = halfvec_distance(query_vector) if mode == 'halfvec' else binary_distance(query_vector)
+    candidate_ids = (
+        queryset.annotate(approx_distance=approximate)
+        .order_by('approx_distance')
+        .values('id')[:limit * max(rerank_factor, 1)]
+    )
+    # One round trip: candidates come from the quantized index in a subquery, then exact re-ranking.
+    return (
+        queryset.filter(id__in=candidate_ids)
+        .annotate(distance=CosineDistance('embedding', query_vector))
+        .order_by('distance')[:limit]
+    )
+
+
+class RetrievedChunk(NamedTuple):
+    id: int
+    page_number: int
+    alias_pages: list
+    content: str
+    # Cosine distance; None for chunks found only by keyword search
+    distance: float | None
+    # Fused (RRF) score in hybrid retrieval, keyword rank score in keyword_search
+    score: float = 0.0
+
+
+# --- Search planning (filtered ANN) ----------------------------------------------
+
+SEARCH_STRATEGIES = ('auto', 'exact', 'hnsw')
+DEFAULT_EXACT_MAX_CHUNKS = 5000
+DEFAULT_EF_SEARCH = 100
+DEFAULT_MAX_SCAN_TUPLES = 20000
+# pgvector's upper bound for hnsw.ef_search
+MAX_EF_SEARCH = 1000
+_pgvector_version: tuple | None = None
+
+
+def pgvector_version() -> tuple:
+    """Installed pgvector extension version, e.g. (0, 8, 0); cached per process."""
+    global _pgvector_version
+    if _pgvector_version is None:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+            row = cursor.fetchone()
+        parts = (row[0] if row else "0").split(".")
+        _pgvector_version = tuple(int(p) for p in parts if p.isdigit())
+    return _pgvector_version
+
+
+@dataclass
+class SearchPlan:
+    """How one nearest-neighbour query is executed."""
+    strategy: str                   # 'exact' or 'hnsw'
+    chunk_count: int | None = None  # rows matching the filter, when counted
+    ef_search: int | None = None
+    iterative_scan: str | None = None
+    max_scan_tuples: int | None = None
+    # Quantized storage: index candidates per result re-ranked on the full vectors
+    rerank_factor: int | None = None
+
+    def describe(self) -> str:
+        if self.strategy == 'exact':
+            return f"exact ({self.chunk_count} chunks)"
+        parts = [f"hnsw ef_search={self.ef_search}"]
+        if self.iterative_scan:
+            parts.append(f"iterative_scan={self.iterative_scan}")
+        if self.rerank_factor:
+            parts.append(f"rerank_factor={self.rerank_factor}")
+        if self.chunk_count is not None:
+            parts.append(f"{self.chunk_count} chunks")
+        return " ".join(parts)
+
+
+def plan_search(
+    queryset, limit: int = 25, strategy: str | None = None, chunk_count: int | None = None,
+    mode: str | None = None, ef_search: int | None = None,
+) -> SearchPlan:
+    """
+    Choose exact or HNSW search for `queryset` (RAG_SEARCH_STRATEGY=auto|exact|hnsw).
+    In 'auto' mode the filtered row count decides: chat passes the document's
+    stored `chunk_count`; without one, an index-only count query runs.
+
+    `limit` is the number of rows the caller asks for (hybrid retrieval: its
+    candidate count). In the quantized storage `mode`s the index scan has to
+    return `limit * RAG_RERANK_FACTOR` candidates, so `hnsw.ef_search` is sized
+    from that. Without iterative scans (pgvector < 0.8) HNSW returns at most
+    ef_search rows, so the re-rank factor is lowered to fit MAX_EF_SEARCH.
+    """
+    strategy = (strategy or os.getenv("RAG_SEARCH_STRATEGY", "auto")).strip().lower()
+    if strategy not in SEARCH_STRATEGIES:
+        raise ValueError(f"Invalid RAG_SEARCH_STRATEGY: {strategy}. Use 'auto', 'exact', or 'hnsw'")
+
+    if strategy == 'auto':
+        if chunk_count is None:
+            chunk_count = queryset.count()
+        max_exact = int(os.getenv("RAG_EXACT_SEARCH_MAX_CHUNKS", str(DEFAULT_EXACT_MAX_CHUNKS)))
+        strategy = 'exact' if chunk_count <= max_exact else 'hnsw'
+    if strategy == 'exact':
+        return SearchPlan('exact', chunk_count)
+
+    if ef_search is None:
+        ef_search = int(os.getenv("RAG_HNSW_EF_SEARCH", str(DEFAULT_EF_SEARCH)))
+    plan = SearchPlan('hnsw', chunk_count)
+    if pgvector_version() >= (0, 8):
+        plan.iterative_scan = os.getenv("RAG_HNSW_ITERATIVE_SCAN", "relaxed_order").strip().lower()
+        plan.max_scan_tuples = int(os.getenv("RAG_HNSW_MAX_SCAN_TUPLES", str(DEFAULT_MAX_SCAN_TUPLES)))
+    iterative = plan.iterative_scan not in (None, 'off')
+
+    index_rows = limit
+    if (mode or vector_storage_mode()) != 'full':
+        plan.rerank_factor = default_rerank_factor()
+        if not iterative and limit * plan.rerank_factor > MAX_EF_SEARCH:
+            plan.rerank_factor = max(MAX_EF_SEARCH // max(limit, 1), 1)
+        index_rows = limit * plan.rerank_factor
+    plan.ef_search = min(max(ef_search, index_rows), MAX_EF_SEARCH)
+    return plan
+
+
+def apply_search_plan(plan: SearchPlan) -> None:
+    """
+    Transaction-local planner settings for `plan`; call inside transaction.atomic().
+    Every setting is written each time: SET LOCAL inside a savepoint lasts until
+    the outer transaction ends, so an earlier plan's settings may still be active.
+    """
+    with connection.cursor() as cursor:
+        # HNSW only supports plain index scans; with them off the document_id btree
+        # is still used through a bitmap scan.
+        cursor.execute(
+            "SELECT set_config('enable_indexscan', %s, true)",
+            ['off' if plan.strategy == 'exact' else 'on'],
+        )
+        if plan.strategy == 'exact':
+            return
+        cursor.execute("SELECT set_config('hnsw.ef_search', %s, true)", [str(plan.ef_search)])
+        if pgvector_version() >= (0, 8):
+            cursor.execute("SELECT set_config('hnsw.iterative_scan', %s, true)", [plan.iterative_scan or 'off'])
+            if plan.max_scan_tuples:
+                cursor.execute("SELECT set_config('hnsw.max_scan_tuples', %s, true)", [str(plan.max_scan_tuples)])
+
+
+@dataclass
+class RetrievalResult:
+    """Chunks returned by one retrieval, plus where the time went (milliseconds)."""
+    chunks: list[RetrievedChunk] = field(default_factory=list)
+    embed_ms: float = 0.0
+    search_ms: float = 0.0
+    # Keyword search runs while the query is embedded, so it is not added to total_ms
+    keyword_ms: float = 0.0
+    keyword_hits: int = 0
+    # Where the query vector came from: 'memory', 'db' (query cache) or 'backend'
+    query_cache: str = ''
+    # SearchPlan.describe() of the vector search
+    search_plan: str = ''
+
+    @property
+    def total_ms(self) -> float:
+        return max(self.embed_ms, self.keyword_ms) + self.search_ms
+
+    @property
+    def contexts(self) -> list[str]:
+        return [c.content for c in self.chunks]
+
+    def timings(self) -> dict:
+        return {
+            'embed_ms': round(self.embed_ms, 1),
+            'search_ms': round(self.search_ms, 1),
+            'keyword_ms': round(self.keyword_ms, 1),
+            'total_ms': round(self.total_ms, 1),
+            'query_cache': self.query_cache,
+            'keyword_hits': self.keyword_hits,
+            'search_plan': self.search_plan,
+        }
+
+
+def search_chunks(
+    queryset, query_vector, limit: int = 25, mode: str | None = None, plan: SearchPlan | None = None,
+) -> tuple[list[RetrievedChunk], float]:
+    """
+    Run `nearest_chunks` once under `plan` (default: `plan_search`), fetching
+    only the columns the prompt needs (never the 1024-float embedding).
+    Returns (chunks, elapsed milliseconds).
+    """
+    start = time.perf_counter()
+    if plan is None:
+        plan = plan_search(queryset, limit, mode=mode)
+    # Exact search scans the stored full vectors; quantized indexes only help HNSW.
+    mode = 'full' if plan.strategy == 'exact' else mode
+    with transaction.atomic():
+        apply_search_plan(plan)
+        rows = list(nearest_chunks(
+            queryset, query_vector, limit=limit, mode=mode, rerank_factor=plan.rerank_factor,
+        ).values_list(
+            'id', 'page_number', 'alias_pages', 'content', 'distance'
+        ))
+    # relaxed_order iterative scans may return rows slightly out of order
+    chunks = sorted((RetrievedChunk(*row) for row in rows), key=lambda c: c.distance)
+    return chunks, (time.perf_counter() - start) * 1000
+
+
+# --- Keyword search and rank fusion ---------------------------------------------
+
+DEFAULT_RRF_K = 60
+_MAX_KEYWORD_TERMS = 16
+# Codes, numbers and words; keeps "VCBF-BCF", "12/GCN-UBCK", "1,5%" as one term.
+_TERM_RE = re.compile(r"\w+(?:[.,/-]\w+)*%?")
+# Question words and particles (accent-folded) that would match almost every chunk.
+_QUERY_STOPWORDS = frozenset(
+    "la gi nao bao nhieu cua va co khong cho duoc trong cac nhung nay the nhu voi ve "
+    "hoi toi ban hay xin vui long thi o tai de khi nao sao vay a "
+    "what which how is are the of for and or in on to a an does do".split()
+)
+
+
+def keyword_terms(text: str) -> list[str]:
+    """Distinct search terms of a question, stop words dropped, in order of appearance."""
+    terms = []
+    seen = set()
+    for term in _TERM_RE.findall(text or ""):
+        folded = remove_vietnamese_diacritics(term)
+        if folded in seen or folded in _QUERY_STOPWORDS or (len(term) < 2 and not term.isdigit()):
+            continue
+        seen.add(folded)
+        terms.append(term)
+        if len(terms) >= _MAX_KEYWORD_TERMS:
+            break
+    return terms
+
+
+def keyword_query(text: str) -> SearchQuery | None:
+    """OR of the question's terms (each term's own tokens ANDed), or None when nothing is left."""
+    query = None
+    for term in keyword_terms(text):
+        part = SearchQuery(term, config=SEARCH_CONFIG, search_type="plain")
+        query = part if query is None else query | part
+    return query
+
+
+def keyword_search(queryset, text: str, limit: int = 25, close_connection: bool = False) -> tuple[list[RetrievedChunk], float]:
+    """
+    Full-text ranking (ts_rank_cd, length-normalized) of `queryset` for `text`
+    via the GIN index on `search_vector`. Returns (chunks, elapsed milliseconds).
+
+    `close_connection` closes this thread's database connection afterwards, for
+    calls made from a worker thread.
+    """
+    start = time.perf_counter()
+    try:
+        query = keyword_query(text)
+        if query is None:
+            return [], 0.0
+        rows = (
+            queryset.filter(search_vector=query)
+            .annotate(rank=SearchRank(F('search_vector'), query, cover_density=True, normalization=1))
+            .order_by('-rank', 'id')
+            .values_list('id', 'page_number', 'alias_pages', 'content', 'rank')[:limit]
+        )
+        chunks = [RetrievedChunk(id, page, aliases, content, None, rank) for id, page, aliases, content, rank in rows]
+        return chunks, (time.perf_counter() - start) * 1000
+    finally:
+        if close_connection:
+            connection.close()
+
+
+def reciprocal_rank_fusion(rankings: list[list[RetrievedChunk]], limit: int = 25, k: int = DEFAULT_RRF_K) -> list[RetrievedChunk]:
+    """
+    Merge ranked lists: score(chunk) = sum over lists of 1 / (k + rank). Rank
+    positions are all that is compared, so cosine distances and text ranks
+    need no common scale. The vector distance is kept when a chunk has one.
+    """
+    scores: dict[int, float] = {}
+    chunks: dict[int, RetrievedChunk] = {}
+    for ranking in rankings:
+        for rank, chunk in enumerate(ranking, start=1):
+            scores[chunk.id] = scores.get(chunk.id, 0.0) + 1.0 / (k + rank)
+            known = chunks.get(chunk.id)
+            if known is None or (known.distance is None and chunk.distance is not None):
+                chunks[chunk.id] = chunk
+    ordered = sorted(scores, key=lambda chunk_id: (-scores[chunk_id], chunk_id))[:limit]
+    return [chunks[chunk_id]._replace(score=round(scores[chunk_id], 6)) for chunk_id in ordered]
@@ -2,11 +2,14 @@ from rest_framework.decorators import api_view, parser_classes
 from rest_framework.response import Response
 from rest_framework import status, viewsets
 from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.settings import api_settings
 from rest_framework.decorators import action
-from django.http import FileResponse, Http404, HttpResponse
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from django.db import models as dj_models
+from django.db import models as dj_models, transaction
+import json
 import logging
 import os
 import threading
@@ -14,7 +17,7 @@ import fitz
 import io
 import base64
 
-from .models import Document, ExtractedFundData, DocumentChangeLog
+from .models import Document, ExtractedFundData, DocumentChangeLog, RagIngestionCheckpoint
 from .serializers import (
     MessageSerializer,
     DocumentSerializer,
@@ -24,13 +27,39 @@ from .serializers import (
     DocumentChangeLogSerializer,
     ChatRequestSerializer,
     ChatResponseSerializer,
-    ChatHistorySerializer
+    ChatHistorySerializer,
+    CorpusSearchRequestSerializer
 )
+from .embeddings import EmbeddingModelMismatch, query_cache_stats
 from .services import DocumentProcessingService, RAGService
+from .answer_cache import invalidate_answer_cache
+from .chat_counters import chat_metrics
+from .corpus_search import CORPUS_FILTER_FIELDS
+from .structured_summary import invalidate_structured_summary, refresh_structured_summary
 
 logger = logging.getLogger(__name__)
 
 
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Accepts `Accept: text/event-stream` in content negotiation for chat_stream.
+    The answer itself is a StreamingHttpResponse; what is rendered here are the
+    errors returned before streaming starts, sent as a single `error` event.
+    """
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not (isinstance(data, dict) and 'error' in data):
+            data = {'error': 'Invalid request', 'details': data}
+        return _sse_event('error', data).encode(self.charset)
+
+
 class DocumentViewSet(viewsets.ModelViewSet):
     """
     ViewSet for handling document CRUD operations
@@ -157,6 +186,9 @@ class DocumentViewSet(viewsets.ModelViewSet):
                     user_comment=user_comment,
                     changes=changes
                 )
+                # Cached chat answers and the prompt's structured block may quote the old values
+                invalidate_answer_cache(instance.id)
+                invalidate_structured_summary(instance)
         
         self.perform_update(serializer)
         
@@ -261,6 +293,11 @@ class DocumentViewSet(viewsets.ModelViewSet):
                 logger.info(f"Document {instance.id} edited. Total edits: {instance.edit_count}")
             except Exception as e:
                 logger.error(f"Error syncing ExtractedFundData: {e}")
+
+            try:
+                refresh_structured_summary(instance.id)
+            except Exception as e:
+                logger.warning(f"Failed to rebuild structured summary for document {instance.id}: {e}")
         
         return Response(serializer.data)
     
@@ -529,6 +566,37 @@ class DocumentViewSet(viewsets.ModelViewSet):
             'failed': failed
         })
 
+    @action(detail=False, methods=['get', 'post'])
+    def search(self, request):
+        """
+        Semantic search across all RAG-indexed documents, grouped per document
+        GET /api/documents/search/?q=...&fund_type=&management_company=&custodian_bank=&page=1&page_size=10
+        POST with the same fields as a JSON body
+        """
+        serializer = CorpusSearchRequestSerializer(data=request.data if request.method == 'POST' else request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        params = serializer.validated_data
+        filters = {name: params.get(name, '').strip() for name in CORPUS_FILTER_FIELDS}
+        try:
+            logger.info(f"Corpus search: {params['q'][:50]}... filters={filters}")
+            rag_service = RAGService()
+            result = rag_service.search_corpus(
+                params['q'],
+                filters=filters,
+                page=params['page'],
+                page_size=params['page_size'],
+                chunks_per_document=params['chunks_per_document'],
+            )
+            return Response(result)
+        except Exception as e:
+            logger.error(f"Corpus search error: {str(e)}")
+            return Response(
+                {'error': f'Failed to search documents: {str(e)}'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
     @action(detail=True, methods=['get'])
     def rag_status(self, request, pk=None):
         """
@@ -537,6 +605,20 @@ class DocumentViewSet(viewsets.ModelViewSet):
         """
         document = self.get_object()
         chunks_count = document.chunks.count()
+
+        checkpoint = None
+        try:
+            cp = document.rag_checkpoint
+            checkpoint = {
+                'stage': cp.stage,
+                'mode': cp.mode,
+                'completed_batches': cp.completed_batches,
+                'total_batches': cp.total_batches,
+                'saved_chunks': cp.saved_chunks,
+                'updated_at': cp.updated_at,
+            }
+        except RagIngestionCheckpoint.DoesNotExist:
+            pass
         
         return Response({
             'is_ingested': chunks_count > 0,
@@ -547,6 +629,13 @@ class DocumentViewSet(viewsets.ModelViewSet):
             'rag_error_message': getattr(document, 'rag_error_message', None),
             'rag_started_at': getattr(document, 'rag_started_at', None),
             'rag_completed_at': getattr(document, 'rag_completed_at', None),
+            'rag_metrics': {**(getattr(document, 'rag_metrics', None) or {}), **chat_metrics(document.id)},
+            'rag_pages_total': document.rag_pages_total,
+            'rag_pages_indexed': document.rag_pages_indexed,
+            'rag_coverage': document.rag_coverage,
+            'rag_checkpoint': checkpoint,
+            # Process-wide (not per document): query embedding cache hits since start-up.
+            'query_embedding_cache': query_cache_stats(),
         })
     
     @action(detail=True, methods=['post'])
@@ -554,6 +643,7 @@ class DocumentViewSet(viewsets.ModelViewSet):
         """
         Process document for RAG (vectorize and store chunks)
         POST /api/documents/{id}/ingest_for_rag/
+        Body (optional): {"mode": "incremental" | "full", "resume": true}
         """
         document = self.get_object()
         
@@ -565,8 +655,14 @@ class DocumentViewSet(viewsets.ModelViewSet):
         
         try:
             logger.info(f"Starting RAG ingestion for document {document.id}")
+            mode = str(request.data.get('mode', '') or '').strip().lower()
+            incremental = None if not mode else mode != 'full'
+            # A forced full rebuild never resumes an earlier checkpoint.
+            resume = str(request.data.get('resume', 'true')).strip().lower() not in {"0", "false", "no", "off"}
+            resume = resume and mode != 'full'
+
             rag_service = RAGService()
-            success = rag_service.ingest_document(document.id)
+            success = rag_service.ingest_document(document.id, incremental=incremental, resume=resume)
             
             chunks_count = document.chunks.count()
             logger.info(f"RAG ingestion completed. Created {chunks_count} chunks.")
@@ -602,12 +698,19 @@ class DocumentViewSet(viewsets.ModelViewSet):
         """
         document = self.get_object()
         
-        # Check if document has been ingested
+        # Check if document has been ingested. While ingestion is running, chat is
+        # allowed as soon as the first page range is committed (partial coverage).
         if not document.chunks.exists():
+            if document.rag_status in {'queued', 'running'}:
+                error = 'Document is still being indexed for RAG. Please retry in a moment.'
+            else:
+                error = 'Document not ingested yet for RAG. Please call /documents/{id}/ingest_for_rag/ first.'
             return Response(
                 {
-                    'error': 'Document not ingested yet for RAG. Please call /documents/{id}/ingest_for_rag/ first.',
-                    'chunks_count': 0
+                    'error': error,
+                    'chunks_count': 0,
+                    'rag_status': document.rag_status,
+                    'rag_coverage': document.rag_coverage,
                 },
                 status=status.HTTP_400_BAD_REQUEST
             )
@@ -622,16 +725,31 @@ class DocumentViewSet(viewsets.ModelViewSet):
         
         try:
             logger.info(f"RAG chat query for document {document.id}: {user_query[:50]}...")
+            asked_at = timezone.now()
             rag_service = RAGService()
-            answer = rag_service.chat(document.id, user_query, history)
+            result = rag_service.chat(document.id, user_query, history, return_source=True)
             
+            document.refresh_from_db(fields=['rag_status', 'rag_pages_total', 'rag_pages_indexed'])
             response_data = {
-                'answer': answer,
+                'answer': result['text'],
                 'query': user_query,
-                'chunks_count': document.chunks.count()
+                'chunks_count': document.chunks.count(),
+                'rag_status': document.rag_status,
+                'rag_coverage': document.rag_coverage,
+                'timings': result.get('timings', {}),
+                'context_usage': result.get('context_usage', {}),
+                'cached': result.get('cached'),
+                'routed': result.get('routed'),
             }
+            if 'error' not in result:
+                self._append_chat_turn(document, user_query, response_data['answer'], asked_at, response_data['chunks_count'])
             
             return Response(response_data)
+        except EmbeddingModelMismatch as e:
+            return Response(
+                {'error': str(e), 'rag_embedding_model': document.rag_embedding_model},
+                status=status.HTTP_409_CONFLICT
+            )
         except Exception as e:
             logger.error(f"RAG chat error for document {document.id}: {str(e)}")
             return Response(
@@ -639,6 +757,103 @@ class DocumentViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(
+        detail=True,
+        methods=['post'],
+        url_path='chat_stream',
+        renderer_classes=[*api_settings.DEFAULT_RENDERER_CLASSES, EventStreamRenderer],
+    )
+    def chat_stream(self, request, pk=None):
+        """
+        Chat with document using RAG, streamed as Server-Sent Events
+        POST /api/documents/{id}/chat_stream/
+        Body: {"query": "...", "history": [...]}
+
+        Events: `token` ({"text": delta}) while the answer is generated, then `done`
+        (answer, sources, timings, context_usage) or `error`. The finished turn is
+        appended to the document's chat history.
+        """
+        document = self.get_object()
+
+        if not document.chunks.exists():
+            if document.rag_status in {'queued', 'running'}:
+                error = 'Document is still being indexed for RAG. Please retry in a moment.'
+            else:
+                error = 'Document not ingested yet for RAG. Please call /documents/{id}/ingest_for_rag/ first.'
+            return Response(
+                {
+                    'error': error,
+                    'chunks_count': 0,
+                    'rag_status': document.rag_status,
+                    'rag_coverage': document.rag_coverage,
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        serializer = ChatRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        user_query = serializer.validated_data['query']
+        history = serializer.validated_data.get('history', [])
+        logger.info(f"RAG streaming chat query for document {document.id}: {user_query[:50]}...")
+
+        def event_stream():
+            asked_at = timezone.now()
+            try:
+                rag_service = RAGService()
+            except Exception as e:
+                logger.error(f"RAG chat error for document {document.id}: {str(e)}")
+                yield _sse_event('error', {'error': f'Failed to process chat: {str(e)}'})
+                return
+
+            for event, data in rag_service.chat_stream(document.id, user_query, history):
+                if event == 'done':
+                    document.refresh_from_db(fields=['rag_status', 'rag_pages_total', 'rag_pages_indexed'])
+                    data = {
+                        'answer': data['text'],
+                        'query': user_query,
+                        'chunks_count': document.chunks.count(),
+                        'rag_status': document.rag_status,
+                        'rag_coverage': document.rag_coverage,
+                        'sources': data.get('sources', []),
+                        'timings': data.get('timings', {}),
+                        'context_usage': data.get('context_usage', {}),
+                        'cached': data.get('cached'),
+                        'routed': data.get('routed'),
+                    }
+                    self._append_chat_turn(document, user_query, data['answer'], asked_at, data['chunks_count'])
+                yield _sse_event(event, data)
+
+        response = StreamingHttpResponse(event_stream(), content_type='text/event-stream; charset=utf-8')
+        response['Cache-Control'] = 'no-cache'
+        # Disable proxy buffering (nginx) so tokens reach the browser as they are produced
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @staticmethod
+    def _append_chat_turn(document, user_query: str, answer: str, asked_at, chunks_count: int, max_messages: int = 200):
+        """
+        Persist a finished turn of /chat/ or /chat_stream/. The server is the only
+        writer of chat turns (the panel no longer PUTs its state), and the row lock
+        keeps two concurrent turns on one document from dropping each other's turn.
+        """
+        try:
+            with transaction.atomic():
+                locked = Document.objects.select_for_update().only('id', 'chat_history').get(pk=document.pk)
+                history = list(locked.chat_history or [])
+                history.append({'sender': 'user', 'text': user_query, 'timestamp': asked_at.isoformat()})
+                history.append({
+                    'sender': 'ai',
+                    'text': answer,
+                    'timestamp': timezone.now().isoformat(),
+                    'chunks_count': chunks_count,
+                })
+                locked.chat_history = history[-max_messages:]
+                locked.save(update_fields=['chat_history'])
+        except Exception as e:
+            logger.warning(f"Failed to persist chat turn for document {document.id}: {e}")
+
     @action(detail=True, methods=['get', 'put'], url_path='chat_history')
     def chat_history(self, request, pk=None):
         """Persist / restore chat history for a document.
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_asgi_application()
+
+# Load the Ollama chat model while the server starts instead of on the first chat turn.
+from api.ollama import preload_on_startup  # noqa: E402
+
+preload_on_startup(server=True)
@@ -8,6 +8,7 @@ function ChatPanel({ document, onClose }) {
   const [messages, setMessages] = useState([]);
   const [inputMessage, setInputMessage] = useState('');
   const [isLoading, setIsLoading] = useState(false);
+  const [isStreaming, setIsStreaming] = useState(false);
   const [isLoadingHistory, setIsLoadingHistory] = useState(false);
   const [isHistoryLoaded, setIsHistoryLoaded] = useState(false);
   const [isCheckingRagStatus, setIsCheckingRagStatus] = useState(false);
@@ -16,10 +17,9 @@ function ChatPanel({ document, onClose }) {
   const [ragStatus, setRagStatus] = useState(null);
   const [ragProgress, setRagProgress] = useState(0);
   const [ragErrorMessage, setRagErrorMessage] = useState(null);
+  const [ragCoverage, setRagCoverage] = useState(null);
   const [error, setError] = useState(null);
   const messagesEndRef = useRef(null);
-  const hasLoadedHistoryRef = useRef(false);
-  const saveDebounceRef = useRef(null);
   const historyLoadTokenRef = useRef(0);
   const ragStatusTokenRef = useRef(0);
 
@@ -51,7 +51,6 @@ function ChatPanel({ document, onClose }) {
       console.warn('Failed to load chat history:', err);
     } finally {
       if (token === historyLoadTokenRef.current) {
-        hasLoadedHistoryRef.current = true;
         setIsLoadingHistory(false);
         setIsHistoryLoaded(true);
       }
@@ -73,8 +72,22 @@ function ChatPanel({ document, onClose }) {
       setRagStatus(result?.rag_status ?? null);
       setRagProgress(typeof result?.rag_progress === 'number' ? result.rag_progress : 0);
       setRagErrorMessage(result?.rag_error_message ?? null);
+      setRagCoverage(
+        typeof result?.rag_coverage === 'number'
+          ? {
+              coverage: result.rag_coverage,
+              indexed: result.rag_pages_indexed ?? 0,
+              total: result.rag_pages_total ?? 0,
+            }
+          : null
+      );
 
       if (result.is_ingested) {
+        // Chat opens as soon as the first page range is indexed; the rest keeps loading.
+        const isPartial =
+          (result?.rag_status === 'queued' || result?.rag_status === 'running') &&
+          typeof result?.rag_coverage === 'number' &&
+          result.rag_coverage < 1;
         setIsIngested(true);
         setIsIngesting(false);
         // Only inject the default system message if there's no existing conversation.
@@ -83,7 +96,9 @@ function ChatPanel({ document, onClose }) {
           return [
             {
               sender: 'system',
-              text: `Document ready (Tài liệu sẵn sàng)! ${result.chunks_count} knowledge chunks available (Có sẵn ${result.chunks_count} đoạn kiến thức). You can ask questions now (Bạn có thể đặt câu hỏi ngay).`,
+              text: isPartial
+                ? `Document partially indexed (Tài liệu đã lập chỉ mục một phần): ${result.rag_pages_indexed}/${result.rag_pages_total} pages (trang). You can ask questions now; fee and fund identity pages are indexed first (Bạn có thể đặt câu hỏi ngay; các trang phí và thông tin quỹ được ưu tiên).`
+                : `Document ready (Tài liệu sẵn sàng)! ${result.chunks_count} knowledge chunks available (Có sẵn ${result.chunks_count} đoạn kiến thức). You can ask questions now (Bạn có thể đặt câu hỏi ngay).`,
               timestamp: new Date(),
             },
           ];
@@ -107,6 +122,7 @@ function ChatPanel({ document, onClose }) {
       setRagStatus(null);
       setRagProgress(0);
       setRagErrorMessage(null);
+      setRagCoverage(null);
     } finally {
       if (token === ragStatusTokenRef.current) {
         setIsCheckingRagStatus(false);
@@ -116,7 +132,6 @@ function ChatPanel({ document, onClose }) {
 
   useEffect(() => {
     // Load persisted chat history (if any) then check ingestion.
-    hasLoadedHistoryRef.current = false;
     setMessages([]);
     setError(null);
     setIsHistoryLoaded(false);
@@ -137,35 +152,6 @@ function ChatPanel({ document, onClose }) {
     return () => clearInterval(id);
   }, [document?.id, ragStatus, isIngesting, checkIngestionStatus]);
 
-  useEffect(() => {
-    // Persist chat history (debounced) whenever messages change.
-    if (!document?.id) return;
-    if (!hasLoadedHistoryRef.current) return;
-
-    if (saveDebounceRef.current) {
-      clearTimeout(saveDebounceRef.current);
-    }
-
-    saveDebounceRef.current = setTimeout(() => {
-      const historyToSave = (messages || []).map((m) => ({
-        sender: m.sender,
-        text: m.text,
-        timestamp: m.timestamp ? new Date(m.timestamp).toISOString() : new Date().toISOString(),
-        chunks_count: m.chunks_count,
-      }));
-
-      api.saveChatHistory(document.id, historyToSave).catch((err) => {
-        console.warn('Failed to save chat history:', err);
-      });
-    }, 500);
-
-    return () => {
-      if (saveDebounceRef.current) {
-        clearTimeout(saveDebounceRef.current);
-      }
-    };
-  }, [messages, document?.id]);
-
   useEffect(() => {
     // Auto-scroll to bottom when new messages arrive
     scrollToBottom();
@@ -208,22 +194,10 @@ function ChatPanel({ document, onClose }) {
     }
   };
 
-  const handleClose = async () => {
-    try {
-      if (document?.id && hasLoadedHistoryRef.current) {
-        const historyToSave = (messages || []).map((m) => ({
-          sender: m.sender,
-          text: m.text,
-          timestamp: m.timestamp ? new Date(m.timestamp).toISOString() : new Date().toISOString(),
-          chunks_count: m.chunks_count,
-        }));
-        await api.saveChatHistory(document.id, historyToSave);
-      }
-    } catch (err) {
-      console.warn('Failed to save chat history on close:', err);
-    } finally {
-      onClose();
-    }
+  // Chat turns are persisted by the server when a streamed answer finishes
+  // (chat_stream); the panel only reads the history, so there is one writer.
+  const handleClose = () => {
+    onClose();
   };
 
   const handleSendMessage = async () => {
@@ -247,16 +221,26 @@ function ChatPanel({ document, onClose }) {
         text: msg.text,
       }));
 
-      const response = await api.chatWithDocument(document.id, inputMessage, history);
-
-      const aiMessage = {
-        sender: 'ai',
-        text: response.answer,
-        timestamp: new Date(),
-        chunks_count: response.chunks_count,
+      // The answer bubble is added on the first token and grows as tokens stream in.
+      const aiTimestamp = new Date();
+      let streamedText = '';
+      const upsertAiMessage = (patch) => {
+        setMessages((prev) => {
+          const last = prev[prev.length - 1];
+          if (last && last.sender === 'ai' && last.timestamp === aiTimestamp) {
+            return [...prev.slice(0, -1), { ...last, ...patch }];
+          }
+          return [...prev, { sender: 'ai', text: '', timestamp: aiTimestamp, ...patch }];
+        });
       };
 
-      setMessages((prev) => [...prev, aiMessage]);
+      const response = await api.chatWithDocumentStream(document.id, inputMessage, history, (delta) => {
+        streamedText += delta;
+        setIsStreaming(true);
+        upsertAiMessage({ text: streamedText });
+      });
+
+      upsertAiMessage({ text: response.answer, chunks_count: response.chunks_count });
     } catch (err) {
       console.error('Chat error:', err);
       const errorMessage = {
@@ -267,6 +251,8 @@ function ChatPanel({ document, onClose }) {
       setMessages((prev) => [...prev, errorMessage]);
       setError(err.message);
     } finally {
+      // The send button stays disabled until the `done` or `error` event.
+      setIsStreaming(false);
       setIsLoading(false);
     }
   };
@@ -430,6 +416,24 @@ function ChatPanel({ document, onClose }) {
         {/* Chat Interface */}
         {isIngested && (
           <>
+            {/* Partial coverage while ingestion is still running */}
+            {(ragStatus === 'queued' || ragStatus === 'running') && ragCoverage && ragCoverage.coverage < 1 && (
+              <div className="px-4 py-2 bg-blue-50 border-b border-blue-100">
+                <div className="flex justify-between text-xs text-blue-800 mb-1">
+                  <span>
+                    Indexing in progress: answers use {ragCoverage.indexed}/{ragCoverage.total} pages (Đang lập chỉ mục: câu trả lời dựa trên {ragCoverage.indexed}/{ragCoverage.total} trang)
+                  </span>
+                  <span>{Math.round(ragCoverage.coverage * 100)}%</span>
+                </div>
+                <div className="w-full h-1.5 bg-blue-100 rounded-full overflow-hidden">
+                  <div
+                    className="h-1.5 bg-blue-600 transition-all"
+                    style={{ width: `${Math.round(ragCoverage.coverage * 100)}%` }}
+                  />
+                </div>
+              </div>
+            )}
+
             {/* Messages Area */}
             <div className="flex-1 overflow-y-auto p-4 space-y-4 bg-gray-50">
               {isLoadingHistory && !isHistoryLoaded && messages.length === 0 && (
@@ -496,7 +500,7 @@ function ChatPanel({ document, onClose }) {
                 </div>
               ))}
 
-              {isLoading && (
+              {isLoading && !isStreaming && (
                 <div className="flex justify-start">
                   <div className="bg-white rounded-lg p-3 shadow-sm border border-gray-200">
                     <div className="flex items-center gap-2">
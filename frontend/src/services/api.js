@@ -294,6 +294,68 @@ class ApiService {
     return response.json();
   }
 
+  /**
+   * Chat with document using RAG, streaming the answer (Server-Sent Events)
+   * @param {number} id - Document ID
+   * @param {string} query - User question
+   * @param {Array} history - Chat history (optional)
+   * @param {Function} onToken - Called with each text delta as it arrives
+   * @returns {Promise} Final event: answer, sources, timings, context_usage
+   */
+  async chatWithDocumentStream(id, query, history = [], onToken = () => {}) {
+    const response = await fetch(`${API_BASE_URL}/documents/${id}/chat_stream/`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        // JSON is accepted too: errors raised before the stream starts come back as JSON.
+        Accept: 'text/event-stream, application/json',
+      },
+      body: JSON.stringify({ query, history }),
+    });
+
+    if (!response.ok) {
+      const error = await response.json().catch(() => ({}));
+      throw new Error(error.error || 'Failed to chat with document');
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let result = null;
+
+    const handleEvent = (raw) => {
+      let event = 'message';
+      const dataLines = [];
+      for (const line of raw.split('\n')) {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) dataLines.push(line.slice(5).trimStart());
+      }
+      if (dataLines.length === 0) return;
+      const data = JSON.parse(dataLines.join('\n'));
+      if (event === 'token') onToken(data.text || '');
+      else if (event === 'done') result = data;
+      else if (event === 'error') throw new Error(data.error || 'Failed to chat with document');
+    };
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let boundary = buffer.indexOf('\n\n');
+      while (boundary !== -1) {
+        handleEvent(buffer.slice(0, boundary));
+        buffer = buffer.slice(boundary + 2);
+        boundary = buffer.indexOf('\n\n');
+      }
+    }
+    if (buffer.trim()) handleEvent(buffer);
+
+    if (!result) {
+      throw new Error('Chat stream ended unexpectedly');
+    }
+    return result;
+  }
+
   /**
    * Get download URL for a document
    * @param {number} id - Document ID